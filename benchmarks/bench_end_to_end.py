@@ -0,0 +1,225 @@
+"""
+End-to-end benchmark of the bot against a local stand-in of the OpenWebUI API.
+Every request goes through the same code as a slash command, with a fake discord.Interaction whose
+responses and edits only wait for a configurable Discord latency: "chat" and "stream" run
+generate_chat_response (non-streamed and streamed), "pages" runs show_generated_awnser on the corpus
+message, and "image" runs the /image command. Every scenario is run at several concurrency levels
+and reports the throughput, the p50/p95/p99 latency of a request and the peak RSS of the process so far.
+The completion is the worst case scenario message of the benchmark corpus, repeated to make it larger.
+The corpus is versioned (benchmarks/corpus/v1): a changed message goes into a new version, so results
+measured on two versions are never compared.
+The bot's own settings (SCHEDULER_CONCURRENCY, STREAM_EDIT_INTERVAL, ...) are read from the environment.
+
+Usage:
+    python benchmarks/bench_end_to_end.py [--scenarios chat,stream,pages,image] [--concurrency 1,8,32]
+        [--requests 64] [--repeat 1] [--latency 0.05] [--token-interval 0] [--discord-latency 0.05]
+"""
+
+import argparse
+import asyncio
+import itertools
+import os
+import resource
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+os.environ.setdefault("DISCORD_TOKEN", "benchmark")
+os.environ.setdefault("MODEL_NAME", "benchmark")
+
+import bot  # noqa: E402
+from backend_pool import load_backends  # noqa: E402
+from openwebui import OpenWebUIClient  # noqa: E402
+from standin import StandIn, build_sources  # noqa: E402
+
+SCENARIOS = ("chat", "stream", "pages", "image")
+
+_ids = itertools.count(1)
+
+
+class FakeChannel:
+    """The channel of the fake interactions, it only builds partial messages."""
+
+    def __init__(self):
+        self.id = next(_ids)
+
+    def get_partial_message(self, message_id: int) -> SimpleNamespace:
+        return SimpleNamespace(id=message_id, channel=self)
+
+
+class FakeResponse:
+    """The interaction response of a fake interaction."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.done = False
+
+    def is_done(self) -> bool:
+        return self.done
+
+    async def defer(self, **kwargs):
+        await asyncio.sleep(self.latency)
+        self.done = True
+
+    async def send_message(self, **kwargs):
+        await asyncio.sleep(self.latency)
+        self.done = True
+
+
+class FakeInteraction:
+    """
+    The part of discord.Interaction the commands use, every call to Discord only waits for the latency.
+
+    Args:
+        latency (float): The seconds a call to Discord takes.
+
+    Attributes:
+        edits (int): The number of edits of the original response.
+    """
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.user = SimpleNamespace(id=next(_ids))
+        self.guild_id = next(_ids)
+        self.channel = FakeChannel()
+        self.channel_id = self.channel.id
+        self.response = FakeResponse(latency)
+        self.message = None
+        self.edits = 0
+
+    async def edit_original_response(self, **kwargs) -> SimpleNamespace:
+        await asyncio.sleep(self.latency)
+        self.edits += 1
+        return SimpleNamespace(id=next(_ids), channel=self.channel, attachments=[])
+
+
+def percentile(samples: list[float], fraction: float) -> float:
+    """Returns a percentile of sorted samples."""
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+
+def peak_rss_mib() -> float:
+    """Returns the peak resident set size of the process, in MiB (ru_maxrss is in KiB on Linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def run_request(scenario: str, number: int, options) -> None:
+    interaction = FakeInteraction(options.discord_latency)
+    # A different prompt every time, so identical requests are not coalesced or cached
+    prompt = f"Benchmark question {number}"
+    if scenario in ("chat", "stream"):
+        bot.STREAM_RESPONSES = scenario == "stream"
+        await bot.generate_chat_response(interaction, prompt, use_cache=False)
+    elif scenario == "pages":
+        await interaction.response.defer()
+        sample = options.sample
+        await bot.show_generated_awnser(
+            interaction,
+            sample["title"],
+            sample["awnser"] * options.repeat,
+            sample["thought"],
+            sample["sources"],
+            prompt,
+        )
+    else:
+        await bot.image_cmd.callback(interaction, prompt)
+    if interaction.edits == 0:
+        raise RuntimeError(f"The {scenario} request did not respond")
+
+
+async def run_level(scenario: str, concurrency: int, options) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: list[float] = []
+    errors: list[Exception] = []
+
+    async def timed(number: int):
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await run_request(scenario, number, options)
+            except Exception as error:
+                errors.append(error)
+                return
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(timed(number) for number in range(options.requests)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "throughput": len(latencies) / elapsed,
+        "p50": percentile(latencies, 0.50) if latencies else 0.0,
+        "p95": percentile(latencies, 0.95) if latencies else 0.0,
+        "p99": percentile(latencies, 0.99) if latencies else 0.0,
+        "errors": errors,
+        "rss": peak_rss_mib(),
+    }
+
+
+async def main_async(options):
+    options.sample = bot.load_corpus_sample("worst_case")
+    completion = (options.sample["thought"] + options.sample["awnser"]) * options.repeat
+    standin = StandIn(
+        completion,
+        build_sources(options.sources),
+        latency=options.latency,
+        token_interval=options.token_interval,
+        image_latency=options.image_latency,
+        image_bytes=options.image_bytes,
+    )
+    url = await standin.start()
+    bot.bot.openwebui = OpenWebUIClient(load_backends("", url, "benchmark"))
+    await bot.bot.setup_hook()
+
+    print(
+        f"completion: {len(completion)} characters, Discord latency: "
+        f"{options.discord_latency * 1000:.0f} ms, backend latency: {options.latency * 1000:.0f} ms"
+    )
+    print(
+        f"{'scenario':<8} {'concurrency':>11} {'req/s':>9} {'p50 ms':>9} "
+        f"{'p95 ms':>9} {'p99 ms':>9} {'errors':>7} {'peak RSS MiB':>13}"
+    )
+    try:
+        for scenario in options.scenarios:
+            for concurrency in options.concurrency:
+                result = await run_level(scenario, concurrency, options)
+                print(
+                    f"{scenario:<8} {concurrency:>11} {result['throughput']:>9.1f} "
+                    f"{result['p50'] * 1000:>9.1f} {result['p95'] * 1000:>9.1f} "
+                    f"{result['p99'] * 1000:>9.1f} {len(result['errors']):>7} {result['rss']:>13.1f}"
+                )
+                if result["errors"]:
+                    print(f"  first error: {result['errors'][0]!r}", file=sys.stderr)
+    finally:
+        await bot.bot.openwebui.close()
+        await bot.bot.response_cache.close()
+        await bot.bot.image_cache.close()
+        await bot.bot.answers.close()
+        await bot.bot.traces.close()
+        await standin.close()
+
+
+def main():
+    arguments = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    arguments.add_argument("--scenarios", default=",".join(SCENARIOS))
+    arguments.add_argument("--concurrency", default="1,8,32")
+    arguments.add_argument("--requests", type=int, default=64)
+    arguments.add_argument("--repeat", type=int, default=1)
+    arguments.add_argument("--sources", type=int, default=5)
+    arguments.add_argument("--latency", type=float, default=0.05)
+    arguments.add_argument("--token-interval", type=float, default=0.0)
+    arguments.add_argument("--discord-latency", type=float, default=0.05)
+    arguments.add_argument("--image-latency", type=float, default=0.2)
+    arguments.add_argument("--image-bytes", type=int, default=512 * 1024)
+    options = arguments.parse_args()
+    options.scenarios = [name for name in options.scenarios.split(",") if name]
+    unknown = set(options.scenarios) - set(SCENARIOS)
+    if unknown:
+        arguments.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    options.concurrency = [int(level) for level in options.concurrency.split(",")]
+    asyncio.run(main_async(options))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Micro-benchmark of the incremental <think> parser against the regex based extraction it replaced.
+The input is the worst case scenario message of the benchmark corpus (the test_message command shows it),
+repeated to make it larger, both as one finished completion and streamed in small chunks (where the regex
+version has to re-scan the whole completion every time a chunk arrives to show a partial answer).
+
+Usage:
+    python benchmarks/bench_think_parser.py [--repeat 50] [--chunk-size 8] [--runs 5]
+"""
+
+import argparse
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+os.environ.setdefault("DISCORD_TOKEN", "benchmark")
+
+from bot import load_corpus_sample  # noqa: E402
+from think_parser import ThinkParser  # noqa: E402
+
+WORST_CASE = load_corpus_sample("worst_case")
+TEST_THOUGHT = WORST_CASE["thought"]
+TEST_AWNSER = WORST_CASE["awnser"]
+
+
+def extract_thought_and_awnser(input_string):
+    """The regex based extraction that ThinkParser replaced, kept as the baseline."""
+    pattern = r"<think>(.*?)</think>"
+    thoughts = re.findall(pattern, input_string, re.DOTALL)
+
+    if len(thoughts) == 0:
+        thoughts = [""]
+
+    awnser = re.sub(pattern, "", input_string).strip()
+    result = [awnser, thoughts[0]]
+
+    return result
+
+
+def split_into_chunks(text: str, size: int) -> list[str]:
+    """Splits the completion like a stream would."""
+    return [text[i : i + size] for i in range(0, len(text), size)]
+
+
+def regex_whole(text: str):
+    extract_thought_and_awnser(text)
+
+
+def parser_whole(text: str):
+    parser = ThinkParser()
+    parser.feed(text)
+    parser.close()
+    return parser.awnser, parser.thought
+
+
+def regex_streamed(chunks: list[str]):
+    received = ""
+    for chunk in chunks:
+        received += chunk
+        extract_thought_and_awnser(received)
+
+
+def parser_streamed(chunks: list[str]):
+    parser = ThinkParser()
+    for chunk in chunks:
+        parser.feed(chunk)
+    parser.close()
+    return parser.awnser, parser.thought
+
+
+def report(name: str, function, argument, runs: int, number: int):
+    best = min(timeit.repeat(lambda: function(argument), number=number, repeat=runs))
+    print(f"{name:<20} {best / number * 1000:10.3f} ms")
+
+
+def main():
+    arguments = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    arguments.add_argument("--repeat", type=int, default=50)
+    arguments.add_argument("--chunk-size", type=int, default=8)
+    arguments.add_argument("--runs", type=int, default=5)
+    options = arguments.parse_args()
+
+    completion = (TEST_THOUGHT + TEST_AWNSER) * options.repeat
+    chunks = split_into_chunks(completion, options.chunk_size)
+
+    # Both implementations must agree on the thought of a single think block
+    # (the regex version leaves multi-line think blocks in the answer, re.sub lacks re.DOTALL)
+    single = TEST_THOUGHT + TEST_AWNSER
+    assert parser_whole(single)[1] == extract_thought_and_awnser(single)[1].strip()
+
+    print(
+        f"completion: {len(completion)} characters, "
+        f"{len(chunks)} chunks of {options.chunk_size} characters"
+    )
+    report("regex, whole", regex_whole, completion, options.runs, 20)
+    report("parser, whole", parser_whole, completion, options.runs, 20)
+
+    # The regex version is quadratic on a stream, keep its input small enough to finish
+    streamed = split_into_chunks(single * min(options.repeat, 5), options.chunk_size)
+    print(f"streamed: {len(streamed)} chunks")
+    report("regex, streamed", regex_streamed, streamed, options.runs, 1)
+    report("parser, streamed", parser_streamed, streamed, options.runs, 1)
+
+
+if __name__ == "__main__":
+    main()
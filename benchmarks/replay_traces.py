@@ -0,0 +1,217 @@
+"""
+Replays the OpenWebUI traffic recorded with TRACE_PATH (see scripts/trace_recorder.py) to compare two
+versions of the bot on real payloads: long think blocks, big source lists and multilingual text.
+"pipeline" feeds every recorded chat completion through the parsing and page layout of the bot and reports
+the time and the peak of the allocations per completion. "backend" sends every recorded request through
+the same code as a slash command, against a stand-in that answers with the recorded responses at the
+recorded pace (or faster with --speed, 0 for no waiting), and reports the throughput, the p50/p95/p99
+latency of a request and the peak RSS of the process.
+The results can be written with --output and compared with the results of another version with --compare.
+
+Usage:
+    python benchmarks/replay_traces.py TRACE_FILE [--modes pipeline,backend] [--runs 3] [--speed 1]
+        [--concurrency 8] [--stream] [--discord-latency 0.05] [--output results.json]
+        [--compare baseline.json]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+os.environ.setdefault("DISCORD_TOKEN", "benchmark")
+os.environ.setdefault("MODEL_NAME", "benchmark")
+
+import bot  # noqa: E402
+from backend_pool import load_backends  # noqa: E402
+from bench_end_to_end import FakeInteraction, peak_rss_mib, percentile  # noqa: E402
+from openwebui import OpenWebUIClient  # noqa: E402
+from page_layout import CompressedPages, layout_pages  # noqa: E402
+from standin import TraceStandIn  # noqa: E402
+from think_parser import ThinkParser  # noqa: E402
+from trace_recorder import TRACE_VERSION, read_traces  # noqa: E402
+
+MODES = ("pipeline", "backend")
+
+
+def trace_prompt(trace: dict) -> str:
+    """Returns the prompt of a recorded request, the last message of a chat."""
+    request = trace["request"]
+    if trace["kind"] == "image":
+        return request.get("prompt") or "Replayed image"
+    messages = request.get("messages") or [{}]
+    content = messages[-1].get("content")
+    return content if isinstance(content, str) and content else "Replayed question"
+
+
+def render(trace: dict):
+    """Parses a recorded chat completion and lays its pages out, like generate_chat_response."""
+    title, awnser, thought, sources = bot.parse_chat_response(
+        trace["response"], ThinkParser()
+    )
+    CompressedPages(layout_pages(title, awnser, thought, sources, trace_prompt(trace)))
+
+
+def run_pipeline(traces: list[dict], options) -> dict:
+    completions = [
+        trace for trace in traces if trace["kind"] == "chat" and trace["status"] == 200
+    ]
+    if not completions:
+        return {}
+
+    # The fastest of the runs, tracemalloc is off while timing
+    durations = [float("inf")] * len(completions)
+    for _ in range(options.runs):
+        for index, trace in enumerate(completions):
+            started = time.perf_counter()
+            render(trace)
+            durations[index] = min(durations[index], time.perf_counter() - started)
+
+    peaks = []
+    tracemalloc.start()
+    try:
+        for trace in completions:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            render(trace)
+            peaks.append(tracemalloc.get_traced_memory()[1] - before)
+    finally:
+        tracemalloc.stop()
+
+    durations.sort()
+    peaks.sort()
+    return {
+        "completions": len(completions),
+        "total_ms": sum(durations) * 1000,
+        "p50_ms": percentile(durations, 0.50) * 1000,
+        "p95_ms": percentile(durations, 0.95) * 1000,
+        "max_ms": durations[-1] * 1000,
+        "peak_alloc_p50_kib": percentile(peaks, 0.50) / 1024,
+        "peak_alloc_max_kib": peaks[-1] / 1024,
+    }
+
+
+async def replay_request(trace: dict, options):
+    interaction = FakeInteraction(options.discord_latency)
+    if trace["kind"] == "image":
+        await bot.image_cmd.callback(interaction, trace_prompt(trace))
+    else:
+        await bot.generate_chat_response(
+            interaction, trace_prompt(trace), use_cache=False
+        )
+    if interaction.edits == 0:
+        raise RuntimeError(f"The replayed {trace['kind']} request did not respond")
+
+
+async def run_backend(traces: list[dict], options) -> dict:
+    standin = TraceStandIn(traces, options.speed)
+    url = await standin.start()
+    bot.STREAM_RESPONSES = options.stream
+    bot.bot.openwebui = OpenWebUIClient(load_backends("", url, "benchmark"))
+    await bot.bot.setup_hook()
+
+    semaphore = asyncio.Semaphore(options.concurrency)
+    latencies: list[float] = []
+    errors: list[Exception] = []
+
+    async def timed(trace: dict):
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await replay_request(trace, options)
+            except Exception as error:
+                errors.append(error)
+                return
+            latencies.append(time.perf_counter() - started)
+
+    try:
+        started = time.perf_counter()
+        await asyncio.gather(*(timed(trace) for trace in traces))
+        elapsed = time.perf_counter() - started
+    finally:
+        await bot.bot.openwebui.close()
+        await bot.bot.response_cache.close()
+        await bot.bot.image_cache.close()
+        await bot.bot.answers.close()
+        await bot.bot.traces.close()
+        await standin.close()
+
+    if errors:
+        print(f"  first error: {errors[0]!r}", file=sys.stderr)
+    latencies.sort()
+    return {
+        "requests": len(traces),
+        "errors": len(errors),
+        "throughput": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 0.50) * 1000 if latencies else 0.0,
+        "p95_ms": percentile(latencies, 0.95) * 1000 if latencies else 0.0,
+        "p99_ms": percentile(latencies, 0.99) * 1000 if latencies else 0.0,
+        "peak_rss_mib": peak_rss_mib(),
+    }
+
+
+def compare(results: dict, baseline: dict):
+    """Prints every result next to the one of the baseline and the change in percent."""
+    print(f"{'metric':<30} {'baseline':>12} {'current':>12} {'change':>9}")
+    for mode, values in results["modes"].items():
+        for name, value in values.items():
+            before = baseline.get("modes", {}).get(mode, {}).get(name)
+            if before is None:
+                continue
+            change = f"{(value - before) / before * 100:+.1f}%" if before else "n/a"
+            print(f"{mode + '.' + name:<30} {before:>12.2f} {value:>12.2f} {change:>9}")
+
+
+def main():
+    arguments = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    arguments.add_argument("traces")
+    arguments.add_argument("--modes", default=",".join(MODES))
+    arguments.add_argument("--runs", type=int, default=3)
+    arguments.add_argument("--speed", type=float, default=1.0)
+    arguments.add_argument("--concurrency", type=int, default=8)
+    arguments.add_argument("--stream", action="store_true")
+    arguments.add_argument("--discord-latency", type=float, default=0.05)
+    arguments.add_argument("--output")
+    arguments.add_argument("--compare")
+    options = arguments.parse_args()
+    options.modes = [name for name in options.modes.split(",") if name]
+    unknown = set(options.modes) - set(MODES)
+    if unknown:
+        arguments.error(f"unknown modes: {', '.join(sorted(unknown))}")
+
+    traces = [
+        trace
+        for trace in read_traces(options.traces)
+        if trace["version"] == TRACE_VERSION
+    ]
+    if not traces:
+        arguments.error(f"no traces in {options.traces}")
+    print(
+        f"{len(traces)} traces ({sum(trace['kind'] == 'chat' for trace in traces)} chat), "
+        f"speed: {options.speed or 'no waiting'}"
+    )
+
+    results = {"traces": options.traces, "modes": {}}
+    if "pipeline" in options.modes:
+        results["modes"]["pipeline"] = run_pipeline(traces, options)
+    if "backend" in options.modes:
+        results["modes"]["backend"] = asyncio.run(run_backend(traces, options))
+    for mode, values in results["modes"].items():
+        print(mode)
+        for name, value in values.items():
+            print(f"  {name:<22} {value:>12.2f}")
+
+    if options.output:
+        with open(options.output, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+    if options.compare:
+        with open(options.compare, encoding="utf-8") as file:
+            compare(results, json.load(file))
+
+
+if __name__ == "__main__":
+    main()
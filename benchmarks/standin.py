@@ -0,0 +1,268 @@
+"""
+A local stand-in of the OpenWebUI API for the benchmarks.
+It answers /api/chat/completions (streamed as server-sent events or as a single JSON body) with a completion
+built from the benchmark corpus, /api/v1/images/generations with the URL of an image and that URL with the
+image itself. The latency of every endpoint and the size of the payloads are configurable, so a benchmark
+measures the bot and not a real model. TraceStandIn answers with the responses and the timings of recorded
+traces instead (see scripts/trace_recorder.py).
+"""
+
+import asyncio
+import itertools
+import json
+import os
+from typing import Any, NamedTuple, Optional
+
+from aiohttp import web
+
+IMAGE_PATH = "/cache/image/generations/benchmark.png"
+
+# The first bytes of a PNG file, the rest of the benchmark image is random
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+class ChatReply(NamedTuple):
+    """The answer of the stand-in to a chat request."""
+
+    status: int
+    completion: str
+    sources: list
+    latency: float
+    token_interval: float
+    error: str = ""
+
+
+class ImageReply(NamedTuple):
+    """The answer of the stand-in to an image generation request."""
+
+    status: int
+    latency: float
+    error: str = ""
+
+
+def build_sources(count: int) -> list[dict]:
+    """
+    Builds the web search sources of a completion.
+
+    Args:
+        count (int): The number of links of the sources.
+
+    Returns:
+        list[dict]: The sources, shaped like the ones of OpenWebUI.
+    """
+    return [
+        {
+            "source": {"name": "Benchmark source"},
+            "metadata": [
+                {"title": f"Source {number}", "source": f"https://example.com/{number}"}
+                for number in range(count)
+            ],
+        }
+    ]
+
+
+class StandIn:
+    """
+    A local server answering like OpenWebUI.
+
+    Args:
+        completion (str): The completion of every chat request.
+        sources (list[dict]): The sources of every chat request.
+        latency (float): The seconds before the first byte of a chat request.
+        token_interval (float): The seconds between two chunks of a streamed completion.
+        chunk_size (int): The characters of a chunk of a streamed completion.
+        image_latency (float): The seconds an image generation takes.
+        image_bytes (int): The size of the generated image.
+
+    Attributes:
+        url (Optional[str]): The base URL of the server, once started.
+        requests (int): The number of requests answered.
+    """
+
+    def __init__(
+        self,
+        completion: str,
+        sources: list[dict],
+        latency: float = 0.05,
+        token_interval: float = 0.0,
+        chunk_size: int = 16,
+        image_latency: float = 0.2,
+        image_bytes: int = 512 * 1024,
+    ):
+        self.completion = completion
+        self.sources = sources
+        self.latency = latency
+        self.token_interval = token_interval
+        self.chunk_size = chunk_size
+        self.image_latency = image_latency
+        self.image = PNG_SIGNATURE + os.urandom(
+            max(0, image_bytes - len(PNG_SIGNATURE))
+        )
+        self.url: Optional[str] = None
+        self.requests = 0
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """
+        Starts the server.
+
+        Args:
+            host (str): The address the server listens on.
+            port (int): The port the server listens on, 0 for any free port.
+
+        Returns:
+            str: The base URL of the server.
+        """
+        app = web.Application()
+        app.router.add_post("/api/chat/completions", self.chat)
+        app.router.add_post("/api/v1/images/generations", self.generate_image)
+        app.router.add_get(IMAGE_PATH, self.download_image)
+        app.router.add_get("/health", self.health)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def close(self):
+        """Stops the server."""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def chat_reply(self, body: dict) -> ChatReply:
+        """
+        Chooses the answer to a chat request.
+
+        Args:
+            body (dict): The body of the request.
+
+        Returns:
+            ChatReply: The answer and its timing.
+        """
+        return ChatReply(
+            200, self.completion, self.sources, self.latency, self.token_interval
+        )
+
+    def image_reply(self, body: dict) -> ImageReply:
+        """
+        Chooses the answer to an image generation request.
+
+        Args:
+            body (dict): The body of the request.
+
+        Returns:
+            ImageReply: The status and the timing of the answer.
+        """
+        return ImageReply(200, self.image_latency)
+
+    async def chat(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        body = await request.json()
+        reply = self.chat_reply(body)
+        await asyncio.sleep(reply.latency)
+        if reply.status != 200:
+            return web.Response(status=reply.status, text=reply.error)
+        if not body.get("stream"):
+            return web.json_response(
+                {
+                    "choices": [{"message": {"content": reply.completion}}],
+                    "sources": reply.sources,
+                }
+            )
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        await response.write(self._event({"sources": reply.sources}))
+        for start in range(0, len(reply.completion), self.chunk_size):
+            chunk = reply.completion[start : start + self.chunk_size]
+            await response.write(
+                self._event({"choices": [{"delta": {"content": chunk}}]})
+            )
+            if reply.token_interval:
+                await asyncio.sleep(reply.token_interval)
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def generate_image(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        reply = self.image_reply(await request.json())
+        await asyncio.sleep(reply.latency)
+        if reply.status != 200:
+            return web.Response(status=reply.status, text=reply.error)
+        return web.json_response([{"url": IMAGE_PATH}])
+
+    async def download_image(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        return web.Response(body=self.image, content_type="image/png")
+
+    async def health(self, request: web.Request) -> web.Response:
+        return web.Response(text="ok")
+
+    @staticmethod
+    def _event(data: dict) -> bytes:
+        return f"data: {json.dumps(data)}\n\n".encode()
+
+
+class TraceStandIn(StandIn):
+    """
+    A stand-in answering with the responses of recorded traces, in turn, at their recorded pace.
+
+    The time until the first byte of a trace is waited before answering, and the rest of its time is spread
+    over the chunks of a streamed answer. Image generations answer with the benchmark image, the recorded
+    ones are not kept.
+
+    Args:
+        traces (list[dict]): The traces, as read by read_traces.
+        speed (float): How many times faster than recorded the traces are replayed, 0 for no waiting at all.
+        **kwargs: The other arguments of StandIn.
+    """
+
+    def __init__(self, traces: list[dict], speed: float = 1.0, **kwargs):
+        super().__init__("", [], **kwargs)
+        self.speed = speed
+        chat = [trace for trace in traces if trace["kind"] == "chat"]
+        image = [trace for trace in traces if trace["kind"] == "image"]
+        self._chat = itertools.cycle(chat) if chat else None
+        self._image = itertools.cycle(image) if image else None
+
+    def _scaled(self, seconds: float) -> float:
+        return seconds / self.speed if self.speed else 0.0
+
+    @staticmethod
+    def _error(response: Any) -> str:
+        return response if isinstance(response, str) else json.dumps(response)
+
+    def chat_reply(self, body: dict) -> ChatReply:
+        if self._chat is None:
+            return super().chat_reply(body)
+        trace = next(self._chat)
+        latency = self._scaled(trace["first_byte"])
+        response = trace["response"]
+        if trace["status"] != 200:
+            return ChatReply(
+                trace["status"], "", [], latency, 0.0, self._error(response)
+            )
+
+        completion = response["choices"][0]["message"]["content"] or ""
+        sources = response.get("sources") or []
+        if not body.get("stream"):
+            # A single body is only sent once the whole completion is generated
+            return ChatReply(
+                200, completion, sources, self._scaled(trace["total"]), 0.0
+            )
+        chunks = max(1, -(-len(completion) // self.chunk_size))
+        token_interval = self._scaled(trace["total"] - trace["first_byte"]) / chunks
+        return ChatReply(200, completion, sources, latency, token_interval)
+
+    def image_reply(self, body: dict) -> ImageReply:
+        if self._image is None:
+            return super().image_reply(body)
+        trace = next(self._image)
+        latency = self._scaled(trace["total"])
+        if trace["status"] != 200:
+            return ImageReply(trace["status"], latency, self._error(trace["response"]))
+        return ImageReply(200, latency)
@@ -0,0 +1,209 @@
+"""
+This file contains the store of the answers shown by the pagination, so the buttons of an answer keep
+working after a restart (or after its view was evicted) without asking the LLM again.
+The compressed pages of every answer are kept in a SQLite file in WAL mode, keyed by the ID of the message
+that shows them, and answers older than the retention are pruned. The file is only used from a worker
+thread, so disk I/O never blocks the event loop.
+"""
+
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Iterable, Optional
+
+from page_layout import CompressedPages
+
+ANSWER_STORE_PATH = os.getenv("ANSWER_STORE_PATH", "")
+ANSWER_STORE_RETENTION = float(os.getenv("ANSWER_STORE_RETENTION", str(30 * 86400)))
+
+# Minimum amount of seconds between two prunes of the old answers
+PRUNE_INTERVAL = 3600
+
+
+class StoredAnswer:
+    """
+    An answer read from the store.
+
+    Attributes:
+        pages (CompressedPages): The pages of the answer.
+        users (set[int]): The IDs of the users allowed to use the buttons.
+    """
+
+    def __init__(self, pages: CompressedPages, users: set[int]):
+        self.pages = pages
+        self.users = users
+
+
+class AnswerStore:
+    """
+    A SQLite store of the pages of the answers, keyed by message ID.
+
+    Args:
+        path (str): The path of the SQLite file, an empty string disables the store.
+        retention (float): The amount of seconds an answer is kept.
+
+    Attributes:
+        saved (int): The number of answers saved.
+        loaded (int): The number of answers loaded.
+
+    Methods:
+        open: Opens the file and prunes the old answers.
+        close: Closes the file.
+        save: Stores the pages of an answer.
+        load: Reads the pages of an answer.
+        delete: Removes the answers of deleted messages.
+    """
+
+    def __init__(
+        self, path: str = ANSWER_STORE_PATH, retention: float = ANSWER_STORE_RETENTION
+    ):
+        self.path = path
+        self.retention = retention
+        self.saved = 0
+        self.loaded = 0
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        self._pruned_at = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        """Whether the store keeps anything."""
+        return bool(self.path)
+
+    async def open(self):
+        """Opens the file and prunes the old answers."""
+        if self.enabled and self._db is None:
+            await asyncio.to_thread(self._open_db)
+
+    async def close(self):
+        """Closes the file."""
+        if self._db is not None:
+            await asyncio.to_thread(self._close_db)
+
+    async def save(self, message_id: int, pages: CompressedPages, users: set[int]):
+        """
+        Stores the pages of an answer, replacing the previous answer of the message.
+
+        Args:
+            message_id (int): The ID of the message that shows the answer.
+            pages (CompressedPages): The pages of the answer.
+            users (set[int]): The IDs of the users allowed to use the buttons.
+        """
+        if self._db is None:
+            return
+        prune = time.monotonic() - self._pruned_at > PRUNE_INTERVAL
+        if prune:
+            self._pruned_at = time.monotonic()
+        await asyncio.to_thread(
+            self._db_save, message_id, pages.compressed, sorted(users), prune
+        )
+        self.saved += 1
+
+    async def load(self, message_id: int) -> Optional[StoredAnswer]:
+        """
+        Reads the pages of an answer.
+
+        Args:
+            message_id (int): The ID of the message that shows the answer.
+
+        Returns:
+            Optional[StoredAnswer]: The answer, or None if it is not stored.
+        """
+        if self._db is None:
+            return None
+        row = await asyncio.to_thread(self._db_load, message_id)
+        if row is None:
+            return None
+        users, pages = row
+        self.loaded += 1
+        return StoredAnswer(CompressedPages.from_compressed(pages), set(users))
+
+    async def delete(self, message_ids: Iterable[int]):
+        """
+        Removes the answers of deleted messages.
+
+        Args:
+            message_ids (Iterable[int]): The IDs of the deleted messages.
+        """
+        if self._db is not None:
+            await asyncio.to_thread(self._db_delete, list(message_ids))
+
+    def _open_db(self):
+        with self._db_lock:
+            self._db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            # WAL lets the reads of old answers run while a new answer is written
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS answers "
+                "(message_id INTEGER PRIMARY KEY, created_at REAL NOT NULL, users TEXT NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS pages (message_id INTEGER NOT NULL, "
+                "number INTEGER NOT NULL, data BLOB NOT NULL, "
+                "PRIMARY KEY (message_id, number)) WITHOUT ROWID"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS answers_created_at ON answers (created_at)"
+            )
+            self._prune()
+            self._db.commit()
+        self._pruned_at = time.monotonic()
+
+    def _close_db(self):
+        with self._db_lock:
+            self._db.close()
+            self._db = None
+
+    def _prune(self):
+        deadline = time.time() - self.retention
+        self._db.execute(
+            "DELETE FROM pages WHERE message_id IN "
+            "(SELECT message_id FROM answers WHERE created_at < ?)",
+            (deadline,),
+        )
+        self._db.execute("DELETE FROM answers WHERE created_at < ?", (deadline,))
+
+    def _db_save(
+        self, message_id: int, pages: list[bytes], users: list[int], prune: bool
+    ):
+        with self._db_lock:
+            self._db.execute("DELETE FROM pages WHERE message_id = ?", (message_id,))
+            self._db.execute(
+                "INSERT OR REPLACE INTO answers (message_id, created_at, users) VALUES (?, ?, ?)",
+                (message_id, time.time(), json.dumps(users)),
+            )
+            self._db.executemany(
+                "INSERT INTO pages (message_id, number, data) VALUES (?, ?, ?)",
+                [(message_id, number, data) for number, data in enumerate(pages)],
+            )
+            if prune:
+                self._prune()
+            self._db.commit()
+
+    def _db_load(self, message_id: int) -> Optional[tuple[list[int], list[bytes]]]:
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT users FROM answers WHERE message_id = ?", (message_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            pages = self._db.execute(
+                "SELECT data FROM pages WHERE message_id = ? ORDER BY number",
+                (message_id,),
+            ).fetchall()
+        return json.loads(row[0]), [data for (data,) in pages]
+
+    def _db_delete(self, message_ids: list[int]):
+        with self._db_lock:
+            for message_id in message_ids:
+                self._db.execute(
+                    "DELETE FROM pages WHERE message_id = ?", (message_id,)
+                )
+                self._db.execute(
+                    "DELETE FROM answers WHERE message_id = ?", (message_id,)
+                )
+            self._db.commit()
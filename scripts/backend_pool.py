@@ -0,0 +1,271 @@
+"""
+This file contains the pool of OpenWebUI backends the bot spreads its requests over.
+Every backend has a weight and, optionally, the list of models it serves. A request goes to the backend
+with the fewest outstanding requests for its weight, either among all the backends that serve the model
+("least") or among two of them picked at random ("p2c", power of two choices).
+Backends are probed periodically and a circuit breaker ejects a backend after consecutive failures: it is
+skipped for a while, then a single trial request decides whether it comes back.
+"""
+
+import asyncio
+import json
+import os
+import random
+import time
+from typing import Optional
+
+import aiohttp
+
+# JSON list of backends, every backend is a URL or an object with "url", "weight", "models" and "api_key"
+OPENWEBUI_BACKENDS = os.getenv("OPENWEBUI_BACKENDS", "")
+BACKEND_STRATEGY = os.getenv("BACKEND_STRATEGY", "least")
+BACKEND_PROBE_INTERVAL = float(os.getenv("BACKEND_PROBE_INTERVAL", "15"))
+BACKEND_PROBE_PATH = os.getenv("BACKEND_PROBE_PATH", "/health")
+BACKEND_PROBE_TIMEOUT = float(os.getenv("BACKEND_PROBE_TIMEOUT", "5"))
+BACKEND_FAILURE_THRESHOLD = int(os.getenv("BACKEND_FAILURE_THRESHOLD", "3"))
+BACKEND_OPEN_SECONDS = float(os.getenv("BACKEND_OPEN_SECONDS", "30"))
+
+# States of the circuit breaker of a backend
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class NoBackendError(aiohttp.ClientConnectionError):
+    """Raised when no backend that serves the model is available."""
+
+
+class Backend:
+    """
+    An OpenWebUI instance of the pool.
+
+    Args:
+        url (str): The base URL of the instance.
+        api_key (str): The API key used in the Authorization header.
+        weight (float): The share of the requests the instance gets, relative to the others.
+        models (Optional[set[str]]): The models the instance serves, None for every model.
+
+    Attributes:
+        outstanding (int): The number of requests in flight.
+        healthy (bool): Whether the last health probe succeeded.
+        state (str): The state of the circuit breaker (closed, open or half-open).
+        failures (int): The number of consecutive failed requests.
+        requests (int): The number of requests sent.
+        errors (int): The number of failed requests.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        api_key: str,
+        weight: float = 1.0,
+        models: Optional[set[str]] = None,
+    ):
+        self.url = url.rstrip("/")
+        self.api_key = api_key
+        self.weight = weight
+        self.models = models
+        self.outstanding = 0
+        self.healthy = True
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.requests = 0
+        self.errors = 0
+
+    def serves(self, model: Optional[str]) -> bool:
+        """Whether the backend serves the model."""
+        return model is None or self.models is None or model in self.models
+
+    def available(self) -> bool:
+        """Whether a request can be sent to the backend."""
+        if not self.healthy:
+            return False
+        if self.state == HALF_OPEN:
+            # A single trial request at a time
+            return self.outstanding == 0
+        return self.state == CLOSED
+
+    def load(self) -> float:
+        """The outstanding requests of the backend, relative to its weight."""
+        return (self.outstanding + 1) / self.weight
+
+
+def load_backends(config: str, api_base: str, api_key: str) -> list[Backend]:
+    """
+    Builds the backends from OPENWEBUI_BACKENDS, or from OPENWEBUI_API_BASE when it is not set.
+
+    Args:
+        config (str): The JSON list of backends.
+        api_base (str): The base URL used when the list is empty.
+        api_key (str): The API key of the backends that do not set their own.
+
+    Returns:
+        list[Backend]: The backends.
+    """
+    if not config:
+        return [Backend(api_base or "", api_key)]
+    backends = []
+    for entry in json.loads(config):
+        if isinstance(entry, str):
+            entry = {"url": entry}
+        models = entry.get("models")
+        backends.append(
+            Backend(
+                entry["url"],
+                entry.get("api_key", api_key),
+                float(entry.get("weight", 1)),
+                set(models) if models else None,
+            )
+        )
+    return backends
+
+
+class BackendPool:
+    """
+    Picks the backend of every request and keeps track of the health of the backends.
+
+    Args:
+        backends (list[Backend]): The backends of the pool.
+        strategy (str): "least" for the least outstanding requests, "p2c" for the power of two choices.
+        probe_interval (float): The amount of seconds between two health probes, 0 disables them.
+        failure_threshold (int): The number of consecutive failures that open the breaker of a backend.
+        open_seconds (float): The amount of seconds a backend is ejected before a trial request.
+
+    Methods:
+        start: Starts the health probes.
+        close: Stops the health probes.
+        pick: Picks the backend of a request.
+        record: Records the outcome of a request.
+        stats: Returns the state of every backend.
+    """
+
+    def __init__(
+        self,
+        backends: list[Backend],
+        strategy: str = BACKEND_STRATEGY,
+        probe_interval: float = BACKEND_PROBE_INTERVAL,
+        failure_threshold: int = BACKEND_FAILURE_THRESHOLD,
+        open_seconds: float = BACKEND_OPEN_SECONDS,
+    ):
+        self.backends = backends
+        self.strategy = strategy
+        self.probe_interval = probe_interval
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self._probe_task: Optional[asyncio.Task] = None
+
+    def start(self, session: aiohttp.ClientSession):
+        """
+        Starts the health probes, only when there is more than one backend to choose from.
+
+        Args:
+            session (aiohttp.ClientSession): The session used to send the probes.
+        """
+        if (
+            self._probe_task is None
+            and self.probe_interval > 0
+            and len(self.backends) > 1
+        ):
+            self._probe_task = asyncio.create_task(self._probe_loop(session))
+
+    async def close(self):
+        """Stops the health probes."""
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+            try:
+                await self._probe_task
+            except asyncio.CancelledError:
+                pass
+            self._probe_task = None
+
+    def pick(self, model: Optional[str] = None) -> Backend:
+        """
+        Picks the backend of a request, a pool of a single backend always picks it.
+
+        Args:
+            model (Optional[str]): The model of the request, None if any backend can serve it.
+
+        Returns:
+            Backend: The backend with the fewest outstanding requests for its weight.
+
+        Raises:
+            NoBackendError: If no available backend serves the model.
+        """
+        if len(self.backends) == 1:
+            return self.backends[0]
+        now = time.monotonic()
+        for backend in self.backends:
+            # An open breaker turns half-open after open_seconds, the next request is its trial
+            if backend.state == OPEN and now - backend.opened_at >= self.open_seconds:
+                backend.state = HALF_OPEN
+        candidates = [
+            backend
+            for backend in self.backends
+            if backend.serves(model) and backend.available()
+        ]
+        if not candidates:
+            raise NoBackendError(f"No backend available for the model {model}")
+        if self.strategy == "p2c" and len(candidates) > 2:
+            # Two distinct backends, drawing the same one twice would not compare anything
+            first, second = random.sample(candidates, 2)
+            return first if first.load() <= second.load() else second
+        lowest = min(backend.load() for backend in candidates)
+        return random.choice(
+            [backend for backend in candidates if backend.load() == lowest]
+        )
+
+    def record(self, backend: Backend, success: bool):
+        """
+        Records the outcome of a request, opening the breaker after too many consecutive failures.
+
+        Args:
+            backend (Backend): The backend of the request.
+            success (bool): Whether the request succeeded.
+        """
+        backend.requests += 1
+        if success:
+            backend.failures = 0
+            backend.state = CLOSED
+            return
+        backend.errors += 1
+        backend.failures += 1
+        if backend.state == HALF_OPEN or backend.failures >= self.failure_threshold:
+            backend.state = OPEN
+            backend.opened_at = time.monotonic()
+
+    def stats(self) -> list[dict]:
+        """
+        Returns the state of every backend.
+
+        Returns:
+            list[dict]: The URL, state, health, outstanding requests, requests and errors of every backend.
+        """
+        return [
+            {
+                "url": backend.url,
+                "state": backend.state,
+                "healthy": backend.healthy,
+                "outstanding": backend.outstanding,
+                "requests": backend.requests,
+                "errors": backend.errors,
+            }
+            for backend in self.backends
+        ]
+
+    async def _probe(self, session: aiohttp.ClientSession, backend: Backend):
+        try:
+            async with session.get(
+                backend.url + BACKEND_PROBE_PATH,
+                timeout=aiohttp.ClientTimeout(total=BACKEND_PROBE_TIMEOUT),
+            ) as response:
+                backend.healthy = response.status < 500
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            backend.healthy = False
+
+    async def _probe_loop(self, session: aiohttp.ClientSession):
+        while True:
+            await asyncio.gather(
+                *(self._probe(session, backend) for backend in self.backends)
+            )
+            await asyncio.sleep(self.probe_interval)
@@ -9,20 +9,66 @@ The implementation utilizes classes, methods, and tools to handle text and image
 Error handling and logging are implemented to ensure efficient and reliable operation of the bot.
 """
 
-import base64
+import asyncio
+import io
 import json
 import logging
 import os
-import re
-from io import BytesIO
+import sqlite3
+import time
+from functools import partial
+from typing import Optional
 
 import aiohttp
 import discord
-import requests
+from answer_store import AnswerStore
+from backend_pool import OPENWEBUI_BACKENDS, Backend, load_backends
+from cluster_state import SharedLimiter, parse_shard_ids
+from context_builder import ChatContext, build_context
 from discord import app_commands
 from discord.ext import commands
 from dotenv import load_dotenv
-from pagination import Pagination
+from edit_coalescer import EditCoalescer, edit_stats, rate_limit_trace
+from history import ChannelHistoryCache, HistoryMessage
+from image_cache import ImageCache, image_key
+from images import (
+    IMAGE_RECOMPRESS_WEBP,
+    DownloadedImage,
+    ImageTooLargeError,
+    recompress_webp,
+    stream_image,
+)
+from log_pipeline import Payload, setup_logging
+from loop_watchdog import HeartbeatBlockedFilter, LoopWatchdog
+from mention_batcher import MentionBatcher
+from metrics import (
+    METRICS_HOST,
+    METRICS_PORT,
+    Metric,
+    command,
+    gateway_events,
+    registry,
+    timed_stage,
+)
+from openwebui import ENDPOINT_TIMEOUTS, OpenWebUIClient
+from page_layout import CompressedPages, layout_pages
+from pagination import Pagination, StoredPagination, current_page
+from profilers import Profiler, ProfilerBusyError, ProfilerStateError
+from resilience import (
+    RESILIENCE_MIN_CHAT_TIMEOUT,
+    RETRY_STATUSES,
+    RetryableStatusError,
+    StreamInterruptedError,
+    Timeouts,
+)
+from response_cache import ResponseCache, make_key
+from scheduler import PRIORITY_DM, PRIORITY_GUILD, BackendScheduler, SchedulerFullError
+from sessions import SessionStore
+from single_flight import SingleFlight
+from streaming import STREAM_EDIT_INTERVAL, StreamingPreview, iter_sse_data
+from think_parser import ThinkParser
+from trace_recorder import TraceRecorder
+from view_registry import ViewRegistry
 
 # Load environment variables
 load_dotenv()
@@ -32,22 +78,342 @@ DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
 OPENWEBUI_API_KEY = os.getenv("OPENWEBUI_API_KEY")
 OPENWEBUI_API_BASE = os.getenv("OPENWEBUI_API_BASE")
 MODEL_NAME = os.getenv("MODEL_NAME")
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "false").lower() == "true"
+
+# Sharding: SHARD_COUNT shards in total (empty for the count Discord recommends), of which this process runs
+# SHARD_IDS (empty for all of them); cluster.py sets them for every worker
+SHARDING = os.getenv("SHARDING", "false").lower() == "true"
+SHARD_COUNT = int(os.getenv("SHARD_COUNT") or 0) or None
+SHARD_IDS = parse_shard_ids(os.getenv("SHARD_IDS", ""))
+# The slash commands are global, cluster.py only lets its first worker sync them
+SYNC_COMMANDS = os.getenv("SYNC_COMMANDS", "true").lower() == "true"
+
+# Model and generation parameters of the /image command
+IMAGE_MODEL = "dreamshaper_8"
+IMAGE_PARAMS: dict = {}
+
+# Benchmark corpus, its worst case scenario message is shown by the test_message command
+CORPUS_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "..",
+    "benchmarks",
+    "corpus",
+    "v1",
+    "messages.json",
+)
+
+# Chat used by the requests that are not part of a conversation session
+DEFAULT_CHAT_ID = "4a299940-11b4-49e7-9844-5c39e2a2955c"
+
+# Logger of the bot, its records go through the queue of the logging pipeline set up by main
+LOGGER_NAME = "discord.gateway"
+logger = logging.getLogger(LOGGER_NAME)
+
+
+# A sharded bot runs one gateway connection per shard, all of them on the same event loop
+BotBase = commands.AutoShardedBot if SHARDING else commands.Bot
+
+
+class AIBot(BotBase):
+    """
+    The Discord bot, owns the resources shared by every command.
+
+    Attributes:
+        openwebui (OpenWebUIClient): The pooled HTTP client used for every OpenWebUI call, spread over the backends.
+        response_cache (ResponseCache): The cache of the answers to /question.
+        single_flight (SingleFlight): The coalescing of identical chat requests in flight.
+        scheduler (BackendScheduler): The limiter of concurrent requests to the LLM backend.
+        shared_limiter (SharedLimiter): The limit of the requests to the LLM backend shared by the workers
+            of a cluster.
+        history (ChannelHistoryCache): The recent messages of the channels, kept current from gateway events.
+        mentions (MentionBatcher): The batching of the mentions answered by the bot, created in setup_hook.
+        sessions (SessionStore): The conversation sessions of the channels and threads.
+        image_cache (ImageCache): The on-disk cache of the generated images.
+        views (ViewRegistry): The registry that bounds the live pagination views.
+        answers (AnswerStore): The store of the answers, so their buttons survive restarts.
+        traces (TraceRecorder): The recorder of the OpenWebUI traffic, for the replay benchmarks.
+        watchdog (LoopWatchdog): The watchdog that logs what blocks the event loop.
+        profiler (Profiler): The on-demand CPU and memory profiler of the owner's commands.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.openwebui = OpenWebUIClient(
+            load_backends(OPENWEBUI_BACKENDS, OPENWEBUI_API_BASE, OPENWEBUI_API_KEY)
+        )
+        self.response_cache = ResponseCache()
+        self.single_flight = SingleFlight()
+        self.shared_limiter = SharedLimiter()
+        self.scheduler = BackendScheduler(shared=self.shared_limiter)
+        self.history = ChannelHistoryCache()
+        self.mentions: Optional[MentionBatcher] = None
+        self.sessions = SessionStore()
+        self.image_cache = ImageCache()
+        self.views = ViewRegistry()
+        self.answers = AnswerStore()
+        self.traces = TraceRecorder()
+        self.watchdog = LoopWatchdog(logger)
+        self.profiler = Profiler()
+        self._restoring: dict[int, asyncio.Task] = {}
+
+    async def setup_hook(self):
+        """
+        Opens the resources of the bot before it connects to Discord: the shared HTTP client, the response
+        and image caches, the answer store, the limit shared with the other workers, the mention batcher,
+        the view of the stored answers, the metrics collector and server, and the event loop watchdog.
+        """
+        await self.openwebui.start()
+        await self.response_cache.open()
+        await self.image_cache.open()
+        await self.answers.open()
+        await self.shared_limiter.open()
+        self.mentions = MentionBatcher(answer_mentions, logger)
+        if self.answers.enabled:
+            # Answers the buttons of the stored answers that have no live view
+            self.add_view(
+                StoredPagination(self.restore_view, generate_chat_response, logger)
+            )
+        registry.collector(self.collect_metrics)
+        await registry.start(METRICS_HOST, METRICS_PORT)
+        self.watchdog.start()
+
+    async def close(self):
+        """
+        Closes the resources of the bot when it shuts down: the event loop watchdog, the shared HTTP client,
+        the response and image caches, the answer store, the trace recorder, the limit shared with the other
+        workers and the metrics server.
+        """
+        await self.watchdog.stop()
+        await self.openwebui.close()
+        await self.response_cache.close()
+        await self.image_cache.close()
+        await self.answers.close()
+        await self.traces.close()
+        await self.shared_limiter.close()
+        await registry.close()
+        await super().close()
+
+    def dispatch(self, event_name: str, /, *args, **kwargs):
+        """Counts the events of the gateway before dispatching every event."""
+        if event_name == "socket_event_type":
+            gateway_events.inc(args[0])
+        super().dispatch(event_name, *args, **kwargs)
+
+    def collect_metrics(self) -> list[Metric]:
+        """
+        Reads the counters the resources of the bot already keep, when the metrics are scraped.
+
+        Returns:
+            list[Metric]: The metrics, as (name, type, help, samples) tuples.
+        """
+        responses = self.response_cache.stats()
+        images = self.image_cache.stats()
+        resilience = self.openwebui.resilience
+        backends = self.openwebui.pool.stats()
+        return [
+            (
+                "cache_requests_total",
+                "counter",
+                "Cache lookups, by cache and result",
+                [
+                    ({"cache": "response", "result": "hit"}, responses["hits"]),
+                    ({"cache": "response", "result": "miss"}, responses["misses"]),
+                    ({"cache": "image", "result": "hit"}, images["hits"]),
+                    ({"cache": "image", "result": "miss"}, images["misses"]),
+                ],
+            ),
+            (
+                "cache_bytes",
+                "gauge",
+                "Size of the cached entries",
+                [
+                    ({"cache": "response"}, responses["bytes"]),
+                    ({"cache": "image"}, images["bytes"]),
+                    ({"cache": "views"}, self.views.size),
+                ],
+            ),
+            (
+                "coalesced_requests_total",
+                "counter",
+                "Chat requests sent and joined by identical requests in flight",
+                [
+                    ({"role": "leader"}, self.single_flight.leaders),
+                    ({"role": "follower"}, self.single_flight.followers),
+                ],
+            ),
+            (
+                "scheduler_requests",
+                "gauge",
+                "Requests holding or waiting for a backend slot",
+                [
+                    ({"state": "active"}, self.scheduler.active),
+                    ({"state": "queued"}, self.scheduler.queued),
+                ],
+            ),
+            (
+                "scheduler_rejected_total",
+                "counter",
+                "Requests rejected because the queue was full",
+                [({}, self.scheduler.rejected)],
+            ),
+            (
+                "message_edits_total",
+                "counter",
+                "Message edits, by outcome",
+                [
+                    ({"outcome": "sent"}, edit_stats.sent),
+                    ({"outcome": "coalesced"}, edit_stats.dropped),
+                    ({"outcome": "failed"}, edit_stats.failed),
+                    ({"outcome": "rate_limited"}, edit_stats.rate_limited),
+                ],
+            ),
+            (
+                "live_views",
+                "gauge",
+                "Pagination views whose buttons work",
+                [({}, len(self.views))],
+            ),
+            (
+                "view_evictions_total",
+                "counter",
+                "Pagination views evicted",
+                [({}, self.views.evictions)],
+            ),
+            (
+                "backend_requests_total",
+                "counter",
+                "Requests sent to every backend, by outcome",
+                [
+                    (
+                        {"backend": backend["url"], "outcome": "success"},
+                        backend["requests"] - backend["errors"],
+                    )
+                    for backend in backends
+                ]
+                + [
+                    ({"backend": backend["url"], "outcome": "error"}, backend["errors"])
+                    for backend in backends
+                ],
+            ),
+            (
+                "backend_outstanding",
+                "gauge",
+                "Requests in flight to every backend",
+                [
+                    ({"backend": backend["url"]}, backend["outstanding"])
+                    for backend in backends
+                ],
+            ),
+            (
+                "backend_available",
+                "gauge",
+                "Whether every backend is healthy and its circuit breaker is closed",
+                [
+                    (
+                        {"backend": backend["url"]},
+                        int(backend["healthy"] and backend["state"] == "closed"),
+                    )
+                    for backend in backends
+                ],
+            ),
+            (
+                "resilience_total",
+                "counter",
+                "Requests run by the resilience layer, and the retries and hedges they sent",
+                [
+                    ({"kind": "request"}, resilience.requests),
+                    ({"kind": "retry"}, resilience.retries_sent),
+                    ({"kind": "hedge"}, resilience.hedges_sent),
+                    ({"kind": "hedge_won"}, resilience.hedges_won),
+                ],
+            ),
+            (
+                "gateway_latency_seconds",
+                "gauge",
+                "Latency of the heartbeat of every shard run by this process",
+                [
+                    ({"shard": shard_id}, latency)
+                    for shard_id, latency in getattr(
+                        self, "latencies", [(self.shard_id or 0, self.latency)]
+                    )
+                ],
+            ),
+            (
+                "cluster_backend_waits_total",
+                "counter",
+                "Requests that waited for the backend limit shared by the workers of the cluster",
+                [({}, self.shared_limiter.waits)],
+            ),
+        ]
+
+    async def restore_view(
+        self, interaction: discord.Interaction
+    ) -> Optional[Pagination]:
+        """
+        Restores the live view of a message from the answer store.
+
+        Args:
+            interaction (discord.Interaction): The click on a button of the message.
 
-# Initialize logger
-# TODO: define more logging types
-logger = logging.getLogger("discord.gateway")
-logging.getLogger("discord").setLevel(logging.WARNING)
-logging.getLogger("aiohttp.client").setLevel(logging.ERROR)
+        Returns:
+            Optional[Pagination]: The restored view, or None if the answer is not stored.
+        """
+        message_id = interaction.message.id
+        task = self._restoring.get(message_id)
+        if task is None:
+            # Clicks that arrive while the answer is read share the same view
+            task = self._restoring[message_id] = asyncio.create_task(
+                self._restore_view(interaction)
+            )
+            task.add_done_callback(lambda _: self._restoring.pop(message_id, None))
+        return await asyncio.shield(task)
+
+    async def _restore_view(
+        self, interaction: discord.Interaction
+    ) -> Optional[Pagination]:
+        try:
+            stored = await self.answers.load(interaction.message.id)
+        except sqlite3.Error as error:
+            logger.error("Could not read the answer store: %s", error)
+            return None
+        if stored is None:
+            return None
+        pages = stored.pages
+
+        async def get_page(page: int):
+            return pages.embed(page), len(pages)
+
+        view = Pagination(
+            interaction,
+            get_page,
+            generate_chat_response,
+            logger,
+            users=stored.users,
+            registry=self.views,
+        )
+        view.index = current_page(interaction.message)
+        view.total_pages = len(pages)
+        view.timeout = None
+        view.stored = True
+        view.message = interaction.channel.get_partial_message(interaction.message.id)
+        self.views.register(view, pages.size)
+        self.add_view(view, message_id=interaction.message.id)
+        return view
 
 
 # Initialize Discord bot
 intents = discord.Intents.default()
 intents.message_content = True
 intents.messages = True
-bot = commands.Bot(command_prefix="!", intents=intents)
-
-# Message history cache
-channel_history = {}
+# The shards of this process, passed only to a sharded bot
+shard_options = {"shard_count": SHARD_COUNT, "shard_ids": SHARD_IDS} if SHARDING else {}
+# The trace passes Discord's rate limit headers to the edit coalescers
+bot = AIBot(
+    command_prefix="!",
+    intents=intents,
+    http_trace=rate_limit_trace(),
+    **shard_options,
+)
 
 
 @bot.command(name="update")
@@ -58,6 +424,105 @@ async def sync(ctx: commands.Context):
     await ctx.send("Application commands synchronized!")
 
 
+@bot.command(name="cache")
+@commands.is_owner()
+async def cache_stats(ctx: commands.Context):
+    """Shows the hit/miss counters of the caches, of the request and edit coalescing and the live views."""
+    stats = bot.response_cache.stats()
+    images = bot.image_cache.stats()
+    await ctx.send(
+        f"Response cache: {stats['hits']} hits, {stats['misses']} misses "
+        f"({stats['hit_ratio']:.0%}), {stats['entries']} entries, "
+        f"{stats['bytes']} bytes, {stats['evictions']} evictions\n"
+        f"Coalesced requests: {bot.single_flight.leaders} sent, "
+        f"{bot.single_flight.followers} joined, {bot.single_flight.in_flight()} in flight\n"
+        f"Image cache: {images['hits']} hits, {images['misses']} misses, "
+        f"{images['entries']} images, {images['bytes']} bytes\n"
+        f"Message edits: {edit_stats.sent} sent, {edit_stats.dropped} coalesced, "
+        f"{edit_stats.failed} failed, {edit_stats.rate_limited} rate limited\n"
+        f"Pagination views: {len(bot.views)} live, {bot.views.size} bytes of pages, "
+        f"{bot.views.evictions} evicted"
+    )
+
+
+@bot.command(name="backends")
+@commands.is_owner()
+async def backend_stats(ctx: commands.Context):
+    """Shows the state of every OpenWebUI backend of the pool."""
+    lines = [
+        f"{backend['url']}: {backend['state']}, "
+        f"{'healthy' if backend['healthy'] else 'unhealthy'}, "
+        f"{backend['outstanding']} in flight, {backend['requests']} requests, "
+        f"{backend['errors']} errors"
+        for backend in bot.openwebui.pool.stats()
+    ]
+    resilience = bot.openwebui.resilience
+    lines.append(
+        f"Resilience: {resilience.requests} requests, {resilience.retries_sent} retries, "
+        f"{resilience.hedges_sent} hedges ({resilience.hedges_won} answered first)"
+    )
+    await ctx.send("\n".join(lines))
+
+
+def report_files(reports: list[tuple[str, bytes]]) -> list[discord.File]:
+    """Wraps the reports of the profiler into attachments."""
+    return [
+        discord.File(io.BytesIO(content), filename=name) for name, content in reports
+    ]
+
+
+@bot.command(name="profile")
+@commands.is_owner()
+async def profile_cmd(ctx: commands.Context, seconds: float = 10, mode: str = "sample"):
+    """
+    Profiles the CPU of the bot for a while and sends the report.
+
+    Args:
+        seconds (float): How long to profile.
+        mode (str): "sample" for the sampling profiler, "cpu" for cProfile.
+    """
+    if mode not in ("sample", "cpu"):
+        await ctx.send("Usage: `!profile [seconds] [sample|cpu]`")
+        return
+    await ctx.send(f"Profiling ({mode}) for {seconds:g} seconds...")
+    try:
+        if mode == "cpu":
+            reports = await bot.profiler.cprofile(seconds)
+        else:
+            reports = await bot.profiler.sample(seconds)
+    except ProfilerBusyError as error:
+        await ctx.send(str(error))
+        return
+    await ctx.send("Profile done", files=report_files(reports))
+
+
+@bot.command(name="memory")
+@commands.is_owner()
+async def memory_cmd(ctx: commands.Context, action: str = "diff"):
+    """
+    Traces the allocations of the bot and sends what grew since the tracing started.
+
+    Args:
+        action (str): "start" to start the tracing, "diff" to send a report, "stop" to stop the tracing.
+    """
+    try:
+        if action == "start":
+            bot.profiler.memory_start()
+            await ctx.send(
+                "Memory tracing started, `!memory diff` sends what grew since now"
+            )
+        elif action == "diff":
+            reports = await bot.profiler.memory_diff()
+            await ctx.send("Memory diff", files=report_files(reports))
+        elif action == "stop":
+            bot.profiler.memory_stop()
+            await ctx.send("Memory tracing stopped")
+        else:
+            await ctx.send("Usage: `!memory [start|diff|stop]`")
+    except ProfilerStateError as error:
+        await ctx.send(str(error))
+
+
 def is_empty_or_null(string) -> bool:
     """
     Checks if the provided string is either None or an empty string.
@@ -73,269 +538,508 @@ def is_empty_or_null(string) -> bool:
     return False
 
 
-@bot.tree.command(name="test_message", description="worst case scenario test message")
-async def show(interaction: discord.Interaction):
-    """
-    Responds to a user interaction with the worst case scenario type of message
-    """
-    await interaction.response.defer()
-    think_list = split_string_into_chunks(
-        "<think>\r\nOkay, the user is asking why I can't explain Warframe's mechanics and data well. Let me start by understanding their situation. They might be a player encountering issues, maybe a new or returning player struggling with game mechanics. Their frustration could stem from not finding clear explanations, affecting their gameplay experience.\r\n\r\nFirst, I need to acknowledge their frustration. It's important to validate their feelings. Then, explain the limitations: Warframe's complexity and my AI constraints. The game has vast content with constant updates, making it hard to keep up. Also, Warframe's unique mechanics, like the Void, Warframes, and weapons, are interconnected in ways that require deep gameplay understanding, which I don't have firsthand.\r\n\r\nI should break down the reasons clearly. Mention the game's scale, the dynamic nature of updates, and the lack of official data. Highlight that my knowledge is based on community sources, which can be outdated. Emphasize that I can't access real-time data or the game's backend.\r\n\r\nNext, offer solutions. Suggest specific resources like the official wiki, forums, and guides. Provide examples of how to navigate those resources. Also, ask them to specify what they're struggling with so I can give targeted advice. Maybe they need help with a particular mechanic, like Void traversal or weapon builds. Tailoring the response to their specific question would be more helpful.\r\n\r\nCheck if there's an unspoken need. They might be looking for a way to improve their gameplay or troubleshoot a bug. They could be new and overwhelmed, or a veteran needing help with a new update. Understanding their exact issue would help provide a better answer. Encourage them to share details so I can assist more effectively.\r\n\r\nFinally, reassure them that while I can't replace in-game guides, I can help point them to the right resources. Offer to summarize key points or help them interpret existing guides. Make sure the tone is supportive and encouraging, showing willingness to help them succeed in Warframe.</think>",
-        1024,
-    )
-    awnser_list = split_string_into_chunks(
-        '\r\n\r\nEntiendo tu frustraci\u00f3n. Warframe es un juego extremadamente complejo y din\u00e1mico, y explicar sus mec\u00e1nicas y datos con precisi\u00f3n requiere una profundidad de conocimiento que yo, como modelo de lenguaje, no poseo de forma directa. Aqu\u00ed explico las razones y c\u00f3mo puedo ayudarte mejor:\r\n\r\n**\u00bfPor qu\u00e9 no puedo explicar bien mec\u00e1nicas/datos de Warframe?**\r\n\r\n1.  **La Escala y la Complejidad:** Warframe tiene una base de conocimiento *inmensa*. Incluye:\r\n    *   **M\u00faltiples sistemas interconectados:** Void (traves\u00eda, recursos, misiones), Warframes (cada uno con habilidades \u00fanicas), Armas (categor\u00edas, modos, bal\u00edstica), Modificadores (modos de combate, habilidades), Misiones (deportes, misiones secundarias, misiones del Void), Cultivos, Fabricaci\u00f3n, etc.\r\n    *   **Constante actualizaci\u00f3n:** El juego evoluciona constantemente con nuevos Warframes, Armas, Misiones, Modificadores y ajustes mec\u00e1nicos. Lo que escribo hoy podr\u00eda ya estar obsoleto ma\u00f1ana.\r\n    *   **Interdependencia:** Mec\u00e1nicas no funcionan de forma aislada. Por ejemplo, la eficacia de un Warframe depende de su habilidad, el modo de combate activo, el tipo de arma, y hasta el estado del Void en el que se combate.\r\n\r\n2.  **Limitaciones de mi conocimiento:** No tengo acceso directo al c\u00f3digo fuente del juego, a bases de datos en tiempo real, ni a las actualizaciones de desarrolladores. Mi conocimiento se basa en:\r\n    *   **Informaci\u00f3n publicada oficialmente:** Sitio web de Warframe, Warframe Wiki (actualizado por la comunidad), Discord y Discord Bot, Twitter de Warframe, etc.\r\n    *   **Contenido de la comunidad:** Foros (Reddit, Warframe Forums), videos (YouTube, Twitch), gu\u00edas y an\u00e1lisis de jugadores expertos.\r\n    *   **Mi propia experiencia:** Algunos usuarios me comparten sus propias experiencias, pero esto puede ser subjetivo y no siempre representativo.\r\n\r\n3.  **Riesgo de inexactitud:** Dado que mi conocimiento proviene de m\u00faltiples fuentes y se actualiza a trav\u00e9s de entrenamiento (sin actualizaciones en tiempo real), es posible que:\r\n    *   **Los datos sean obsoletos:** Un dato que escribo hoy podr\u00eda ya estar desactualizado tras una actualizaci\u00f3n.\r\n    *   **Los detalles est\u00e9n incompletos o incorrectos:** Especialmente para mec\u00e1nicas complejas o nuevas, donde la comunidad a\u00fan est\u00e1 analizando.\r\n    *   **Fallos en la comprensi\u00f3n:** Algunas mec\u00e1nicas son tan abstractas o interdependientemente complejas que pueden ser malinterpretadas o explicadas de manera inexacta.\r\n\r\n**\u00bfC\u00f3mo puedo ayudarte mejor con Warframe?**\r\n\r\nAunque no puedo "saber" mec\u00e1nicas y datos con la precisi\u00f3n de un jugador experimentado, puedo ofrecerte recursos y estrategias:\r\n\r\n1.  **Dirige a recursos oficiales y comunitarios:**\r\n    *   **Warframe Wiki (oficial):** [https://warframe.wikia.com/wiki/Warframe_Wiki](https://warframe.wikia.com/wiki/Warframe_Wiki) - Es el principal recurso oficial, actualizado por jugadores y moderadores. Contiene informaci\u00f3n detallada sobre Warframes, Armas, Misiones, Modificadores, etc.\r\n    *   **Warframe Forums:** [https://forums.warframe.com/](https://forums.warframe.com/) - \u00datil para discusiones t\u00e9cnicas, bugs reportados por jugadores, y discusiones comunitarias.\r\n    *   **Discord de Warframe:** [https://discord.gg/3pJ9p6Q](https://discord.gg/3pJ9p6Q) - Comunidad activa con jugadores que responden preguntas.\r\n    *   **YouTube/Twitch:** Canales dedicados (como `WarframeGuides`, `WarframeDPS`, `WarframeExplained`) ofrecen gu\u00edas visuales detalladas para mec\u00e1nicas espec\u00edficas.\r\n\r\n2.  **Preguntas espec\u00edficas:** Cu\u00e9ntame *exactamente* qu\u00e9 mec\u00e1nica, dato o situaci\u00f3n te est\u00e1 causando dificultad. Por ejemplo:\r\n    *   "\u00bfC\u00f3mo funciona exactamente la habilidad de *Warframe X*?"\r\n    *   "\u00bfQu\u00e9 significa que un *Modificador* es \'de tipo *Y*\' y c\u00f3mo afecta a los Warframes?"\r\n    *   "\u00bfPor qu\u00e9 mi *Arma Z* se destruye tan r\u00e1pido en el Void?"\r\n    *   "\u00bfQu\u00e9 Warframe es el mejor para *Misi\u00f3n del Void A*?"\r\n    *   "\u00bfQu\u00e9 significa el c\u00f3digo de error *XYZ*?"\r\n    *   "\u00bfC\u00f3mo calculo el da\u00f1o de un *Modificador* en combate?"\r\n    *   "\u00bfPor qu\u00e9 mi *Void Run* no se est\u00e1 completando? (Detalla el problema)"\r\n\r\n3.  **An\u00e1lisis basado en lo que sabes:** Si me proporcionas detalles espec\u00edficos (ej. el nombre del Warframe, el Modificador, el tipo de arma, el Void, el modo de combate, etc.), puedo:\r\n    *   **Explicar el concepto general:** Dando una descripci\u00f3n te\u00f3rica de *c\u00f3mo deber\u00eda* funcionar seg\u00fan lo que entiendo de la mec\u00e1nica.\r\n    *   **Sugerir posibles causas:** Bas\u00e1ndome en mi conocimiento de mec\u00e1nicas similares o comunidades, proponer razones *probables* por las que algo podr\u00eda estar sucediendo (ej: "Podr\u00eda ser que el *Modificador* *X* est\u00e9 activo y est\u00e9 restringiendo la habilidad", "Es posible que el *Void* est\u00e9 muy alto y est\u00e9 afectando la eficiencia de los recursos").\r\n    *   **Dirigirte a recursos:** Recomiendo espec\u00edficamente art\u00edculos de la Wiki o gu\u00edas comunitarias que aborden el tema.\r\n    *   **Aconsejar m\u00e9todos de diagn\u00f3stico:** Ej: "Prueba desactivar todos los modificadores de habilidad y ver si el problema persiste".\r\n\r\n**Ejemplo de c\u00f3mo puedo ayudarte:**\r\n\r\n*   **Tu pregunta:** "\u00bfPor qu\u00e9 mi Warframe *Tesla* se destruye tan r\u00e1pido en el Void?"\r\n*   **Mi respuesta:**\r\n    *   **Explicaci\u00f3n general:** "El Warframe Tesla es un Warframe de tipo *Void* (mejor para combates en el Void). Sin embargo, su habilidad principal (*Tesla*) es un *Modificador de da\u00f1o* que aumenta el da\u00f1o de todos los ataques. Esto puede ser peligroso si est\u00e1s usando Armas que ya generan mucho da\u00f1o, o si est\u00e1s en un Void muy alto donde los da\u00f1os se multiplican."\r\n    *   **Sugerir causas:** "Podr\u00edas estar usando un *Modificador de Da\u00f1o* (como *Overload* o *Void Overload*) que est\u00e9 combinado con la habilidad Tesla, lo que podr\u00eda multiplicar el da\u00f1o excesivamente. Tambi\u00e9n es posible que est\u00e9s usando un *Modificador de Estilo* (como *Soul* o *Void Soul*) que est\u00e9 aumentando tu da\u00f1o de base, lo que tambi\u00e9n se ver\u00eda amplificado por Tesla."\r\n    *   **Dirigir a recursos:** "Revisa la p\u00e1gina de Tesla en la [Wiki](https://warframe.wikia.com/wiki/Tesla) para ver c\u00f3mo interact\u00faan sus habilidades con los Modificadores. En la [Wiki](https://warframe.wikia.com/wiki/Modifiers), busca c\u00f3mo los Modificadores de Da\u00f1o y de Estilo afectan a los Warframes."\r\n    *   **Sugerencia de diagn\u00f3stico:** "Prueba desactivar cualquier *Modificador de Da\u00f1o* o *Modificador de Estilo* que est\u00e9s usando. Si el problema persiste, prueba un Warframe sin habilidades de da\u00f1o o con habilidades neutrales para ver si el problema desaparece."\r\n\r\n**Conclusi\u00f3n:** No puedo "saber" Warframe como un jugador, pero puedo ser un puente hacia la informaci\u00f3n disponible. Tu colaboraci\u00f3n es clave: cuanto m\u00e1s espec\u00edfico sea tu pregunta, m\u00e1s \u00fatil puedo ser, incluso si solo puedo apuntar a recursos o proponer hip\u00f3tesis basadas en mi conocimiento limitado. La comunidad y los recursos oficiales siguen siendo los m\u00e1s confiables.',
-        4096,
-    )
-    await show_generated_awnser(
-        interaction,
-        "a title",
-        awnser_list,
-        think_list,
-        "the source list",
-        "the question",
-    )
-
-
-def find_highest(numbers: int) -> int:
+def load_corpus_sample(name: str, path: str = CORPUS_PATH) -> dict:
     """
-    Finds the highest number in a given list of integers.
+    Reads a message of the benchmark corpus.
 
-    Parameters:
-    numbers (List[int]): A list of integers.
+    Args:
+        name (str): The name of the message.
+        path (str): The path of the corpus.
 
     Returns:
-    int: The highest number in the list.
-    """
-    if not numbers:
-        return 1
-    return max(numbers)
+        dict: The title, prompt, sources, thought and answer of the message.
 
-
-def part_string(current_part: int, amount_of_parts: int) -> str:
+    Raises:
+        KeyError: If the corpus has no message with that name.
     """
-    Generate a string indicating the current part number and total number of parts.
+    with open(path, encoding="utf-8") as file:
+        samples = json.load(file)["samples"]
+    for sample in samples:
+        if sample["name"] == name:
+            return sample
+    raise KeyError(name)
 
-    Args:
-        current_part (int): The current part number (1-based index).
-        amount_of_parts (int): The total number of parts.
 
-    Returns:
-        str: A string indicating the current part number and total number of parts, or an empty string if there is only one part.
+@bot.tree.command(name="test_message", description="worst case scenario test message")
+async def show(interaction: discord.Interaction):
     """
-    if amount_of_parts == 1:
-        return ""
-    return f" (Part {current_part} of {amount_of_parts})"
+    Responds to a user interaction with the worst case scenario type of message
+    """
+    await interaction.response.defer()
+    sample = await asyncio.to_thread(load_corpus_sample, "worst_case")
+    await show_generated_awnser(
+        interaction,
+        sample["title"],
+        sample["awnser"],
+        sample["thought"],
+        sample["sources"],
+        sample["prompt"],
+    )
 
 
 async def show_generated_awnser(
     interaction: discord.Interaction,
     title: str,
-    awnser_list: list[str],
-    think_list: list[str],
+    awnser: str,
+    thought: str,
     formatted_sources: str,
     prompt: str,
+    reply_to: Optional[discord.Message] = None,
+    users: Optional[set[int]] = None,
+    edits: Optional[EditCoalescer] = None,
 ):
     """
-    Generates and shows a paginated response to an interaction with a list of answers and their corresponding thoughts.
+    Generates and shows a paginated response to an interaction with an answer and its thought process.
 
     Args:
-        interaction (discord.Interaction): The interaction to respond to.
+        interaction (discord.Interaction): The interaction to respond to, None when replying to a message.
         title (str): The title of the response embed.
-        awnser_list (list[str]): The list of generated answers.
-        think_list (list[str]): The list of thoughts or explanations for each answer.
+        awnser (str): The generated answer.
+        thought (str): The thought process of the model.
         formatted_sources (str): The formatted sources or references for the answers.
         prompt (str): The original prompt or question that generated the answers.
+        reply_to (Optional[discord.Message]): The message to reply to instead of responding to the interaction.
+        users (Optional[set[int]]): The IDs of the users allowed to use the buttons, defaults to the author.
+        edits (Optional[EditCoalescer]): The coalescer of the edits of the interaction's response.
 
     Returns:
         None
     """
 
+    # The pages are laid out once and kept compressed, turning a page only inflates its embed
+    with timed_stage("layout"):
+        pages = CompressedPages(
+            layout_pages(title, awnser, thought, formatted_sources, prompt)
+        )
+
     async def get_page(page: int):
         """
-        Generates a page of the response embed for the given page number.
+        Returns the embed of the given page number.
 
         Args:
-            page (int): The page number to generate.
+            page (int): The page number to show.
 
         Returns:
-            tuple: A tuple containing the generated embed (discord.Embed) and the total number of pages (int).
+            tuple: A tuple containing the embed of the page (discord.Embed) and the total number of pages (int).
         """
-        emb = discord.Embed(title=title, description="")
-        amount_of_pages: int = find_highest([len(awnser_list), len(think_list)])
-        offset: int = page - 1
-        if offset <= len(awnser_list):
-            for awnser in awnser_list[offset : offset + 1]:
-                emb.description += f"{awnser}\n"
-        if len(think_list) > 0 and offset <= len(think_list):
-            for thought in think_list[offset : offset + 1]:
-                current_part_string: str = part_string(offset + 1, amount_of_pages)
-                emb.add_field(
-                    name=f"Thought process {current_part_string}",
-                    value=f"{thought}\n",
-                    inline=False,
-                )
-        n = Pagination.compute_total_pages(amount_of_pages, 1)
+        return pages.embed(page), len(pages)
+
+    view = Pagination(
+        interaction,
+        get_page,
+        generate_chat_response,
+        logger,
+        reply_to,
+        users,
+        edits,
+        bot.views,
+    )
+    bot.views.register(view, pages.size)
+    try:
+        await view.navegate()
+    except BaseException:
+        bot.views.remove(view)
+        raise
 
-        emb.add_field(name="Question", value=prompt, inline=False)
+    if bot.answers.enabled and view.message is not None:
+        try:
+            await bot.answers.save(view.message.id, pages, view.users)
+            view.stored = True
+        except sqlite3.Error as error:
+            logger.warning("Could not store the answer: %s", error)
 
-        emb.add_field(name="Sources", value=f"{formatted_sources}", inline=False)
 
-        if n > 1:
-            emb.set_footer(text=f"Page {page} from {n}")
+def build_chat_body(
+    prompt: str,
+    stream: bool = False,
+    messages: Optional[list[dict]] = None,
+    chat_id: str = DEFAULT_CHAT_ID,
+) -> dict:
+    """
+    Builds the body of a chat request to the OpenWebUI API.
 
-        return emb, n
+    Args:
+        prompt (str): The user's prompt for the chat request.
+        stream (bool): Whether the completion should be streamed.
+        messages (Optional[list[dict]]): The messages of a conversation, defaults to the prompt alone.
+        chat_id (str): The ID of the chat in OpenWebUI.
 
-    await Pagination(interaction, get_page, generate_chat_response, logger).navegate()
+    Returns:
+        dict: The body of the chat request.
+    """
+    return {
+        "chat_id": chat_id,
+        "stream": stream,
+        "model": MODEL_NAME,
+        "messages": messages or [{"role": "user", "content": prompt}],
+        "features": {
+            "image_generation": False,
+            "code_interpreter": False,
+            "voice": False,
+            "web_search": True,
+        },
+        "background_tasks": {"title_generation": True},
+    }
 
 
-def split_string_into_chunks(input_string: str, max_chunk_size: int) -> list[str]:
+async def chat_request(
+    prompt: str,
+    messages: Optional[list[dict]] = None,
+    chat_id: str = DEFAULT_CHAT_ID,
+) -> list[str]:
     """
-    Splits a string into chunks of specified size.
+    Sends a chat request to the OpenWebUI API with the given prompt.
 
     Args:
-        input_string (str): The string to be split.
-        max_chunk_size (int): The maximum size of each chunk.
+        prompt (str): The user's prompt for the chat request.
+        messages (Optional[list[dict]]): The messages of a conversation session, ending with the prompt.
+        chat_id (str): The ID of the chat in OpenWebUI.
 
     Returns:
-        list[str]: A list of chunks of the input string.
+        response (Response): The response from the OpenWebUI API.
     """
-    chunks = []
-    for i in range(0, len(input_string), max_chunk_size):
-        chunks.append(input_string[i : i + max_chunk_size])
-    return chunks
+    body = build_chat_body(prompt, messages=messages, chat_id=chat_id)
+    # A hedge is sent without the chat and its background tasks, only the first request writes into the chat
+    hedge_body = {
+        key: value
+        for key, value in body.items()
+        if key not in ("chat_id", "background_tasks")
+    }
+
+    async def send(timeouts: Timeouts) -> Optional[dict]:
+        async with bot.openwebui.post(
+            "/api/chat/completions",
+            "chat",
+            model=body["model"],
+            timeouts=timeouts,
+            json=hedge_body if timeouts.hedge else body,
+        ) as response:
+            logger.info("Status: %s", response.status)
+            if response.status in RETRY_STATUSES:
+                raise RetryableStatusError(response.status)
+            if not response.status == 200:
+                logger.info("Failed to get response, Error message: %s", response)
+                if bot.traces.enabled:
+                    bot.traces.record(
+                        "chat",
+                        body,
+                        response.status,
+                        await response.text(),
+                        timeouts.started_at,
+                        timeouts.first_byte_at,
+                    )
+                return None
+            with timed_stage("json_parse", body["model"]):
+                response_data = await response.json()
+            logger.info("Resonse body: %s", response)
+            bot.traces.record(
+                "chat",
+                body,
+                response.status,
+                response_data,
+                timeouts.started_at,
+                timeouts.first_byte_at,
+            )
+            return response_data
+
+    try:
+        # The answer is only shown once complete, so a slow request can be hedged
+        return await bot.openwebui.resilience.run(
+            f"{body['model']}:chat",
+            ENDPOINT_TIMEOUTS["chat"],
+            send,
+            hedge=True,
+            floor=RESILIENCE_MIN_CHAT_TIMEOUT,
+        )
+    except RetryableStatusError as error:
+        logger.info("Failed to get response after retries, %s", error)
+        return None
 
 
-def extract_thought_and_awnser(input_string):
+async def chat_request_streamed(
+    prompt: str, parser: ThinkParser, preview: StreamingPreview
+) -> dict:
     """
-    Extracts all occurrences of text within <think>...</think> tags and the remaining text from the input string.
+    Sends a streamed chat request to the OpenWebUI API and shows the partial answer while it arrives.
 
     Args:
-        input_string (str): The input string containing text with <think>...</think> tags.
+        prompt (str): The user's prompt for the chat request.
+        parser (ThinkParser): The parser that is fed every new token.
+        preview (StreamingPreview): The preview that is updated with every new token.
 
     Returns:
-        list of tuples: A list where each tuple contains two elements:
-            - The extracted text within <think>...</think> tags.
-            - The remaining text from the input string with the <think>...</think> tags removed.
+        dict: A response with the same shape as the one of chat_request, or None if the request failed.
     """
-    pattern = r"<think>(.*?)</think>"
-    thoughts = re.findall(pattern, input_string, re.DOTALL)
+    content: list[str] = []
+    sources: list = []
+    first_token_at: Optional[float] = None
+
+    body = build_chat_body(prompt, stream=True)
+
+    async def send(timeouts: Timeouts) -> bool:
+        nonlocal sources, first_token_at
+        async with bot.openwebui.post(
+            "/api/chat/completions",
+            "chat",
+            model=body["model"],
+            timeouts=timeouts,
+            json=body,
+        ) as response:
+            logger.info("Status: %s", response.status)
+            if response.status in RETRY_STATUSES:
+                raise RetryableStatusError(response.status)
+            if not response.status == 200:
+                logger.info("Failed to get response, Error message: %s", response)
+                return False
+
+            try:
+                async for data in iter_sse_data(response.content):
+                    if data == "[DONE]":
+                        break
+                    try:
+                        event = json.loads(data)
+                    except json.JSONDecodeError:
+                        continue
+                    if not isinstance(event, dict):
+                        continue
+                    if event.get("sources"):
+                        sources = event["sources"]
+                    try:
+                        delta = event["choices"][0]["delta"].get("content")
+                    except (KeyError, IndexError, TypeError, AttributeError):
+                        continue
+                    if delta:
+                        if not content:
+                            first_token_at = time.monotonic()
+                        content.append(delta)
+                        parser.feed(delta)
+                        preview.update()
+            except aiohttp.ClientConnectionError as error:
+                if content:
+                    # Part of the answer is already shown, sending the request again would repeat it
+                    raise StreamInterruptedError(str(error)) from error
+                raise
+        if bot.traces.enabled:
+            bot.traces.record(
+                "chat",
+                body,
+                200,
+                assembled(),
+                timeouts.started_at,
+                first_token_at,
+                stream=True,
+            )
+        return True
 
-    if len(thoughts) == 0:
-        thoughts = [""]
+    def assembled() -> dict:
+        return {
+            "choices": [{"message": {"content": "".join(content)}}],
+            "sources": sources,
+        }
 
-    awnser = re.sub(pattern, "", input_string).strip()
-    result = [awnser, thoughts[0]]
+    try:
+        # The partial answer is shown while it arrives, so the request is retried but never hedged
+        if not await bot.openwebui.resilience.run(
+            f"{body['model']}:stream",
+            ENDPOINT_TIMEOUTS["chat"],
+            send,
+            floor=RESILIENCE_MIN_CHAT_TIMEOUT,
+        ):
+            return None
+    except RetryableStatusError as error:
+        logger.info("Failed to get response after retries, %s", error)
+        return None
 
-    return result
+    return assembled()
 
 
-async def chat_request(prompt: str) -> list[str]:
+def backend_slot(
+    guild_id: Optional[int],
+    user_id: int,
+    interaction: Optional[discord.Interaction] = None,
+    edits: Optional[EditCoalescer] = None,
+):
     """
-    Sends a chat request to the OpenWebUI API with the given prompt.
+    Waits for a slot of the backend scheduler, DMs are served before guild channels.
 
     Args:
-        prompt (str): The user's prompt for the chat request.
+        guild_id (Optional[int]): The ID of the guild of the request, None for DMs.
+        user_id (int): The ID of the user of the request.
+        interaction (Optional[discord.Interaction]): The deferred interaction in which the queue position is shown.
+        edits (Optional[EditCoalescer]): The coalescer of the edits of the interaction's response.
 
     Returns:
-        response (Response): The response from the OpenWebUI API.
+        AsyncContextManager: The context that holds the slot.
     """
-    response: aiohttp.ClientResponse = None
 
-    headers = {
-        "Authorization": f"Bearer {OPENWEBUI_API_KEY}",
-        "Content-Type": "application/json",
-    }
+    edits = edits or EditCoalescer()
 
-    body = {
-        "chat_id": "4a299940-11b4-49e7-9844-5c39e2a2955c",
-        "stream": False,
-        "model": MODEL_NAME,
-        "messages": [{"role": "user", "content": prompt}],
-        "features": {
-            "image_generation": False,
-            "code_interpreter": False,
-            "voice": False,
-            "web_search": True,
-        },
-        "background_tasks": {"title_generation": True},
-    }
+    async def show_queue_position(position: int):
+        embed = discord.Embed(
+            title="Waiting in queue",
+            description=f"Your request is number {position} in the queue.",
+        )
+        edits.submit(partial(interaction.edit_original_response, embed=embed))
+
+    return bot.scheduler.slot(
+        guild_id,
+        user_id,
+        PRIORITY_DM if guild_id is None else PRIORITY_GUILD,
+        show_queue_position if interaction is not None else None,
+    )
 
-    url: str = OPENWEBUI_API_BASE + "/api/chat/completions"
-    timeout = aiohttp.ClientTimeout(total=600)
 
-    async with aiohttp.ClientSession(timeout=timeout) as session:
-        async with session.post(url, json=body, headers=headers) as response:
-            logger.info(f"Status: {response.status}")
-            if not response.status == 200:
-                logger.info(f"Failed to get response, Error message: {response}")
-                return None
-            response_data = await response.json()
-            logger.info(f"Resonse body: {response}")
-            return response_data
+def busy_embed() -> discord.Embed:
+    """
+    Builds the embed shown when a request is rejected because the backend queue is full.
 
+    Returns:
+        discord.Embed: The embed of the rejected request.
+    """
+    return discord.Embed(
+        title="The bot is busy",
+        description="Too many requests are waiting, please try again later.",
+        color=0xFF0000,
+    )
 
-async def generate_chat_response(interaction: discord.Interaction, prompt):
+
+async def generate_chat_response(
+    interaction: discord.Interaction, prompt, use_cache: bool = True
+):
     """
     Generates a chat response based on the given prompt.
 
     Args:
         interaction (discord.Interaction): The interaction object.
         prompt (str): The prompt for the chat response.
+        use_cache (bool): Whether a cached answer can be used, the new answer is cached either way.
 
     Returns:
         discord.Embed: The embed object containing the chat response.
     """
+    command.set("question")
+
+    with timed_stage("defer"):
+        await interaction.response.defer()
+
+    parser = ThinkParser()
+    streamed = False
+    # Every edit of the response (queue position, preview, answer) goes through it, the latest wins
+    edits = EditCoalescer(min_interval=STREAM_EDIT_INTERVAL)
+    body = build_chat_body(prompt)
+    cache_key = make_key(prompt, body["model"], body["features"])
+
+    response: json = None
+    if use_cache:
+        response = await bot.response_cache.get(cache_key)
+        logger.info("Response cache %s: %s", "hit" if response else "miss", prompt)
+
+    async def request_response() -> dict:
+        # Only run by the first caller of an identical request, the others await its result
+        nonlocal streamed
+        async with backend_slot(
+            interaction.guild_id, interaction.user.id, interaction, edits
+        ):
+            if STREAM_RESPONSES:
+                streamed = True
+                response = await chat_request_streamed(
+                    prompt, parser, StreamingPreview(interaction, prompt, parser, edits)
+                )
+            else:
+                response = await chat_request(prompt)
+        if response:
+            await bot.response_cache.set(cache_key, response)
+        return response
 
-    await interaction.response.defer()
-
-    print(f"original response: {interaction.original_response}")
-
-    response: json = await chat_request(prompt)
+    if response is None:
+        try:
+            response = await bot.single_flight.do(cache_key, request_response)
+        except SchedulerFullError as error:
+            logger.warning("Rejected question: %s", error)
+            edits.submit(
+                partial(interaction.edit_original_response, embed=busy_embed())
+            )
+            await edits.flush()
+            return
+        except (
+            aiohttp.ClientError,
+            asyncio.TimeoutError,
+            StreamInterruptedError,
+        ) as error:
+            logger.warning("Failed to get response: %r", error)
+            response = None
     embed = discord.Embed(title="test", description="")
 
-    thought_list: list[str] = []
-    awnser_list: list[str] = []
-    formatted_sources: str = ""
-
     # embed.title("Request failed with status code ")
 
     if not response:
         embed.title = "Failed to get response"
         embed.color = 0xFF0000
-        await interaction.response.edit_original_response(embed=embed)
+        edits.submit(partial(interaction.edit_original_response, embed=embed))
+        await edits.flush()
+        return
+
+    # Serialized, truncated and sampled by the logging thread, only if the level is enabled
+    logger.info("Response: %s", Payload(response))
+
+    # Always set the embed fields safely
+    try:
+        with timed_stage("extract", body["model"]):
+            title, awnser, thought, formatted_sources = parse_chat_response(
+                response, parser, streamed
+            )
+    except (KeyError, IndexError, TypeError):
+        embed.title = "Error in parsing the response"
+        embed.description = "Check the logs"
+        embed.color = 0xFF0000
+        edits.submit(partial(interaction.edit_original_response, embed=embed))
+        await edits.flush()
+        return
+
+    await show_generated_awnser(
+        interaction,
+        title,
+        awnser,
+        thought,
+        formatted_sources,
+        prompt,
+        edits=edits,
+    )
+
+
+def parse_chat_response(
+    response: dict, parser: ThinkParser, streamed: bool = False
+) -> tuple[str, str, str, str]:
+    """
+    Splits a chat response into the parts shown by show_generated_awnser.
+
+    Args:
+        response (dict): The response of the OpenWebUI API.
+        parser (ThinkParser): The parser of the completion.
+        streamed (bool): Whether the parser was already fed the completion while it was streamed.
+
+    Returns:
+        tuple: The title, the answer, the thought process and the formatted sources.
+
+    Raises:
+        KeyError, IndexError, TypeError: If the response does not contain a completion.
+    """
+    formatted_sources: str = ""
 
-    # Print response in console (just in case)
-    logger.info(json.dumps(response, indent=4))
     # Default values
     title = "Answer"
-    embed.color = 0xFF0000
 
     # Check if "sources" exists and is valid
     if "sources" in response and response["sources"]:
         try:
             title = response["sources"][0]["source"]["name"][:256]
-            embed.color = 0x00AEEF
         except (KeyError, IndexError, TypeError):
             pass  # Keep defaults if nested fields are missing
 
-    # Always set the embed fields safely
-    try:
-        result: list[str] = extract_thought_and_awnser(
-            response["choices"][0]["message"]["content"]
-        )
-
-        if not is_empty_or_null(result[1]):
-            thought_list = split_string_into_chunks(result[1], 1024)
-
-        if not is_empty_or_null(result[0]):
-            awnser_list = split_string_into_chunks(result[0], 4096)
-
-    except (KeyError, IndexError, TypeError):
-        embed.title = "Error in parsing the response"
-        embed.description = "Check the logs"
-        embed.color = 0xFF0000
-        await interaction.response.send_message(embed=embed)
+    # The streamed completion was already parsed while it arrived
+    if not streamed:
+        parser.feed(response["choices"][0]["message"]["content"])
+    parser.close()
 
     try:
         # Parse the response and get the metadata (the sources of the generated awnser)
@@ -352,82 +1056,162 @@ async def generate_chat_response(interaction: discord.Interaction, prompt):
         # No need to get the error message of metadata since it is not always filled.
         pass
 
-    await show_generated_awnser(
-        interaction, title, awnser_list, thought_list, formatted_sources, prompt
-    )
+    return title, parser.awnser, parser.thought, formatted_sources
 
 
-async def download_image(download_endpoint):
+async def download_image(
+    download_endpoint, backend: Optional[Backend] = None
+) -> Optional[DownloadedImage]:
     """
-    Downloads an image from the specified endpoint and returns its base64 encoded string.
+    Downloads an image from the specified endpoint, streamed into a single buffer.
 
     Args:
         download_endpoint (str): The endpoint URL to download the image from.
+        backend (Optional[Backend]): The backend that generated the image.
 
     Returns:
-        str: The base64 encoded string of the downloaded image, or None if the request failed.
+        DownloadedImage: The downloaded image (recompressed to WebP if enabled), or None if the request failed.
+
+    Raises:
+        ImageTooLargeError: If the image is larger than IMAGE_MAX_BYTES.
     """
 
-    headers = {
-        "Authorization": f"Bearer {OPENWEBUI_API_KEY}",
-        "Content-Type": "image/png",
-    }
+    # A download has no side effect, it is sent again after a failure
+    try:
+        image = await bot.openwebui.resilience.run(
+            "download",
+            ENDPOINT_TIMEOUTS["download"],
+            lambda timeouts: stream_image(
+                bot.openwebui, download_endpoint, backend=backend, timeouts=timeouts
+            ),
+        )
+    except (
+        RetryableStatusError,
+        aiohttp.ClientError,
+        asyncio.TimeoutError,
+    ) as error:
+        logger.info("Failed to download image after retries, %r", error)
+        image = None
+    if image is None:
+        logger.error("Failed to download image: %s", download_endpoint)
+        return None
 
-    response = requests.get(
-        OPENWEBUI_API_BASE + download_endpoint, headers=headers, timeout=60
-    )
+    if IMAGE_RECOMPRESS_WEBP:
+        image = await recompress_webp(image)
+    return image
 
-    if response.status_code != 200:
-        logger.error(f"Failed to get response, Error message: {response}")
-        return None
 
-    image_data = BytesIO(response.content)
-    base64_image = base64.b64encode(image_data.read()).decode("utf-8")
-    return base64_image
+def image_cache_key(prompt: str) -> str:
+    """
+    Builds the image cache key of a prompt.
+
+    Args:
+        prompt (str): The prompt of the image.
+
+    Returns:
+        str: The key of the image in the image cache.
+    """
+    return image_key(prompt, IMAGE_MODEL, IMAGE_PARAMS)
 
 
 async def image_request(prompt):
-    """Function that sends the request to generate a image response"""
+    """
+    Function that sends the request to generate a image response
 
-    headers = {
-        "Authorization": f"Bearer {OPENWEBUI_API_KEY}",
-        "Content-Type": "application/json",
-    }
+    Returns:
+        tuple: The status code, either the parsed JSON body or the error text, and the backend that
+        generated the image (its files are only on that backend).
 
-    body = json.dumps(
-        {
-            "model": "dreamshaper_8",
-            "prompt": prompt,
-        }
-    )
+    Raises:
+        NoBackendError: If no available backend serves the image model.
+        aiohttp.ClientError: If the request failed.
+        asyncio.TimeoutError: If the request timed out.
+    """
 
-    response = requests.post(
-        OPENWEBUI_API_BASE + "/api/v1/images/generations",
-        data=body,
-        headers=headers,
-        timeout=600,
-    )
+    body = {
+        "model": IMAGE_MODEL,
+        "prompt": prompt,
+        **IMAGE_PARAMS,
+    }
 
-    return response
+    backend = bot.openwebui.pool.pick(IMAGE_MODEL)
+
+    async def send(timeouts: Timeouts) -> tuple:
+        async with bot.openwebui.post(
+            "/api/v1/images/generations",
+            "image",
+            backend=backend,
+            timeouts=timeouts,
+            json=body,
+        ) as response:
+            if response.status != 200:
+                data = await response.text()
+            else:
+                data = await response.json()
+            bot.traces.record(
+                "image",
+                body,
+                response.status,
+                data,
+                timeouts.started_at,
+                timeouts.first_byte_at,
+            )
+            return response.status, data, backend
+
+    # Generating an image again costs as much as the first time, so it gets adaptive timeouts only
+    return await bot.openwebui.resilience.run(
+        f"{IMAGE_MODEL}:image", ENDPOINT_TIMEOUTS["image"], send, retry=False
+    )
 
 
-async def generate_image_response(prompt):
+async def generate_image_response(
+    interaction: discord.Interaction, prompt, edits: Optional[EditCoalescer] = None
+):
     """Function that starts the process of generating a image response"""
 
-    response = await image_request(prompt)
+    cache_key = image_cache_key(prompt)
+    cached = await bot.image_cache.get(cache_key)
+    if cached is not None:
+        logger.info("Image cache hit: %s", prompt)
+        embed = discord.Embed(title="Generated image", description=prompt)
+        if cached.cdn_url:
+            # The same image was already posted, link it instead of uploading it again
+            embed.set_image(url=cached.cdn_url)
+            return embed, None
+        try:
+            cached_file = await asyncio.to_thread(open, cached.path, "rb")
+        except OSError as error:
+            # Evicted (or unreadable) since the lookup, the image is generated again
+            logger.warning("Cached image unavailable, generating it again: %s", error)
+            bot.image_cache.drop_missing(cache_key)
+        else:
+            embed.set_image(url=f"attachment://{cached.filename}")
+            return embed, discord.File(cached_file, filename=cached.filename)
 
-    embed = discord.Embed()
+    try:
+        async with backend_slot(
+            interaction.guild_id, interaction.user.id, interaction, edits
+        ):
+            status, response_dict, backend = await image_request(prompt)
+    except SchedulerFullError as error:
+        logger.warning("Rejected image: %s", error)
+        return busy_embed(), None
+    except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+        # NoBackendError is a ClientError, raised when no backend serves the image model
+        logger.warning("Failed to get image response: %r", error)
+        embed = discord.Embed(title="Failed to get response", color=0xFF0000)
+        return embed, None
 
-    if response.status_code != 200:
-        logger.error(f"Request failed with status code {response.status_code}")
-        logger.error(f"Error message:{response.text}")
-        embed.title = f"Request failed with status code {response.status_code}"
-        embed.description = "Error message:", response.text
-        return embed
+    embed = discord.Embed()
 
-    response_dict = response.json()
+    if status != 200:
+        logger.error("Request failed with status code %s", status)
+        logger.error("Error message: %s", Payload(response_dict))
+        embed.title = f"Request failed with status code {status}"
+        embed.description = f"Error message: {response_dict}"
+        return embed, None
 
-    logger.info(json.dumps(response_dict, indent=4))
+    logger.info("Image response: %s", Payload(response_dict))
 
     # Parse image URL correctly
     try:
@@ -438,9 +1222,16 @@ async def generate_image_response(prompt):
         embed.color = 0xFF0000
         return embed, None
 
-    base64_image = await download_image(download_endpoint)
+    try:
+        image = await download_image(download_endpoint, backend)
+    except ImageTooLargeError as error:
+        logger.error("Image too large: %s", error)
+        embed.title = "The generated image is too large"
+        embed.description = str(error)
+        embed.color = 0xFF0000
+        return embed, None
 
-    if base64_image is None:
+    if image is None:
         embed.title = "Error in downloading the image"
         embed.description = "Check the logs"
         embed.color = 0xFF0000
@@ -449,23 +1240,47 @@ async def generate_image_response(prompt):
     embed.title = "Generated image"
     embed.description = prompt
 
-    img_bytes = BytesIO(base64.b64decode(base64_image))
-    img_file = discord.File(img_bytes, filename="image.png")
-    embed.set_image(url="attachment://image.png")
+    try:
+        await bot.image_cache.put(cache_key, image)
+    except OSError as error:
+        # A full or read-only disk must not stop the image from being sent
+        logger.warning("Could not cache the image: %s", error)
+        image.file.seek(0)
+    img_file = image.to_file()
+    embed.set_image(url=f"attachment://{image.filename}")
 
     return embed, img_file
 
 
 # IMAGE COMMAND
-# @bot.tree.command(name="image", description="Generate an image from a prompt")
-# @app_commands.describe(prompt="What image do you want?")
-# async def image_cmd(interaction: discord.Interaction, prompt: str):
-#     """The command that is used to generate a image response based on a question"""
-#     await interaction.response.defer()
+@bot.tree.command(name="image", description="Generate an image from a prompt")
+@app_commands.describe(prompt="What image do you want?")
+async def image_cmd(interaction: discord.Interaction, prompt: str):
+    """The command that is used to generate a image response based on a question"""
+    command.set("image")
+
+    with timed_stage("defer"):
+        await interaction.response.defer()
 
-#     reply, img_file = await generate_image_response(prompt)
+    edits = EditCoalescer()
+    reply, img_file = await generate_image_response(interaction, prompt, edits)
 
-#     await interaction.followup.send(embed=reply, file=img_file)
+    # Send the queue position that may still be waiting before it can be replaced
+    try:
+        await edits.flush()
+    except discord.HTTPException:
+        pass
+    try:
+        message = await interaction.edit_original_response(
+            embed=reply, attachments=[img_file] if img_file else []
+        )
+    finally:
+        if img_file:
+            # discord.py does not close the buffers and files it was given
+            img_file.close()
+            img_file.fp.close()
+    if img_file and message.attachments:
+        bot.image_cache.set_cdn_url(image_cache_key(prompt), message.attachments[0].url)
 
 
 @bot.tree.command(name="question", description="Ask a question and get a text reply")
@@ -481,10 +1296,59 @@ async def question_cmd(interaction: discord.Interaction, prompt: str):
     Returns:
         None
     """
-    logger.info(f"Started Question command with the following prompt: {prompt}")
+    logger.info("Started Question command with the following prompt: %s", prompt)
     await generate_chat_response(interaction, prompt)
 
 
+@bot.tree.command(
+    name="session_info", description="Shows the conversation session of this channel"
+)
+async def session_info_cmd(interaction: discord.Interaction):
+    """
+    Shows the size of the conversation session of the channel.
+
+    Args:
+        interaction (discord.Interaction): The interaction object.
+
+    Returns:
+        None
+    """
+    session = bot.sessions.peek(interaction.channel_id)
+    if session is None:
+        await interaction.response.send_message(
+            content="There is no conversation in this channel.", ephemeral=True
+        )
+        return
+    await interaction.response.send_message(
+        content=(
+            f"Conversation `{session.chat_id}`: {session.turns} turns, "
+            f"{session.size} characters, {session.compactions} compactions, "
+            f"started <t:{int(session.created_at)}:R>"
+        ),
+        ephemeral=True,
+    )
+
+
+@bot.tree.command(
+    name="session_reset", description="Starts a new conversation in this channel"
+)
+async def session_reset_cmd(interaction: discord.Interaction):
+    """
+    Removes the conversation session of the channel, the next mention starts a new one.
+
+    Args:
+        interaction (discord.Interaction): The interaction object.
+
+    Returns:
+        None
+    """
+    if bot.sessions.reset(interaction.channel_id):
+        content = "The conversation was reset."
+    else:
+        content = "There is no conversation in this channel."
+    await interaction.response.send_message(content=content)
+
+
 @bot.tree.command(
     name="get_model_name", description="Returns the name of the currently loaded LLM"
 )
@@ -501,32 +1365,34 @@ async def model_cmd(interaction: discord.Interaction):
     await interaction.response.send_message(content=MODEL_NAME)
 
 
-async def get_chat_history(channel, limit=100):
+async def get_chat_history(channel, limit=100, exclude=()) -> ChatContext:
     """
-    Fetches the chat history from a specified channel.
+    Builds the chat history of a specified channel from the history cache, within the token budget.
 
     Args:
-        channel (discord.channel.Channel): The channel to fetch messages from.
-        limit (int, optional): The number of messages to fetch. Defaults to 100.
+        channel (discord.channel.Channel): The channel to get messages from.
+        limit (int, optional): The number of messages to consider. Defaults to 100.
+        exclude (Iterable[int], optional): The IDs of messages to leave out.
 
     Returns:
-        str: A string containing the chat history, with each message on a new line.
+        ChatContext: The chat history, with each message on a new line, and the number of tokens it used.
     """
 
-    messages = []
-    async for message in channel.history(limit=limit):
-        content = f"{message.author.name}: {message.content}"
-
-        # Handle attachments (images)
-        for attachment in message.attachments:
-            if any(
-                attachment.filename.lower().endswith(ext)
-                for ext in [".png", ".jpg", ".jpeg", ".gif", ".webp"]
-            ):
-                content += f" [Image: {attachment.url}]"
-
-        messages.append(content)
-    return "\n".join(reversed(messages))
+    messages = await bot.history.get(channel, limit)
+    if exclude:
+        messages = [
+            message for message in messages if message.message_id not in exclude
+        ]
+    context = build_context(messages)
+    logger.info(
+        "Chat history of %s: %s/%s tokens, %s messages, %s dropped",
+        channel.id,
+        context.tokens,
+        context.budget,
+        context.messages,
+        context.dropped,
+    )
+    return context
 
 
 @bot.event
@@ -541,6 +1407,9 @@ async def on_message(message: discord.Message):
         None
     """
 
+    # Keep the cached history of the channel current, including the bot's own replies
+    bot.history.add(message)
+
     # Ignore messages from the bot itself
     if message.author == bot.user:
         return
@@ -556,40 +1425,187 @@ async def on_message(message: discord.Message):
         should_respond = True
 
     if should_respond:
-        async with message.channel.typing():
-            # Get chat history
-            history = await get_chat_history(message.channel)
+        # Mentions arriving close together in a channel are answered by a single request
+        bot.mentions.add(message)
 
-            # Remove bot mention from the message
-            user_message = message.content.replace(f"<@{bot.user.id}>", "").strip()
+    await bot.process_commands(message)
 
-            # Collect image URLs from the message
-            image_urls = []
-            for attachment in message.attachments:
-                if any(
-                    attachment.filename.lower().endswith(ext)
-                    for ext in [".png", ".jpg", ".jpeg", ".gif", ".webp"]
-                ):
-                    image_urls.append(attachment.url)
 
-            # Get AI response
-            # response = await generate_chat_response(user_message)
+def remove_bot_mention(text: str) -> str:
+    """
+    Removes the mentions of the bot from a message.
 
-            # Send response
-            # await message.reply(embed=response)
+    Args:
+        text (str): The text of the message.
+
+    Returns:
+        str: The text without the mentions of the bot.
+    """
+    return text.replace(f"<@{bot.user.id}>", "").replace(f"<@!{bot.user.id}>", "")
+
+
+def build_mention_prompt(
+    context: Optional[ChatContext], messages: list[discord.Message]
+) -> str:
+    """
+    Builds the prompt that answers a batch of mentions.
+
+    Args:
+        context (Optional[ChatContext]): The chat history of the channel without the mentions,
+            None when the conversation session already holds the previous messages.
+        messages (list[discord.Message]): The messages that mention the bot, oldest first.
+
+    Returns:
+        str: The chat history followed by the messages to answer.
+    """
+    mentions = [
+        remove_bot_mention(HistoryMessage.from_message(message).render())
+        for message in messages
+    ]
+    if len(mentions) == 1:
+        request = f"Reply to this message:\n{mentions[0].strip()}"
+    else:
+        request = "Reply to all of these messages in a single answer:\n" + "\n".join(
+            mention.strip() for mention in mentions
+        )
+    if context is None or not context.text:
+        return request
+    return f"Chat history:\n{context.text}\n\n{request}"
 
-    await bot.process_commands(message)
+
+async def answer_mentions(messages: list[discord.Message]):
+    """
+    Answers a batch of messages that mention the bot (or were sent to it in a DM) with a single reply.
+
+    Args:
+        messages (list[discord.Message]): The messages of the batch, oldest first.
+
+    Returns:
+        None
+    """
+    command.set("mention")
+    last = messages[-1]
+    channel = last.channel
+    question = "\n".join(
+        remove_bot_mention(message.content).strip() for message in messages
+    )[:1024]
+
+    async def request_answer() -> tuple:
+        session = bot.sessions.get(channel.id)
+        # One turn at a time, so the session stays in the order it was sent in
+        async with session.lock:
+            context = None
+            if session.turns == 0:
+                # Only the first turn of a session carries the chat history, later turns
+                # extend the same conversation so its prefix stays stable
+                context = await get_chat_history(
+                    channel, exclude={message.id for message in messages}
+                )
+            prompt = build_mention_prompt(context, messages)
+            async with backend_slot(
+                last.guild.id if last.guild else None, last.author.id
+            ):
+                response = await chat_request(
+                    prompt, session.request_messages(prompt), session.chat_id
+                )
+            if not response:
+                return response, None
+            parser = ThinkParser()
+            try:
+                with timed_stage("extract", MODEL_NAME):
+                    parsed = parse_chat_response(response, parser)
+            except (KeyError, IndexError, TypeError):
+                return response, None
+            bot.sessions.append_turn(session, prompt, parser.awnser)
+            return response, parsed
+
+    # The request is started before the typing indicator, not after it
+    request = asyncio.create_task(request_answer())
+    try:
+        try:
+            async with channel.typing():
+                await asyncio.wait([request])
+        except discord.HTTPException as error:
+            # The typing indicator is cosmetic, the answer is still awaited without it
+            logger.warning("Failed to show the typing indicator: %s", error)
+        response, parsed = await request
+    except asyncio.CancelledError:
+        request.cancel()
+        raise
+    except SchedulerFullError as error:
+        logger.warning("Rejected mention: %s", error)
+        await last.reply(embed=busy_embed())
+        return
+    except (aiohttp.ClientError, asyncio.TimeoutError, discord.HTTPException) as error:
+        logger.error("Failed to answer mention: %s", error)
+        response, parsed = None, None
+
+    if not response:
+        await last.reply(
+            embed=discord.Embed(title="Failed to get response", color=0xFF0000)
+        )
+        return
+
+    if parsed is None:
+        await last.reply(
+            embed=discord.Embed(
+                title="Error in parsing the response",
+                description="Check the logs",
+                color=0xFF0000,
+            )
+        )
+        return
+
+    title, awnser, thought, formatted_sources = parsed
+    await show_generated_awnser(
+        None,
+        title,
+        awnser,
+        thought,
+        formatted_sources,
+        question or "(empty message)",
+        reply_to=last,
+        users={message.author.id for message in messages},
+    )
+
+
+@bot.event
+async def on_raw_message_edit(payload: discord.RawMessageUpdateEvent):
+    """
+    Updates the cached history when a message is edited.
+    The raw event is used so edits of messages missing from discord.py's message cache are seen too.
+    """
+    bot.history.edit(payload.channel_id, payload.message_id, payload.data)
+
+
+@bot.event
+async def on_raw_message_delete(payload: discord.RawMessageDeleteEvent):
+    """
+    Removes a deleted message from the cached history and the answer store.
+    """
+    bot.history.delete(payload.channel_id, [payload.message_id])
+    await bot.answers.delete([payload.message_id])
+
+
+@bot.event
+async def on_raw_bulk_message_delete(payload: discord.RawBulkMessageDeleteEvent):
+    """
+    Removes bulk deleted messages from the cached history and the answer store.
+    """
+    bot.history.delete(payload.channel_id, payload.message_ids)
+    await bot.answers.delete(payload.message_ids)
 
 
 @bot.event
 async def on_ready():
     """
     Event handler for when the bot is ready to receive events.
-    Syncs the bot's slash commands to the guild and prints the number of commands synced.
+    Syncs the bot's slash commands to the guild (unless SYNC_COMMANDS is off) and prints the number of commands synced.
     """
-    synced = await bot.tree.sync()
-    logger.info(f"Slash commands synced to guild. Commands: {len(synced)}")
-    logger.info(f"Logged in as {bot.user}")
+    if SYNC_COMMANDS:
+        synced = await bot.tree.sync()
+        logger.info("Slash commands synced to guild. Commands: %s", len(synced))
+    logger.info("Logged in as %s", bot.user)
 
 
 @bot.event
@@ -611,11 +1627,25 @@ async def on_resumed():
 
 def main():
     """Main function to run the AI bot."""
-    if not all([DISCORD_TOKEN, OPENWEBUI_API_KEY, OPENWEBUI_API_BASE, MODEL_NAME]):
-        logger.info("Error: Missing required environment variables")
+    if not all(
+        [
+            DISCORD_TOKEN,
+            OPENWEBUI_API_KEY,
+            OPENWEBUI_API_BASE or OPENWEBUI_BACKENDS,
+            MODEL_NAME,
+        ]
+    ):
+        logger.error("Error: Missing required environment variables")
         return
 
-    bot.run(DISCORD_TOKEN)
+    listener = setup_logging(LOGGER_NAME)
+    # discord.py warns on this logger when the event loop delays a heartbeat
+    logger.addFilter(HeartbeatBlockedFilter())
+    try:
+        # The pipeline replaces the log handler discord.py installs by default
+        bot.run(DISCORD_TOKEN, log_handler=None)
+    finally:
+        listener.stop()
 
 
 if __name__ == "__main__":
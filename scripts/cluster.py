@@ -0,0 +1,218 @@
+"""
+This file contains the launcher of the bot as a cluster of worker processes, to use every core of a host.
+The shards of the bot are split into CLUSTER_PROCESSES contiguous ranges and every range is run by its own
+process (bot.py with SHARDING, SHARD_COUNT and SHARD_IDS set), so gateway events, embeds and JSON of different
+guilds are handled on different cores. The workers are started one after the other, leaving every shard the
+time Discord requires between two identifies, and a worker that exits is restarted after a growing delay.
+The workers share the response cache, the answer store and the limit of the requests to the LLM backend through
+SQLite files (see cluster_state.py); every worker gets its own metrics port, METRICS_PORT + its index.
+
+Usage:
+    python cluster.py
+"""
+
+import asyncio
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+from typing import Optional
+
+import aiohttp
+from cluster_state import CLUSTER_BACKEND_CONCURRENCY, CLUSTER_STATE_PATH
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
+CLUSTER_PROCESSES = int(os.getenv("CLUSTER_PROCESSES") or os.cpu_count() or 1)
+SHARD_COUNT = int(os.getenv("SHARD_COUNT") or 0)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+# Seconds a shard waits before it identifies to the gateway (one identify per 5 seconds without large bot sharding)
+IDENTIFY_INTERVAL = 5
+# Bounds (in seconds) of the delay before a worker that exited is restarted
+RESTART_MIN = 5
+RESTART_MAX = 300
+# Seconds a worker has to run to be considered healthy, its restart delay is then reset
+HEALTHY_AFTER = 60
+
+DISCORD_API = "https://discord.com/api/v10"
+
+BOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+
+logger = logging.getLogger("cluster")
+
+
+async def recommended_shards(token: str) -> int:
+    """
+    Asks Discord for the recommended number of shards of the bot.
+
+    Args:
+        token (str): The token of the bot.
+
+    Returns:
+        int: The number of shards.
+    """
+    async with aiohttp.ClientSession() as session:
+        async with session.get(
+            f"{DISCORD_API}/gateway/bot", headers={"Authorization": f"Bot {token}"}
+        ) as response:
+            response.raise_for_status()
+            return (await response.json())["shards"]
+
+
+def split_shards(shard_count: int, processes: int) -> list[range]:
+    """
+    Splits the shards into contiguous ranges of about the same size.
+
+    Args:
+        shard_count (int): The number of shards.
+        processes (int): The number of worker processes, at most one per shard.
+
+    Returns:
+        list[range]: The shards of every worker.
+    """
+    processes = max(1, min(processes, shard_count))
+    size, extra = divmod(shard_count, processes)
+    ranges = []
+    start = 0
+    for index in range(processes):
+        end = start + size + (1 if index < extra else 0)
+        ranges.append(range(start, end))
+        start = end
+    return ranges
+
+
+class Worker:
+    """
+    A worker process of the cluster, running bot.py for a range of shards.
+
+    Args:
+        index (int): The index of the worker.
+        shards (range): The shards of the worker.
+        shard_count (int): The number of shards of the bot.
+
+    Attributes:
+        process (Optional[subprocess.Popen]): The running process, if any.
+    """
+
+    def __init__(self, index: int, shards: range, shard_count: int):
+        self.index = index
+        self.shards = shards
+        self.shard_count = shard_count
+        self.process: Optional[subprocess.Popen] = None
+        self.started_at = 0.0
+        self.restart_at = 0.0
+        self.delay = RESTART_MIN
+
+    def start(self):
+        """Starts the process of the worker."""
+        env = dict(
+            os.environ,
+            SHARDING="true",
+            SHARD_COUNT=str(self.shard_count),
+            SHARD_IDS=f"{self.shards.start}-{self.shards.stop - 1}",
+        )
+        if METRICS_PORT:
+            env["METRICS_PORT"] = str(METRICS_PORT + self.index)
+        if self.index > 0:
+            # The commands are global, one sync from the first worker covers the whole cluster
+            env["SYNC_COMMANDS"] = "false"
+        self.process = subprocess.Popen([sys.executable, BOT_PATH], env=env)
+        self.started_at = time.monotonic()
+        logger.info(
+            "Worker %s started with shards %s (PID %s)",
+            self.index,
+            env["SHARD_IDS"],
+            self.process.pid,
+        )
+
+    def check(self):
+        """Restarts the worker once its process exited and its restart delay passed."""
+        now = time.monotonic()
+        if self.process is not None:
+            code = self.process.poll()
+            if code is None:
+                return
+            if now - self.started_at > HEALTHY_AFTER:
+                self.delay = RESTART_MIN
+            logger.warning(
+                "Worker %s exited with code %s, restarting in %s seconds",
+                self.index,
+                code,
+                self.delay,
+            )
+            self.process = None
+            self.restart_at = now + self.delay
+            self.delay = min(self.delay * 2, RESTART_MAX)
+        if now >= self.restart_at:
+            self.start()
+
+    def stop(self):
+        """Asks the process of the worker to shut down."""
+        if self.process is not None and self.process.poll() is None:
+            self.process.send_signal(signal.SIGINT)
+
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(levelname)-8s %(name)s %(message)s"
+    )
+    if not DISCORD_TOKEN:
+        logger.error("Error: Missing required environment variables")
+        return
+
+    shard_count = SHARD_COUNT or asyncio.run(recommended_shards(DISCORD_TOKEN))
+    workers = [
+        Worker(index, shards, shard_count)
+        for index, shards in enumerate(split_shards(shard_count, CLUSTER_PROCESSES))
+    ]
+    logger.info(
+        "Running %s shards in %s workers%s",
+        shard_count,
+        len(workers),
+        (
+            ""
+            if CLUSTER_STATE_PATH and CLUSTER_BACKEND_CONCURRENCY
+            else ", without a shared backend limit"
+        ),
+    )
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    try:
+        for worker in workers:
+            worker.start()
+            # The shards of a worker identify one after the other, the next worker waits for them
+            deadline = time.monotonic() + len(worker.shards) * IDENTIFY_INTERVAL
+            while not stopping and time.monotonic() < deadline:
+                time.sleep(0.5)
+            if stopping:
+                break
+        while not stopping:
+            for worker in workers:
+                worker.check()
+            time.sleep(1)
+    finally:
+        for worker in workers:
+            worker.stop()
+        for worker in workers:
+            if worker.process is not None:
+                try:
+                    worker.process.wait(timeout=30)
+                except subprocess.TimeoutExpired:
+                    worker.process.kill()
+
+
+if __name__ == "__main__":
+    main()
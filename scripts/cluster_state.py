@@ -0,0 +1,202 @@
+"""
+This file contains the state shared by the worker processes of a cluster (see cluster.py).
+Every worker owns a range of shards and runs its own event loop, so they only share what goes through a
+SQLite file on the host: the response cache (RESPONSE_CACHE_PATH) and the answer store (ANSWER_STORE_PATH)
+already live in SQLite files and only need to point to the same path, and SharedLimiter bounds how many
+requests all the workers together send to the LLM backend. The file is only used from worker threads, so it
+never blocks an event loop.
+"""
+
+import asyncio
+import os
+import sqlite3
+import threading
+from typing import Optional
+
+# SQLite file shared by the workers of a cluster, an empty string disables the shared limit
+CLUSTER_STATE_PATH = os.getenv("CLUSTER_STATE_PATH", "")
+# Maximum number of requests to the LLM backend in flight across all the workers, 0 for no shared limit
+CLUSTER_BACKEND_CONCURRENCY = int(os.getenv("CLUSTER_BACKEND_CONCURRENCY", "0"))
+
+# Bounds (in seconds) of the wait between two attempts to take a slot
+POLL_MIN = 0.05
+POLL_MAX = 0.5
+
+
+def parse_shard_ids(value: str) -> Optional[list[int]]:
+    """
+    Parses a list of shard IDs such as "0-3" or "0,2,4".
+
+    Args:
+        value (str): The shard IDs, comma separated, with ranges of consecutive IDs written as "first-last".
+
+    Returns:
+        Optional[list[int]]: The sorted shard IDs, or None if the value is empty.
+
+    Raises:
+        ValueError: If a part of the value is not an ID or a range.
+    """
+    ids: set[int] = set()
+    for part in value.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        ids.update(range(int(first), int(last or first) + 1))
+    return sorted(ids) or None
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class SharedLimiter:
+    """
+    A concurrency limit shared by the processes of a host through a SQLite file.
+
+    Every request in flight holds a row with the PID of its process, and the rows of processes that died are
+    reclaimed the next time a slot is taken, so a crashed worker never keeps its slots.
+
+    Args:
+        path (str): The path of the SQLite file, an empty string disables the limiter.
+        concurrency (int): The maximum number of slots held at the same time, 0 disables the limiter.
+
+    Attributes:
+        waits (int): The number of times a slot was not free and had to be waited for.
+
+    Methods:
+        open: Opens the file.
+        close: Closes the file.
+        acquire: Waits for a slot.
+        release: Frees a slot.
+    """
+
+    def __init__(
+        self,
+        path: str = CLUSTER_STATE_PATH,
+        concurrency: int = CLUSTER_BACKEND_CONCURRENCY,
+    ):
+        self.path = path
+        self.concurrency = concurrency
+        self.waits = 0
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        # Releases of the slots taken for callers that were cancelled meanwhile
+        self._orphans: set[asyncio.Task] = set()
+
+    @property
+    def enabled(self) -> bool:
+        """Whether the limiter bounds anything."""
+        return bool(self.path) and self.concurrency > 0
+
+    async def open(self):
+        """Opens the file and frees the slots this PID held before a restart."""
+        if self.enabled and self._db is None:
+            await asyncio.to_thread(self._open_db)
+
+    async def close(self):
+        """Frees the slots of this process and closes the file."""
+        if self._db is not None:
+            await asyncio.to_thread(self._close_db)
+
+    async def acquire(self) -> Optional[int]:
+        """
+        Waits for a slot.
+
+        Returns:
+            Optional[int]: The ID of the slot, to pass to release, or None if the limiter is disabled.
+        """
+        if self._db is None:
+            return None
+        delay = POLL_MIN
+        while True:
+            # The thread cannot be stopped, if the caller is cancelled the slot it takes is released instead
+            attempt = asyncio.ensure_future(asyncio.to_thread(self._db_acquire))
+            try:
+                slot = await asyncio.shield(attempt)
+            except asyncio.CancelledError:
+                attempt.add_done_callback(self._release_orphan)
+                raise
+            if slot is not None:
+                return slot
+            if delay == POLL_MIN:
+                self.waits += 1
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, POLL_MAX)
+
+    async def release(self, slot: Optional[int]):
+        """
+        Frees a slot.
+
+        Args:
+            slot (Optional[int]): The ID returned by acquire.
+        """
+        if slot is not None and self._db is not None:
+            await asyncio.to_thread(self._db_release, slot)
+
+    def _release_orphan(self, attempt: asyncio.Future):
+        if attempt.cancelled() or attempt.exception() is not None:
+            return
+        if attempt.result() is not None:
+            task = asyncio.ensure_future(self.release(attempt.result()))
+            self._orphans.add(task)
+            task.add_done_callback(self._orphans.discard)
+
+    def _open_db(self):
+        with self._db_lock:
+            # Each process waits for the others' writes instead of failing with "database is locked"
+            self._db = sqlite3.connect(
+                self.path, timeout=30, isolation_level=None, check_same_thread=False
+            )
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS backend_slots "
+                "(id INTEGER PRIMARY KEY, pid INTEGER NOT NULL)"
+            )
+            self._db.execute("DELETE FROM backend_slots WHERE pid = ?", (os.getpid(),))
+
+    def _close_db(self):
+        with self._db_lock:
+            self._db.execute("DELETE FROM backend_slots WHERE pid = ?", (os.getpid(),))
+            self._db.close()
+            self._db = None
+
+    def _db_acquire(self) -> Optional[int]:
+        with self._db_lock:
+            # BEGIN IMMEDIATE takes the write lock, so two processes never count the same free slot
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                pids = [
+                    pid
+                    for (pid,) in self._db.execute(
+                        "SELECT DISTINCT pid FROM backend_slots"
+                    )
+                ]
+                for pid in pids:
+                    if not _process_alive(pid):
+                        self._db.execute(
+                            "DELETE FROM backend_slots WHERE pid = ?", (pid,)
+                        )
+                (held,) = self._db.execute(
+                    "SELECT COUNT(*) FROM backend_slots"
+                ).fetchone()
+                slot = None
+                if held < self.concurrency:
+                    slot = self._db.execute(
+                        "INSERT INTO backend_slots (pid) VALUES (?)", (os.getpid(),)
+                    ).lastrowid
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        return slot
+
+    def _db_release(self, slot: int):
+        with self._db_lock:
+            self._db.execute("DELETE FROM backend_slots WHERE id = ?", (slot,))
@@ -0,0 +1,121 @@
+"""
+This file contains the builder of the chat history sent to the LLM when the bot is mentioned or messaged.
+The history is filled newest message first until a token budget is used, so long channels do not
+produce huge prompts that inflate the prefill time or overflow the context of the model.
+Tokens are estimated from the length of the text (no tokenizer has to be loaded), and the estimate
+is cached on every message so it is computed once per message. Messages of bots are left out and an
+image URL that appears several times is only kept in its most recent message.
+"""
+
+import os
+
+from history import HistoryMessage
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+CONTEXT_INCLUDE_BOTS = os.getenv("CONTEXT_INCLUDE_BOTS", "false").lower() == "true"
+
+# Average amount of characters per token of common LLM tokenizers
+CHARACTERS_PER_TOKEN = 4
+
+# Text that replaces an image URL that is already in a more recent message, which comes later in the history
+REPEATED_IMAGE = " [Image: see below]"
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimates the number of tokens of a text.
+
+    Args:
+        text (str): The text to estimate.
+
+    Returns:
+        int: The estimated number of tokens, at least 1 for a non empty text.
+    """
+    return -(-len(text) // CHARACTERS_PER_TOKEN)
+
+
+def message_tokens(message: HistoryMessage) -> int:
+    """
+    Returns the token count of the author and text of a message, computing it only once.
+
+    Args:
+        message (HistoryMessage): The message.
+
+    Returns:
+        int: The estimated number of tokens.
+    """
+    if message.tokens is None:
+        message.tokens = estimate_tokens(f"{message.author}: {message.content}\n")
+    return message.tokens
+
+
+class ChatContext:
+    """
+    A chat history that fits in a token budget.
+
+    Attributes:
+        text (str): The chat history, oldest message first.
+        tokens (int): The estimated number of tokens of the text.
+        budget (int): The token budget the history was built for.
+        messages (int): The number of messages in the history.
+        dropped (int): The number of messages left out (bots, empty, or over the budget).
+    """
+
+    def __init__(
+        self, text: str, tokens: int, budget: int, messages: int, dropped: int
+    ):
+        self.text = text
+        self.tokens = tokens
+        self.budget = budget
+        self.messages = messages
+        self.dropped = dropped
+
+
+def build_context(
+    messages: list[HistoryMessage],
+    budget: int = CONTEXT_TOKEN_BUDGET,
+    include_bots: bool = CONTEXT_INCLUDE_BOTS,
+) -> ChatContext:
+    """
+    Builds the chat history that fits in the token budget, keeping the most recent messages.
+
+    Args:
+        messages (list[HistoryMessage]): The messages of the channel, oldest first.
+        budget (int): The maximum number of tokens of the history.
+        include_bots (bool): Whether messages of bots are kept.
+
+    Returns:
+        ChatContext: The chat history and how many tokens it used.
+    """
+    lines: list[str] = []
+    seen_urls: set[str] = set()
+    tokens = 0
+    dropped = 0
+
+    for position, message in enumerate(reversed(messages)):
+        if (message.is_bot and not include_bots) or not (
+            message.content or message.image_urls
+        ):
+            dropped += 1
+            continue
+
+        line = f"{message.author}: {message.content}"
+        cost = message_tokens(message)
+        for url in message.image_urls:
+            if url in seen_urls:
+                line += REPEATED_IMAGE
+                cost += estimate_tokens(REPEATED_IMAGE)
+            else:
+                seen_urls.add(url)
+                image = f" [Image: {url}]"
+                line += image
+                cost += estimate_tokens(image)
+
+        if tokens + cost > budget:
+            dropped += len(messages) - position
+            break
+        lines.append(line)
+        tokens += cost
+
+    lines.reverse()
+    return ChatContext("\n".join(lines), tokens, budget, len(lines), dropped)
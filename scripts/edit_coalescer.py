@@ -0,0 +1,207 @@
+"""
+This file contains the coalescing of the edits of a Discord message.
+Every event that changes a message (a page button, a new token of a streamed answer, a new queue position)
+submits the new state of the message, and only the latest state is sent: states submitted while an edit
+is waiting are dropped, so a burst of events becomes a single REST call instead of a queue of calls that
+hit 429s and wait behind each other.
+The minimum interval between two edits adapts to the rate limit headers Discord sends back: the edits left
+in the bucket are spread over the time until it resets, and a 429 holds the edits until it is lifted.
+The latest state is sent at once when the message is complete (flush).
+"""
+
+import asyncio
+import contextvars
+import os
+import time
+from typing import Awaitable, Callable, Optional
+
+import aiohttp
+import discord
+from metrics import observe_stage
+
+EDIT_MIN_INTERVAL = float(os.getenv("EDIT_MIN_INTERVAL", "0.5"))
+EDIT_MAX_INTERVAL = float(os.getenv("EDIT_MAX_INTERVAL", "10"))
+
+# The coalescer whose edit is being sent, so the rate limit headers of the response reach it
+_current: contextvars.ContextVar[Optional["EditCoalescer"]] = contextvars.ContextVar(
+    "edit_coalescer", default=None
+)
+
+
+class EditStats:
+    """
+    The counters of every coalescer.
+
+    Attributes:
+        sent (int): The number of edits sent.
+        dropped (int): The number of intermediate states replaced by a newer one before being sent.
+        failed (int): The number of edits Discord rejected.
+        rate_limited (int): The number of 429 responses to an edit.
+    """
+
+    def __init__(self):
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+        self.rate_limited = 0
+
+
+edit_stats = EditStats()
+
+
+def rate_limit_trace() -> aiohttp.TraceConfig:
+    """
+    Builds the trace that passes the rate limit headers of Discord's responses to the coalescers.
+
+    Returns:
+        aiohttp.TraceConfig: The trace, given to the bot as http_trace.
+    """
+
+    async def on_request_end(session, context, params: aiohttp.TraceRequestEndParams):
+        coalescer = _current.get()
+        if coalescer is not None:
+            coalescer.observe(params.response.status, params.response.headers)
+
+    trace = aiohttp.TraceConfig()
+    trace.on_request_end.append(on_request_end)
+    return trace
+
+
+class EditCoalescer:
+    """
+    Sends the latest state of a message, at most one edit per interval.
+
+    A state is a coroutine function without arguments that sends the edit, it is only called when the
+    edit is sent so it can read the latest data at that time.
+
+    Args:
+        min_interval (float): The minimum amount of seconds between two edits.
+        max_interval (float): The maximum amount of seconds between two edits, whatever the headers say.
+
+    Attributes:
+        interval (float): The current amount of seconds between two edits.
+        sent (int): The number of edits sent.
+        dropped (int): The number of states replaced by a newer one before being sent.
+        failed (int): The number of edits Discord rejected.
+        rate_limited (int): The number of 429 responses to an edit.
+        pending (bool): Whether a state is waiting to be sent.
+
+    Methods:
+        submit: Sets the latest state of the message.
+        flush: Sends the latest state at once and waits for it.
+        observe: Adapts the interval to the rate limit headers of a response.
+    """
+
+    def __init__(
+        self,
+        min_interval: float = EDIT_MIN_INTERVAL,
+        max_interval: float = EDIT_MAX_INTERVAL,
+    ):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.interval = min_interval
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+        self.rate_limited = 0
+        self._pending: Optional[Callable[[], Awaitable]] = None
+        self._next_at = 0.0
+        self._flushing = False
+        self._error: Optional[discord.HTTPException] = None
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def pending(self) -> bool:
+        """Whether a state is waiting to be sent."""
+        return self._pending is not None
+
+    def submit(self, send: Callable[[], Awaitable]):
+        """
+        Sets the latest state of the message, replacing the state waiting to be sent.
+
+        Args:
+            send (Callable): A coroutine function without arguments that sends the edit.
+        """
+        if self._pending is not None:
+            self.dropped += 1
+            edit_stats.dropped += 1
+        self._pending = send
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def flush(self):
+        """
+        Sends the latest state without waiting for the interval and waits until it is sent.
+
+        Raises:
+            discord.HTTPException: If Discord rejected the last edit.
+        """
+        self._flushing = True
+        self._wake.set()
+        try:
+            if self._task is not None:
+                # The caller being cancelled must not cancel an edit that is being sent
+                await asyncio.shield(self._task)
+        finally:
+            self._flushing = False
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def observe(self, status: int, headers):
+        """
+        Adapts the interval to the rate limit headers of a response to an edit.
+
+        Args:
+            status (int): The status code of the response.
+            headers: The headers of the response.
+        """
+        now = time.monotonic()
+        if status == 429:
+            self.rate_limited += 1
+            edit_stats.rate_limited += 1
+            self.interval = min(self.max_interval, self.interval * 2)
+            retry_after = float(headers.get("Retry-After", self.interval))
+            self._next_at = max(self._next_at, now + retry_after)
+            return
+
+        remaining = headers.get("X-RateLimit-Remaining")
+        reset_after = headers.get("X-RateLimit-Reset-After")
+        if remaining is None or reset_after is None:
+            return
+        remaining, reset_after = int(remaining), float(reset_after)
+        if remaining == 0:
+            self._next_at = max(self._next_at, now + reset_after)
+        # Spread the edits left in the bucket over the time until it resets
+        self.interval = min(
+            self.max_interval, max(self.min_interval, reset_after / (remaining + 1))
+        )
+
+    async def _run(self):
+        while self._pending is not None:
+            delay = self._next_at - time.monotonic()
+            if delay > 0 and not self._flushing:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+
+            send, self._pending = self._pending, None
+            token = _current.set(self)
+            started = time.perf_counter()
+            try:
+                await send()
+                observe_stage("discord_edit", time.perf_counter() - started)
+                self.sent += 1
+                edit_stats.sent += 1
+                self._error = None
+            except discord.HTTPException as error:
+                # An intermediate state that fails is replaced by the next one, the last error is raised by flush
+                self.failed += 1
+                edit_stats.failed += 1
+                self._error = error
+            finally:
+                _current.reset(token)
+            self._next_at = max(self._next_at, time.monotonic() + self.interval)
@@ -0,0 +1,279 @@
+"""
+This file contains the in-memory cache of the recent messages of every channel the bot talks in.
+The history of a channel is fetched from Discord once, the first time it is needed, and is then kept
+current from the gateway events (new, edited, deleted and bulk deleted messages), so building the
+chat history of a mention or DM does not cost a paginated REST call anymore.
+Each channel keeps a bounded number of messages, and the least recently used channels are evicted
+when there are too many of them or when the cache uses more memory than allowed.
+"""
+
+import asyncio
+import os
+from collections import OrderedDict
+from typing import Iterable, Optional
+
+import discord
+
+HISTORY_MESSAGES = int(os.getenv("HISTORY_MESSAGES", "100"))
+HISTORY_MAX_CHANNELS = int(os.getenv("HISTORY_MAX_CHANNELS", "500"))
+HISTORY_MAX_BYTES = int(os.getenv("HISTORY_MAX_BYTES", str(16 * 1024 * 1024)))
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".gif", ".webp")
+
+
+class HistoryMessage:
+    """
+    The parts of a message needed to build a chat history.
+
+    Args:
+        message_id (int): The ID of the message.
+        author (str): The name of the author.
+        content (str): The text of the message.
+        image_urls (list[str]): The URLs of the images attached to the message.
+        is_bot (bool): Whether the author is a bot.
+
+    Attributes:
+        tokens (Optional[int]): The estimated token count of the author and text, set by the context builder
+            the first time it is needed and reset when the message is edited.
+    """
+
+    __slots__ = ("message_id", "author", "content", "image_urls", "is_bot", "tokens")
+
+    def __init__(
+        self,
+        message_id: int,
+        author: str,
+        content: str,
+        image_urls: list[str],
+        is_bot: bool,
+    ):
+        self.message_id = message_id
+        self.author = author
+        self.content = content
+        self.image_urls = image_urls
+        self.is_bot = is_bot
+        self.tokens: Optional[int] = None
+
+    @classmethod
+    def from_message(cls, message: discord.Message) -> "HistoryMessage":
+        """Builds the history entry of a Discord message."""
+        return cls(
+            message.id,
+            message.author.name,
+            message.content,
+            image_urls(message.attachments),
+            message.author.bot,
+        )
+
+    @property
+    def size(self) -> int:
+        """An estimate of the memory used by the text of the message."""
+        return (
+            len(self.author)
+            + len(self.content)
+            + sum(len(url) for url in self.image_urls)
+        )
+
+    def render(self) -> str:
+        """
+        Renders the message as a line of the chat history.
+
+        Returns:
+            str: The author and text of the message, followed by its images.
+        """
+        line = f"{self.author}: {self.content}"
+        for url in self.image_urls:
+            line += f" [Image: {url}]"
+        return line
+
+
+def image_urls(attachments: Iterable) -> list[str]:
+    """
+    Collects the URLs of the image attachments.
+
+    Args:
+        attachments (Iterable): Discord attachments, or attachment dicts of a raw gateway event.
+
+    Returns:
+        list[str]: The URLs of the attachments that are images.
+    """
+    urls = []
+    for attachment in attachments:
+        if isinstance(attachment, dict):
+            filename, url = attachment.get("filename", ""), attachment.get("url", "")
+        else:
+            filename, url = attachment.filename, attachment.url
+        if filename.lower().endswith(IMAGE_EXTENSIONS):
+            urls.append(url)
+    return urls
+
+
+class ChannelHistory:
+    """The cached messages of a channel, oldest first."""
+
+    def __init__(self):
+        self.messages: OrderedDict[int, HistoryMessage] = OrderedDict()
+        self.size = 0
+        self.loaded: Optional[asyncio.Future] = None
+
+
+class ChannelHistoryCache:
+    """
+    A bounded cache of the recent messages of every channel, kept current from gateway events.
+
+    Args:
+        max_messages (int): The maximum number of messages kept per channel.
+        max_channels (int): The maximum number of channels kept.
+        max_bytes (int): The maximum size of the messages kept in all channels.
+
+    Attributes:
+        fetches (int): The number of histories fetched from Discord.
+        evictions (int): The number of channels evicted to respect the bounds.
+        size (int): The size of the messages kept in all channels.
+
+    Methods:
+        get: Returns the recent messages of a channel, fetching them the first time.
+        add: Adds a new message.
+        edit: Updates the text of a message.
+        delete: Removes messages.
+    """
+
+    def __init__(
+        self,
+        max_messages: int = HISTORY_MESSAGES,
+        max_channels: int = HISTORY_MAX_CHANNELS,
+        max_bytes: int = HISTORY_MAX_BYTES,
+    ):
+        self.max_messages = max_messages
+        self.max_channels = max_channels
+        self.max_bytes = max_bytes
+        self.fetches = 0
+        self.evictions = 0
+        self.size = 0
+        self._channels: OrderedDict[int, ChannelHistory] = OrderedDict()
+
+    async def get(self, channel, limit: int = HISTORY_MESSAGES) -> list[HistoryMessage]:
+        """
+        Returns the recent messages of a channel, the history is fetched from Discord only the first time.
+
+        Args:
+            channel (discord.abc.Messageable): The channel.
+            limit (int): The maximum number of messages to return.
+
+        Returns:
+            list[HistoryMessage]: The most recent messages, oldest first.
+        """
+        history = self._channel(channel.id)
+        while history.loaded is None or not history.loaded.done():
+            if history.loaded is not None:
+                # Another caller is fetching the history, if it fails this caller fetches it again
+                await asyncio.shield(history.loaded)
+                continue
+            history.loaded = asyncio.get_running_loop().create_future()
+            try:
+                fetched = [
+                    HistoryMessage.from_message(message)
+                    async for message in channel.history(limit=self.max_messages)
+                ]
+            except BaseException:
+                history.loaded.set_result(None)
+                history.loaded = None
+                raise
+            self.fetches += 1
+            self._fill(channel.id, history, fetched)
+            history.loaded.set_result(None)
+
+        messages = list(history.messages.values())
+        return messages[-limit:] if limit else []
+
+    def add(self, message: discord.Message):
+        """
+        Adds a new message to the history of its channel, if that history is cached.
+
+        Args:
+            message (discord.Message): The new message.
+        """
+        history = self._channels.get(message.channel.id)
+        if history is None:
+            return
+        self._put(history, HistoryMessage.from_message(message))
+        self._trim(message.channel.id, history)
+
+    def edit(self, channel_id: int, message_id: int, data: dict):
+        """
+        Updates a cached message from the data of a raw edit event.
+
+        Args:
+            channel_id (int): The ID of the channel.
+            message_id (int): The ID of the edited message.
+            data (dict): The raw data of the edited message.
+        """
+        history = self._channels.get(channel_id)
+        if history is None or message_id not in history.messages:
+            return
+        entry = history.messages[message_id]
+        self._account(history, -entry.size)
+        if "content" in data:
+            entry.content = data["content"]
+        if "attachments" in data:
+            entry.image_urls = image_urls(data["attachments"])
+        entry.tokens = None
+        self._account(history, entry.size)
+
+    def delete(self, channel_id: int, message_ids: Iterable[int]):
+        """
+        Removes deleted messages from the history of a channel.
+
+        Args:
+            channel_id (int): The ID of the channel.
+            message_ids (Iterable[int]): The IDs of the deleted messages.
+        """
+        history = self._channels.get(channel_id)
+        if history is None:
+            return
+        for message_id in message_ids:
+            entry = history.messages.pop(message_id, None)
+            if entry is not None:
+                self._account(history, -entry.size)
+
+    def _channel(self, channel_id: int) -> ChannelHistory:
+        history = self._channels.get(channel_id)
+        if history is None:
+            history = self._channels[channel_id] = ChannelHistory()
+        self._channels.move_to_end(channel_id)
+        return history
+
+    def _fill(self, channel_id: int, history: ChannelHistory, fetched: list):
+        # Messages received while the history was fetched are merged, snowflakes sort by time
+        for entry in fetched:
+            if entry.message_id not in history.messages:
+                self._put(history, entry)
+        history.messages = OrderedDict(sorted(history.messages.items()))
+        self._trim(channel_id, history)
+
+    def _put(self, history: ChannelHistory, entry: HistoryMessage):
+        previous = history.messages.pop(entry.message_id, None)
+        if previous is not None:
+            self._account(history, -previous.size)
+        history.messages[entry.message_id] = entry
+        self._account(history, entry.size)
+
+    def _account(self, history: ChannelHistory, size: int):
+        history.size += size
+        self.size += size
+
+    def _trim(self, channel_id: int, history: ChannelHistory):
+        while len(history.messages) > self.max_messages:
+            _, entry = history.messages.popitem(last=False)
+            self._account(history, -entry.size)
+        while len(self._channels) > self.max_channels or (
+            self.size > self.max_bytes and len(self._channels) > 1
+        ):
+            evicted_id = next(iter(self._channels))
+            if evicted_id == channel_id:
+                # Never evict the channel that is being used, evict the next one instead
+                self._channels.move_to_end(channel_id)
+                evicted_id = next(iter(self._channels))
+            evicted = self._channels.pop(evicted_id)
+            self.size -= evicted.size
+            self.evictions += 1
@@ -0,0 +1,282 @@
+"""
+This file contains the on-disk cache of the images generated by /image, so a prompt that was already
+drawn is answered from disk instead of asking the backend to generate it again.
+Images are content addressed: the file name is the hash of the prompt, the model and the generation
+parameters. A small JSON index keeps the size and last use of every file, and the least recently used
+files are evicted once the cache is larger than allowed. Files and index are written to a temporary
+file first and then renamed, so a crash never leaves a partial file behind, and all disk I/O runs in
+a worker thread.
+In dedup mode the URL of the attachment Discord stored when the image was first posted is remembered,
+and reused instead of uploading the same image again while that URL is still valid.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from typing import Optional
+
+from images import DownloadedImage
+
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", "")
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+IMAGE_CACHE_DEDUP = os.getenv("IMAGE_CACHE_DEDUP", "false").lower() == "true"
+# Discord attachment URLs are signed and expire after about a day
+IMAGE_CACHE_CDN_TTL = float(os.getenv("IMAGE_CACHE_CDN_TTL", str(20 * 3600)))
+
+INDEX_FILE = "index.json"
+
+
+def image_key(prompt: str, model: str, params: dict) -> str:
+    """
+    Builds the cache key of an image generation.
+
+    Args:
+        prompt (str): The prompt of the image.
+        model (str): The name of the image model.
+        params (dict): The generation parameters.
+
+    Returns:
+        str: The SHA-256 hex digest of the generation request.
+    """
+    identity = json.dumps(
+        [prompt.strip(), model, params], sort_keys=True, ensure_ascii=False
+    )
+    return hashlib.sha256(identity.encode("utf-8")).hexdigest()
+
+
+class CachedImage:
+    """
+    An image found in the cache.
+
+    Attributes:
+        path (str): The path of the image file.
+        filename (str): The name of the attachment.
+        cdn_url (Optional[str]): The Discord URL of the image, set in dedup mode while it is valid.
+    """
+
+    def __init__(self, path: str, filename: str, cdn_url: Optional[str] = None):
+        self.path = path
+        self.filename = filename
+        self.cdn_url = cdn_url
+
+
+def _write_atomic(path: str, source) -> int:
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    descriptor, temporary = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(descriptor, "wb") as file:
+            if isinstance(source, bytes):
+                file.write(source)
+            else:
+                shutil.copyfileobj(source, file)
+            size = file.tell()
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+    return size
+
+
+class ImageCache:
+    """
+    A size bounded, content addressed cache of generated images.
+
+    Args:
+        directory (str): The directory of the cache, an empty string disables it.
+        max_bytes (int): The maximum size of the cached images.
+        dedup (bool): Whether the Discord URL of a posted image is reused instead of uploading it again.
+        cdn_ttl (float): The amount of seconds a Discord URL is reused.
+
+    Attributes:
+        hits (int): The number of lookups that found an image.
+        misses (int): The number of lookups that did not.
+        size (int): The size of the cached images.
+
+    Methods:
+        open: Loads the index.
+        close: Saves the index.
+        get: Looks up an image.
+        put: Stores an image.
+        drop_missing: Forgets an image whose file disappeared.
+        set_cdn_url: Remembers the Discord URL of a posted image.
+    """
+
+    def __init__(
+        self,
+        directory: str = IMAGE_CACHE_DIR,
+        max_bytes: int = IMAGE_CACHE_MAX_BYTES,
+        dedup: bool = IMAGE_CACHE_DEDUP,
+        cdn_ttl: float = IMAGE_CACHE_CDN_TTL,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.dedup = dedup
+        self.cdn_ttl = cdn_ttl
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        # key -> {"filename", "size", "last_used", "cdn_url", "cdn_at"}
+        self._index: dict[str, dict] = {}
+        self._dirty = False
+
+    @property
+    def enabled(self) -> bool:
+        """Whether the cache stores anything."""
+        return bool(self.directory)
+
+    async def open(self):
+        """Loads the index, forgetting the entries whose file is missing."""
+        if not self.enabled:
+            return
+        self._index = await asyncio.to_thread(self._load_index)
+        self.size = sum(entry["size"] for entry in self._index.values())
+        await self._evict_and_save()
+
+    async def close(self):
+        """Saves the index if it changed."""
+        if self.enabled and self._dirty:
+            await self._evict_and_save()
+
+    async def get(self, key: str) -> Optional[CachedImage]:
+        """
+        Looks up an image.
+
+        Args:
+            key (str): The key built by image_key.
+
+        Returns:
+            Optional[CachedImage]: The cached image, or None if it is not cached.
+        """
+        entry = self._index.get(key) if self.enabled else None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        entry["last_used"] = time.time()
+        self._dirty = True
+        cdn_url = None
+        if self.dedup and entry.get("cdn_url"):
+            if time.time() - entry["cdn_at"] < self.cdn_ttl:
+                cdn_url = entry["cdn_url"]
+        return CachedImage(
+            self._path(key, entry["filename"]), entry["filename"], cdn_url
+        )
+
+    async def put(self, key: str, image: DownloadedImage):
+        """
+        Stores an image, the buffer of the image is rewound so it can still be sent.
+
+        Args:
+            key (str): The key built by image_key.
+            image (DownloadedImage): The downloaded image.
+        """
+        if not self.enabled or image.size > self.max_bytes:
+            return
+        image.file.seek(0)
+        size = await asyncio.to_thread(
+            _write_atomic, self._path(key, image.filename), image.file
+        )
+        image.file.seek(0)
+        previous = self._index.get(key)
+        if previous is not None:
+            self.size -= previous["size"]
+        self._index[key] = {
+            "filename": image.filename,
+            "size": size,
+            "last_used": time.time(),
+            "cdn_url": None,
+            "cdn_at": 0,
+        }
+        self.size += size
+        await self._evict_and_save()
+
+    def drop_missing(self, key: str):
+        """
+        Forgets an image whose file disappeared, like one evicted after it was looked up.
+        The lookup that returned it counts as a miss.
+
+        Args:
+            key (str): The key built by image_key.
+        """
+        entry = self._index.pop(key, None)
+        if entry is None:
+            return
+        self.size -= entry["size"]
+        self.hits -= 1
+        self.misses += 1
+        self._dirty = True
+
+    def set_cdn_url(self, key: str, url: str):
+        """
+        Remembers the Discord URL of a posted image, used in dedup mode.
+
+        Args:
+            key (str): The key built by image_key.
+            url (str): The URL of the attachment.
+        """
+        entry = self._index.get(key)
+        if entry is not None:
+            entry["cdn_url"] = url
+            entry["cdn_at"] = time.time()
+            self._dirty = True
+
+    def stats(self) -> dict:
+        """
+        Returns the counters of the cache.
+
+        Returns:
+            dict: The hits, misses, entries and size of the cache.
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self._index),
+            "bytes": self.size,
+        }
+
+    def _path(self, key: str, filename: str) -> str:
+        extension = os.path.splitext(filename)[1]
+        return os.path.join(self.directory, key[:2], key + extension)
+
+    def _load_index(self) -> dict[str, dict]:
+        try:
+            with open(
+                os.path.join(self.directory, INDEX_FILE), encoding="utf-8"
+            ) as file:
+                index = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            index = {}
+        return {
+            key: entry
+            for key, entry in index.items()
+            if os.path.exists(self._path(key, entry["filename"]))
+        }
+
+    async def _evict_and_save(self):
+        # The index is only touched on the event loop, the worker thread only does file I/O
+        evicted = []
+        if self.size > self.max_bytes:
+            for key in sorted(
+                self._index, key=lambda key: self._index[key]["last_used"]
+            ):
+                if self.size <= self.max_bytes:
+                    break
+                entry = self._index.pop(key)
+                self.size -= entry["size"]
+                evicted.append(self._path(key, entry["filename"]))
+        index = json.dumps(self._index, separators=(",", ":")).encode("utf-8")
+        self._dirty = False
+        await asyncio.to_thread(self._write_changes, evicted, index)
+
+    def _write_changes(self, evicted: list[str], index: bytes):
+        for path in evicted:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+        _write_atomic(os.path.join(self.directory, INDEX_FILE), index)
@@ -0,0 +1,181 @@
+"""
+This file contains the pipeline that brings a generated image from OpenWebUI to a Discord attachment.
+The download is streamed chunk by chunk into a single buffer, which moves to a temporary file on disk
+once the image is large, and that buffer is handed to discord.File as is, without any base64 round trip.
+Images larger than the size cap are rejected, and PNG images can optionally be recompressed to WebP
+(in a worker thread, with Pillow) to cut the upload time.
+"""
+
+import asyncio
+import io
+import os
+import tempfile
+from typing import IO, Optional
+
+import discord
+from backend_pool import Backend
+from openwebui import OpenWebUIClient
+from resilience import RETRY_STATUSES, RetryableStatusError, Timeouts
+
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", str(10 * 1024 * 1024)))
+IMAGE_SPOOL_BYTES = int(os.getenv("IMAGE_SPOOL_BYTES", str(2 * 1024 * 1024)))
+IMAGE_RECOMPRESS_WEBP = os.getenv("IMAGE_RECOMPRESS_WEBP", "false").lower() == "true"
+IMAGE_WEBP_QUALITY = int(os.getenv("IMAGE_WEBP_QUALITY", "90"))
+
+# Size of the chunks read from the download
+CHUNK_SIZE = 64 * 1024
+
+# Status codes of the downloads worth retrying, the image is usually still there after a 429 or a 5xx
+DOWNLOAD_RETRY_STATUSES = RETRY_STATUSES | {429}
+
+
+class ImageTooLargeError(Exception):
+    """Raised when an image is larger than IMAGE_MAX_BYTES."""
+
+
+class DownloadedImage:
+    """
+    A downloaded image, held in memory or in a temporary file.
+
+    Args:
+        file (IO[bytes]): The buffer holding the image (a BytesIO or a temporary file), positioned at its start.
+        size (int): The size of the image.
+        filename (str): The name of the attachment.
+
+    Methods:
+        to_file: Wraps the buffer in a discord.File.
+        close: Releases the buffer.
+    """
+
+    def __init__(self, file: IO[bytes], size: int, filename: str):
+        self.file = file
+        self.size = size
+        self.filename = filename
+
+    def to_file(self) -> discord.File:
+        """
+        Wraps the buffer in a discord.File, the buffer is closed once the file is sent.
+
+        Returns:
+            discord.File: The attachment of the image.
+        """
+        self.file.seek(0)
+        return discord.File(self.file, filename=self.filename)
+
+    def close(self):
+        """Releases the buffer."""
+        self.file.close()
+
+
+def _buffer(size: Optional[int] = None) -> IO[bytes]:
+    # A BytesIO or a temporary file rather than a SpooledTemporaryFile, which discord.File does not take
+    # before Python 3.11 (it is not an io.IOBase)
+    if size is not None and size > IMAGE_SPOOL_BYTES:
+        return tempfile.TemporaryFile()
+    return io.BytesIO()
+
+
+def _rollover(file: IO[bytes], size: int) -> IO[bytes]:
+    # Moves an image that outgrew IMAGE_SPOOL_BYTES from memory to a temporary file
+    if size <= IMAGE_SPOOL_BYTES or not isinstance(file, io.BytesIO):
+        return file
+    disk = tempfile.TemporaryFile()
+    disk.write(file.getbuffer())
+    file.close()
+    return disk
+
+
+async def stream_image(
+    client: OpenWebUIClient,
+    path: str,
+    max_bytes: int = IMAGE_MAX_BYTES,
+    backend: Optional[Backend] = None,
+    timeouts: Optional[Timeouts] = None,
+) -> Optional[DownloadedImage]:
+    """
+    Streams an image from OpenWebUI into a single buffer.
+
+    Args:
+        client (OpenWebUIClient): The shared OpenWebUI client.
+        path (str): The path of the image.
+        max_bytes (int): The maximum size of the image.
+        backend (Optional[Backend]): The backend that generated the image.
+        timeouts (Optional[Timeouts]): The timeouts given by the resilience layer.
+
+    Returns:
+        Optional[DownloadedImage]: The image, or None if the request failed.
+
+    Raises:
+        ImageTooLargeError: If the image is larger than max_bytes.
+        RetryableStatusError: If the status code is worth retrying.
+    """
+    async with client.get(
+        path, "download", backend=backend, timeouts=timeouts
+    ) as response:
+        if response.status in DOWNLOAD_RETRY_STATUSES:
+            raise RetryableStatusError(response.status)
+        if response.status != 200:
+            return None
+        if response.content_length is not None and response.content_length > max_bytes:
+            raise ImageTooLargeError(f"The image has {response.content_length} bytes")
+
+        file = _buffer(response.content_length)
+        size = 0
+        try:
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise ImageTooLargeError(
+                        f"The image has more than {max_bytes} bytes"
+                    )
+                file = _rollover(file, size)
+                file.write(chunk)
+        except BaseException:
+            file.close()
+            raise
+
+    file.seek(0)
+    extension = os.path.splitext(path.split("?")[0])[1] or ".png"
+    return DownloadedImage(file, size, "image" + extension)
+
+
+def _recompress(image: DownloadedImage, quality: int) -> DownloadedImage:
+    from PIL import Image
+
+    output = _buffer(image.size)
+    image.file.seek(0)
+    with Image.open(image.file) as source:
+        source.save(output, format="WEBP", quality=quality, method=4)
+    size = output.tell()
+    output = _rollover(output, size)
+    output.seek(0)
+    return DownloadedImage(output, size, "image.webp")
+
+
+async def recompress_webp(
+    image: DownloadedImage, quality: int = IMAGE_WEBP_QUALITY
+) -> DownloadedImage:
+    """
+    Recompresses an image to WebP in a worker thread, if it makes the image smaller.
+
+    Pillow is an optional dependency, without it the image is returned unchanged.
+
+    Args:
+        image (DownloadedImage): The downloaded image.
+        quality (int): The WebP quality, from 0 to 100.
+
+    Returns:
+        DownloadedImage: The smallest of the two images, the other one is closed.
+    """
+    try:
+        import PIL  # noqa: F401
+    except ImportError:
+        return image
+
+    webp = await asyncio.to_thread(_recompress, image, quality)
+    if webp.size >= image.size:
+        webp.close()
+        image.file.seek(0)
+        return image
+    image.close()
+    return webp
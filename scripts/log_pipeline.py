@@ -0,0 +1,184 @@
+"""
+This file contains the logging pipeline of the bot.
+A log call on the event loop only builds the record and puts it in a bounded queue: the message is formatted
+and written to stdout (and optionally to a rotating file) by a listener thread, so the loop never waits on
+I/O or on serializing a large payload. Payloads (LLM responses, with their sources and reasoning) are
+wrapped in Payload and serialized lazily in that thread, truncated, and only a sample of the large ones is
+kept. Records are written as text or as one JSON object per line.
+"""
+
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+from typing import Any, Optional
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+LOG_FILE = os.getenv("LOG_FILE", "")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_PAYLOAD_MAX_CHARS = int(os.getenv("LOG_PAYLOAD_MAX_CHARS", "2000"))
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "0.1"))
+
+# Size and number of the rotated log files
+LOG_FILE_MAX_BYTES = 10 * 1024 * 1024
+LOG_FILE_BACKUPS = 3
+
+TEXT_FORMAT = "%(asctime)s %(levelname)-8s %(name)s %(message)s"
+
+# Attributes of every LogRecord, anything else was passed with extra= and goes into the JSON record
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class Payload:
+    """
+    A large object to log, serialized to compact JSON only when the record is written.
+
+    Args:
+        value (Any): The object, usually a response of the OpenWebUI API.
+        max_chars (int): The maximum size of the serialized object, the rest is cut.
+
+    Attributes:
+        large (bool): Whether the serialized object was larger than max_chars, set once it is serialized.
+    """
+
+    __slots__ = ("value", "max_chars", "large", "_text")
+
+    def __init__(self, value: Any, max_chars: int = LOG_PAYLOAD_MAX_CHARS):
+        self.value = value
+        self.max_chars = max_chars
+        self.large = False
+        self._text: Optional[str] = None
+
+    def __str__(self) -> str:
+        if self._text is None:
+            text = json.dumps(self.value, ensure_ascii=False, default=str)
+            self.large = len(text) > self.max_chars
+            if self.large:
+                text = f"{text[: self.max_chars]}… ({len(text)} characters)"
+            self._text = text
+        return self._text
+
+
+class PayloadSampler(logging.Filter):
+    """
+    Keeps only a sample of the records with a large payload, the others always pass.
+
+    Args:
+        rate (float): The share of the records with a large payload that are kept.
+
+    Attributes:
+        dropped (int): The number of records dropped.
+    """
+
+    def __init__(self, rate: float = LOG_PAYLOAD_SAMPLE_RATE):
+        super().__init__()
+        self.rate = rate
+        self.dropped = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        args = record.args if isinstance(record.args, tuple) else ()
+        payloads = [arg for arg in args if isinstance(arg, Payload)]
+        if not payloads:
+            return True
+        # Decided once per record, so every handler keeps the same sample
+        kept = getattr(record, "_sampled", None)
+        if kept is None:
+            for payload in payloads:
+                # Serialized here, in the listener thread
+                str(payload)
+            large = any(payload.large for payload in payloads)
+            kept = not large or random.random() < self.rate
+            if not kept:
+                self.dropped += 1
+            record._sampled = kept
+        return kept
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as a JSON object on a single line, with the fields given with extra=."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update(
+            (key, value)
+            for key, value in vars(record).items()
+            if key not in _RECORD_ATTRIBUTES and not key.startswith("_")
+        )
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    A queue handler that leaves the formatting to the listener thread and drops records when the queue is full.
+
+    Attributes:
+        dropped (int): The number of records dropped because the queue was full.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The default prepare formats the message on the calling thread, the record is passed as is instead
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(logger_name: str) -> logging.handlers.QueueListener:
+    """
+    Sends the records of the discord loggers (the bot logs to one of them) through the queue.
+
+    Args:
+        logger_name (str): The name of the logger of the bot, logged at LOG_LEVEL.
+
+    Returns:
+        logging.handlers.QueueListener: The started listener, stopped when the bot shuts down to flush the queue.
+    """
+    formatter = (
+        JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter(TEXT_FORMAT)
+    )
+    handlers: list[logging.Handler] = [logging.StreamHandler(sys.stdout)]
+    if LOG_FILE:
+        handlers.append(
+            logging.handlers.RotatingFileHandler(
+                LOG_FILE,
+                maxBytes=LOG_FILE_MAX_BYTES,
+                backupCount=LOG_FILE_BACKUPS,
+                encoding="utf-8",
+            )
+        )
+    sampler = PayloadSampler()
+    for handler in handlers:
+        handler.setFormatter(formatter)
+        handler.addFilter(sampler)
+
+    log_queue: queue.Queue = queue.Queue(LOG_QUEUE_SIZE)
+    discord_logger = logging.getLogger("discord")
+    discord_logger.addHandler(LazyQueueHandler(log_queue))
+    discord_logger.setLevel(logging.WARNING)
+    discord_logger.propagate = False
+    logging.getLogger(logger_name).setLevel(LOG_LEVEL)
+    logging.getLogger("aiohttp.client").setLevel(logging.ERROR)
+
+    listener = logging.handlers.QueueListener(
+        log_queue, *handlers, respect_handler_level=True
+    )
+    listener.start()
+    return listener
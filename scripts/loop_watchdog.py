@@ -0,0 +1,150 @@
+"""
+This file contains the watchdog of the event loop.
+A task on the loop wakes up every WATCHDOG_INTERVAL seconds and records how late it woke up in a histogram:
+any blocking call (a synchronous HTTP request, a large json.dumps, a slow regex) delays it. A helper thread
+watches the time of its last wake up, and once the loop has been stuck for WATCHDOG_THRESHOLD seconds it
+logs the stack of the loop's thread and the task that is running, which is the code blocking the loop, while
+it is still blocking. The discord.py warnings about a blocked gateway heartbeat, which come before the
+"Attempting to reconnect" disconnections, are counted as well.
+"""
+
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from typing import Optional
+
+from metrics import registry
+
+# Seconds between two wake ups of the loop probe, 0 disables the watchdog
+WATCHDOG_INTERVAL = float(os.getenv("WATCHDOG_INTERVAL", "0.25"))
+# Seconds the loop has to be stuck before the blocking stack is logged
+WATCHDOG_THRESHOLD = float(os.getenv("WATCHDOG_THRESHOLD", "1"))
+
+# Upper bounds (in seconds) of the buckets of the loop lag histogram
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+loop_lag_seconds = registry.histogram(
+    "event_loop_lag_seconds",
+    "Delay of the wake ups of the event loop probe",
+    buckets=LAG_BUCKETS,
+)
+loop_blocked = registry.counter(
+    "event_loop_blocked_total",
+    "Times the event loop was stuck for longer than the watchdog threshold",
+)
+heartbeat_blocked = registry.counter(
+    "gateway_heartbeat_blocked_total",
+    "Warnings of discord.py about a gateway heartbeat blocked by the event loop",
+)
+
+
+class HeartbeatBlockedFilter(logging.Filter):
+    """Counts the heartbeat blocked warnings of the discord.gateway logger, every record passes."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno == logging.WARNING and "heartbeat blocked" in str(record.msg):
+            heartbeat_blocked.inc()
+        return True
+
+
+class LoopWatchdog:
+    """
+    Measures the lag of the event loop and logs the stack of what blocks it.
+
+    Args:
+        logger (logging.Logger): The logger of the blocking stacks.
+        interval (float): The seconds between two wake ups of the probe, 0 disables the watchdog.
+        threshold (float): The seconds the loop has to be stuck before its stack is logged.
+
+    Attributes:
+        blocked (int): The number of times the loop was stuck for longer than the threshold.
+
+    Methods:
+        start: Starts the probe on the running loop and the helper thread.
+        stop: Stops the probe and the helper thread.
+    """
+
+    def __init__(
+        self,
+        logger: logging.Logger,
+        interval: float = WATCHDOG_INTERVAL,
+        threshold: float = WATCHDOG_THRESHOLD,
+    ):
+        self.logger = logger
+        self.interval = interval
+        self.threshold = threshold
+        self.blocked = 0
+        self._beat = 0.0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread = 0
+        self._probe: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        """Starts the probe on the running loop and the helper thread, unless the interval is 0."""
+        if not self.interval or self._probe is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stopped.clear()
+        self._probe = asyncio.create_task(self._run_probe())
+        self._thread = threading.Thread(
+            target=self._watch, name="loop-watchdog", daemon=True
+        )
+        self._thread.start()
+
+    async def stop(self):
+        """Stops the probe and the helper thread."""
+        self._stopped.set()
+        if self._probe is not None:
+            self._probe.cancel()
+            try:
+                await self._probe
+            except asyncio.CancelledError:
+                pass
+            self._probe = None
+        if self._thread is not None:
+            await asyncio.to_thread(self._thread.join)
+            self._thread = None
+
+    async def _run_probe(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            loop_lag_seconds.observe(max(0.0, now - expected))
+            self._beat = now
+
+    def _watch(self):
+        # The beat at which the stack was last logged, a stuck loop is only reported once
+        reported = 0.0
+        while not self._stopped.wait(self.interval):
+            beat = self._beat
+            stuck = time.monotonic() - beat - self.interval
+            if stuck < self.threshold or beat == reported:
+                continue
+            reported = beat
+            self.blocked += 1
+            loop_blocked.inc()
+            self.logger.warning(
+                "Event loop blocked for %.2f seconds so far, in task %s\n%s",
+                stuck,
+                self._running_task(),
+                self._loop_stack(),
+            )
+
+    def _running_task(self) -> str:
+        task = asyncio.current_task(self._loop)
+        return task.get_name() if task is not None else "none"
+
+    def _loop_stack(self) -> str:
+        frame = sys._current_frames().get(self._loop_thread)
+        if frame is None:
+            return "(the stack of the loop is not available)"
+        return "".join(traceback.format_stack(frame))
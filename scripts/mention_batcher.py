@@ -0,0 +1,108 @@
+"""
+This file contains the batching of the messages that mention the bot (or are sent to it in a DM).
+Mentions in the same channel that arrive within a short window are debounced into one batch, so a burst
+of mentions is answered by a single request to the LLM backend instead of one request per message.
+A batch is flushed when no new mention arrived for the debounce window, when it waited for the maximum
+delay, or when it is full.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from typing import Awaitable, Callable
+
+import discord
+
+MENTION_BATCH_WINDOW = float(os.getenv("MENTION_BATCH_WINDOW", "1.5"))
+MENTION_BATCH_MAX_WAIT = float(os.getenv("MENTION_BATCH_MAX_WAIT", "5"))
+MENTION_BATCH_MAX = int(os.getenv("MENTION_BATCH_MAX", "10"))
+
+
+class _Batch:
+    """The mentions of a channel waiting to be answered."""
+
+    def __init__(self):
+        self.messages: list[discord.Message] = []
+        self.started_at = time.monotonic()
+        self.timer: asyncio.TimerHandle = None
+
+
+class MentionBatcher:
+    """
+    Debounces the mentions of every channel into batches.
+
+    Args:
+        handler (Callable): A coroutine function called with the messages of a batch, oldest first.
+        logger (logging.Logger): The logger of the errors the handler raises.
+        window (float): The amount of seconds without a new mention after which a batch is flushed.
+        max_wait (float): The maximum amount of seconds a batch waits after its first mention.
+        max_batch (int): The maximum number of messages in a batch.
+
+    Attributes:
+        batches (int): The number of batches flushed.
+        messages (int): The number of messages batched.
+
+    Methods:
+        add: Adds a mention to the batch of its channel.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[list[discord.Message]], Awaitable[None]],
+        logger: logging.Logger,
+        window: float = MENTION_BATCH_WINDOW,
+        max_wait: float = MENTION_BATCH_MAX_WAIT,
+        max_batch: int = MENTION_BATCH_MAX,
+    ):
+        self.handler = handler
+        self.logger = logger
+        self.window = window
+        self.max_wait = max_wait
+        self.max_batch = max_batch
+        self.batches = 0
+        self.messages = 0
+        self._pending: dict[int, _Batch] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    def add(self, message: discord.Message):
+        """
+        Adds a mention to the batch of its channel and (re)starts the debounce timer.
+
+        Args:
+            message (discord.Message): The message that mentions the bot.
+        """
+        channel_id = message.channel.id
+        batch = self._pending.get(channel_id)
+        if batch is None:
+            batch = self._pending[channel_id] = _Batch()
+        batch.messages.append(message)
+        self.messages += 1
+
+        if batch.timer is not None:
+            batch.timer.cancel()
+        if len(batch.messages) >= self.max_batch:
+            self._flush(channel_id)
+            return
+        remaining = batch.started_at + self.max_wait - time.monotonic()
+        batch.timer = asyncio.get_running_loop().call_later(
+            max(0.0, min(self.window, remaining)), self._flush, channel_id
+        )
+
+    def _flush(self, channel_id: int):
+        batch = self._pending.pop(channel_id, None)
+        if batch is None:
+            return
+        self.batches += 1
+        task = asyncio.create_task(self.handler(batch.messages))
+        # Keep a reference so the task is not garbage collected while it runs
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        task.add_done_callback(self._log_error)
+
+    def _log_error(self, task: asyncio.Task):
+        # Nothing awaits the handler, its errors would otherwise only show up when the task is collected
+        if not task.cancelled() and task.exception() is not None:
+            self.logger.error(
+                "Failed to answer a batch of mentions", exc_info=task.exception()
+            )
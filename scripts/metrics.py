@@ -0,0 +1,304 @@
+"""
+This file contains the metrics of the bot and the small HTTP server that exposes them to Prometheus.
+The hot path records into counters and histograms kept in plain dictionaries (a lookup and an increment per
+sample), labelled by the command being served, which every command sets once in a context variable. The
+counters the other parts of the bot already keep (caches, edits, backends, views) are not copied: they are
+plugged in as collectors, read only when the metrics are scraped.
+"""
+
+import bisect
+import contextvars
+import os
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator, Optional
+
+from aiohttp import web
+
+# Port of the /metrics endpoint, 0 disables the server
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+# Prefix of the name of every metric
+PREFIX = "discord_ai_bot_"
+
+# Upper bounds (in seconds) of the buckets of the latency histograms
+LATENCY_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    120,
+    300,
+    600,
+)
+
+# The command being served, the label of every metric recorded while serving it
+command: contextvars.ContextVar[str] = contextvars.ContextVar(
+    "metrics_command", default="none"
+)
+
+# A metric read from a collector: name, type, help and the labels and value of every sample
+Metric = tuple[str, str, str, list[tuple[dict, float]]]
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """
+    A counter with labels.
+
+    Args:
+        name (str): The name of the metric.
+        help (str): The description of the metric.
+        labels (tuple[str, ...]): The names of the labels.
+
+    Methods:
+        inc: Increments the counter of the given label values.
+    """
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *values: str, amount: float = 1):
+        """
+        Increments the counter of the given label values.
+
+        Args:
+            *values (str): The values of the labels, in order.
+            amount (float): The amount added.
+        """
+        self._values[values] = self._values.get(values, 0) + amount
+
+    def render(self) -> Iterator[str]:
+        """Yields the lines of the metric in the Prometheus text format."""
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for values, value in list(self._values.items()):
+            yield f"{self.name}{_format_labels(self.labels, values)} {value}"
+
+
+class Histogram:
+    """
+    A histogram with labels.
+
+    Args:
+        name (str): The name of the metric.
+        help (str): The description of the metric.
+        labels (tuple[str, ...]): The names of the labels.
+        buckets (tuple[float, ...]): The upper bounds of the buckets, in increasing order.
+
+    Methods:
+        observe: Records a value for the given label values.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # Per label values: the count of every bucket (the last one is +Inf), the sum and the count
+        self._values: dict[tuple, list] = {}
+
+    def observe(self, value: float, *values: str):
+        """
+        Records a value for the given label values.
+
+        Args:
+            value (float): The value, in seconds for the latency histograms.
+            *values (str): The values of the labels, in order.
+        """
+        series = self._values.get(values)
+        if series is None:
+            series = self._values[values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self) -> Iterator[str]:
+        """Yields the lines of the metric in the Prometheus text format."""
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for values, (counts, total, count) in list(self._values.items()):
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                labels = _format_labels(self.labels, values, f'le="{le}"')
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labels, values)
+            yield f"{self.name}_sum{labels} {total}"
+            yield f"{self.name}_count{labels} {count}"
+
+
+class MetricsRegistry:
+    """
+    The metrics of the bot and the HTTP server that exposes them.
+
+    Methods:
+        counter: Creates a counter.
+        histogram: Creates a histogram.
+        collector: Plugs in a function that reads metrics kept elsewhere.
+        render: Returns every metric in the Prometheus text format.
+        start: Starts the /metrics server.
+        close: Stops the /metrics server.
+    """
+
+    def __init__(self):
+        self._metrics: list = []
+        self._collectors: list[Callable[[], Iterable[Metric]]] = []
+        self._runner: Optional[web.AppRunner] = None
+
+    def counter(self, name: str, help: str, labels: tuple[str, ...] = ()) -> Counter:
+        """Creates a counter, see Counter."""
+        metric = Counter(PREFIX + name, help, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        """Creates a latency histogram, see Histogram."""
+        metric = Histogram(PREFIX + name, help, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def collector(self, collect: Callable[[], Iterable[Metric]]):
+        """
+        Plugs in a function that reads metrics kept elsewhere, called on every scrape.
+
+        Args:
+            collect (Callable): A function that returns the metrics, as (name, type, help, samples) tuples.
+        """
+        self._collectors.append(collect)
+
+    def render(self) -> str:
+        """
+        Returns every metric in the Prometheus text format.
+
+        Returns:
+            str: The body of the /metrics response.
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collect in self._collectors:
+            for name, kind, help, samples in collect():
+                lines.append(f"# HELP {PREFIX}{name} {help}")
+                lines.append(f"# TYPE {PREFIX}{name} {kind}")
+                for labels, value in samples:
+                    names, values = tuple(labels), tuple(labels.values())
+                    lines.append(
+                        f"{PREFIX}{name}{_format_labels(names, values)} {value}"
+                    )
+        lines.append("")
+        return "\n".join(lines)
+
+    async def start(self, host: str = METRICS_HOST, port: int = METRICS_PORT):
+        """
+        Starts the /metrics server, unless the port is 0.
+
+        Args:
+            host (str): The address the server listens on.
+            port (int): The port the server listens on.
+        """
+        if not port or self._runner is not None:
+            return
+
+        async def handle(request: web.Request) -> web.Response:
+            return web.Response(
+                text=self.render(), content_type="text/plain", charset="utf-8"
+            )
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+    async def close(self):
+        """Stops the /metrics server."""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+registry = MetricsRegistry()
+
+stage_seconds = registry.histogram(
+    "stage_seconds",
+    "Time spent in every stage of a command",
+    ("command", "stage", "model"),
+)
+backend_seconds = registry.histogram(
+    "backend_seconds",
+    "Time until the first byte and until the end of the OpenWebUI requests",
+    ("command", "endpoint", "model", "phase"),
+)
+backend_errors = registry.counter(
+    "backend_errors_total",
+    "Failed OpenWebUI requests, by reason",
+    ("command", "endpoint", "model", "reason"),
+)
+gateway_events = registry.counter(
+    "gateway_events_total", "Events received from the Discord gateway", ("event",)
+)
+
+
+def observe_stage(stage: str, seconds: float, model: str = ""):
+    """
+    Records the time spent in a stage of the current command.
+
+    Args:
+        stage (str): The name of the stage.
+        seconds (float): The time spent in the stage.
+        model (str): The model used by the stage, if any.
+    """
+    stage_seconds.observe(seconds, command.get(), stage, model)
+
+
+@contextmanager
+def timed_stage(stage: str, model: str = "") -> Iterator[None]:
+    """
+    Records the time spent in the block as a stage of the current command.
+
+    Args:
+        stage (str): The name of the stage.
+        model (str): The model used by the stage, if any.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - started, model)
@@ -0,0 +1,173 @@
+"""
+This file contains the shared HTTP client that the bot uses for every call to the OpenWebUI API.
+A single aiohttp session is created when the bot starts and closed when it shuts down, so requests
+reuse pooled keep-alive connections and cached DNS lookups instead of paying for a new TCP/TLS handshake each time.
+Every endpoint has its own timeout so a slow image generation can not hold the same budget as a file download.
+Every request goes to a backend picked by the backend pool, which also learns from the outcome of the request.
+The resilience layer of the client adapts the timeouts to the latencies of every model and retries (or
+hedges) the requests that are safe to send again, see resilience.py.
+"""
+
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+import aiohttp
+from backend_pool import Backend, BackendPool
+from metrics import backend_errors, backend_seconds, command
+from resilience import Resilience, Timeouts
+
+# Connection pool settings
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "100"))
+HTTP_POOL_SIZE_PER_HOST = int(os.getenv("HTTP_POOL_SIZE_PER_HOST", "20"))
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "60"))
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", "300"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+
+# Total timeout (in seconds) of each kind of request
+ENDPOINT_TIMEOUTS = {
+    "chat": float(os.getenv("OPENWEBUI_CHAT_TIMEOUT", "600")),
+    "image": float(os.getenv("OPENWEBUI_IMAGE_TIMEOUT", "600")),
+    "download": float(os.getenv("OPENWEBUI_DOWNLOAD_TIMEOUT", "60")),
+}
+
+
+class OpenWebUIClient:
+    """
+    A pooled HTTP client for the OpenWebUI API.
+
+    Args:
+        backends (list[Backend]): The OpenWebUI instances the requests are spread over.
+
+    Attributes:
+        pool (BackendPool): The pool that picks the backend of every request.
+        resilience (Resilience): The adaptive timeouts, retries and hedges of the requests.
+        session (Optional[aiohttp.ClientSession]): The shared session, None until start is called.
+    """
+
+    def __init__(self, backends: list[Backend]):
+        self.pool = BackendPool(backends)
+        self.resilience = Resilience(HTTP_CONNECT_TIMEOUT)
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    async def start(self):
+        """Creates the shared session and its connection pool, and starts the health probes."""
+        if self.session is not None and not self.session.closed:
+            return
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_SIZE,
+            limit_per_host=HTTP_POOL_SIZE_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+            use_dns_cache=True,
+        )
+        self.session = aiohttp.ClientSession(connector=connector)
+        self.pool.start(self.session)
+
+    async def close(self):
+        """Stops the health probes and closes the shared session and every pooled connection."""
+        await self.pool.close()
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    @staticmethod
+    def timeout(endpoint: str) -> aiohttp.ClientTimeout:
+        """
+        Builds the timeout of the given kind of endpoint.
+
+        Args:
+            endpoint (str): The kind of endpoint ("chat", "image" or "download").
+
+        Returns:
+            aiohttp.ClientTimeout: The timeout to use for the request.
+        """
+        return aiohttp.ClientTimeout(
+            total=ENDPOINT_TIMEOUTS[endpoint], sock_connect=HTTP_CONNECT_TIMEOUT
+        )
+
+    @asynccontextmanager
+    async def request(
+        self,
+        method: str,
+        path: str,
+        endpoint: str,
+        model: Optional[str] = None,
+        backend: Optional[Backend] = None,
+        timeouts: Optional[Timeouts] = None,
+        **kwargs,
+    ) -> AsyncIterator[aiohttp.ClientResponse]:
+        """
+        Sends a request to the OpenWebUI API through the shared session.
+
+        Args:
+            method (str): The HTTP method.
+            path (str): The path of the API endpoint, appended to the base URL of the backend.
+            endpoint (str): The kind of endpoint, used to pick the timeout.
+            model (Optional[str]): The model of the request, only backends that serve it are picked.
+            backend (Optional[Backend]): The backend to use instead of picking one, for a file it generated.
+            timeouts (Optional[Timeouts]): The timeouts given by the resilience layer, the static timeout of
+                the endpoint otherwise. The time of the first byte is written to them.
+            **kwargs: Extra arguments passed to aiohttp (json, headers, ...).
+
+        Yields:
+            aiohttp.ClientResponse: The response of the API.
+
+        Raises:
+            NoBackendError: If no available backend serves the model.
+        """
+        if self.session is None or self.session.closed:
+            await self.start()
+        if backend is None:
+            backend = self.pool.pick(model)
+        headers = {"Authorization": f"Bearer {backend.api_key}"}
+        headers.update(kwargs.pop("headers", {}))
+
+        timeout = (
+            self.timeout(endpoint) if timeouts is None else timeouts.client_timeout()
+        )
+
+        labels = (command.get(), endpoint, model or "")
+        started = time.monotonic()
+
+        backend.outstanding += 1
+        failed: Optional[bool] = False
+        try:
+            async with self.session.request(
+                method, backend.url + path, headers=headers, timeout=timeout, **kwargs
+            ) as response:
+                first_byte_at = time.monotonic()
+                if timeouts is not None:
+                    timeouts.set_first_byte(first_byte_at)
+                backend_seconds.observe(first_byte_at - started, *labels, "first_byte")
+                failed = response.status >= 500
+                if failed:
+                    backend_errors.inc(*labels, f"status_{response.status}")
+                yield response
+            backend_seconds.observe(time.monotonic() - started, *labels, "total")
+        except asyncio.TimeoutError:
+            failed = True
+            backend_errors.inc(*labels, "timeout")
+            raise
+        except aiohttp.ClientError:
+            failed = True
+            backend_errors.inc(*labels, "connection")
+            raise
+        except asyncio.CancelledError:
+            # A hedged request that lost the race says nothing about the backend
+            failed = None
+            raise
+        finally:
+            backend.outstanding -= 1
+            if failed is not None:
+                self.pool.record(backend, not failed)
+
+    def post(self, path: str, endpoint: str, **kwargs):
+        """Sends a POST request, see request."""
+        return self.request("POST", path, endpoint, **kwargs)
+
+    def get(self, path: str, endpoint: str, **kwargs):
+        """Sends a GET request, see request."""
+        return self.request("GET", path, endpoint, **kwargs)
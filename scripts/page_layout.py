@@ -0,0 +1,260 @@
+"""
+This file contains the layout of an answer into the pages shown by the pagination.
+The answer and the thought process are split on paragraph, line, sentence and word boundaries (in that
+order of preference), never inside a markdown link, and a code block that does not fit on a page is closed
+at the end of the page and opened again, with its language, on the next one.
+Every page respects the limits of a Discord embed, including the 6000 characters of the whole embed, so
+the answer fills as few pages as possible and none of them is rejected. The pages are laid out once per
+answer and kept compressed, so turning a page only inflates the embed of that page.
+"""
+
+import json
+import zlib
+from typing import Optional
+
+import discord
+
+# Limits of a Discord embed
+EMBED_TITLE_LIMIT = 256
+EMBED_DESCRIPTION_LIMIT = 4096
+EMBED_FIELD_LIMIT = 1024
+EMBED_TOTAL_LIMIT = 6000
+
+THOUGHT_NAME = "Thought process"
+QUESTION_NAME = "Question"
+SOURCES_NAME = "Sources"
+
+# Room kept for the part counter of the thought process and for the page footer
+THOUGHT_NAME_RESERVE = len(f"{THOUGHT_NAME} (Part 999 of 999)")
+FOOTER_RESERVE = len("Page 999 from 999")
+
+FENCE = "```"
+CLOSING_FENCE = "\n```"
+ELLIPSIS = "…"
+
+
+def part_string(current_part: int, amount_of_parts: int) -> str:
+    """
+    Generate a string indicating the current part number and total number of parts.
+
+    Args:
+        current_part (int): The current part number (1-based index).
+        amount_of_parts (int): The total number of parts.
+
+    Returns:
+        str: A string indicating the current part number and total number of parts, or an empty string if there is only one part.
+    """
+    if amount_of_parts == 1:
+        return ""
+    return f" (Part {current_part} of {amount_of_parts})"
+
+
+def _open_fence(text: str) -> Optional[str]:
+    # Returns the opening line of the code block the text ends in, if any
+    opener = None
+    for line in text.split("\n"):
+        stripped = line.strip()
+        if stripped.startswith(FENCE):
+            opener = stripped if opener is None else None
+    return opener
+
+
+def _boundary(text: str, limit: int) -> int:
+    # Returns where the text is cut so the first part has at most limit characters
+    window = text[:limit]
+    minimum = limit // 2
+    for separator in ("\n\n", "\n"):
+        position = window.rfind(separator)
+        if position >= minimum:
+            return position + len(separator)
+    position = max(window.rfind(mark) for mark in (". ", "! ", "? "))
+    if position >= minimum:
+        return position + 2
+    position = window.rfind(" ")
+    if position >= minimum:
+        # Do not cut the text of a markdown link, move the whole link to the next part
+        opening = window.rfind("[", 0, position)
+        if opening > window.rfind("]", 0, position) and opening >= minimum:
+            return opening
+        return position + 1
+    return limit
+
+
+def take_chunk(text: str, limit: int) -> tuple[str, str]:
+    """
+    Takes the first chunk of a text, cut on the best boundary before the limit.
+
+    Args:
+        text (str): The text to split.
+        limit (int): The maximum size of the chunk.
+
+    Returns:
+        tuple: The chunk and the rest of the text, which reopens the code block the chunk was cut in.
+    """
+    if len(text) <= limit:
+        return text, ""
+    cut = _boundary(text, limit)
+    if _open_fence(text[:cut]) is not None:
+        # Make room to close the code block
+        cut = _boundary(text, limit - len(CLOSING_FENCE))
+        fence = _open_fence(text[:cut])
+        if fence is not None:
+            return text[:cut].rstrip("\n") + CLOSING_FENCE, f"{fence}\n{text[cut:]}"
+    return text[:cut].rstrip(), text[cut:].lstrip()
+
+
+def split_text(text: str, limit: int) -> list[str]:
+    """
+    Splits a text into chunks on paragraph, line, sentence and word boundaries.
+
+    Args:
+        text (str): The text to split.
+        limit (int): The maximum size of a chunk.
+
+    Returns:
+        list[str]: The chunks of the text.
+    """
+    chunks = []
+    while text:
+        chunk, text = take_chunk(text, limit)
+        chunks.append(chunk)
+    return chunks
+
+
+def shorten(text: str, limit: int) -> str:
+    """
+    Shortens a text to a limit, keeping whole lines when possible.
+
+    Args:
+        text (str): The text to shorten.
+        limit (int): The maximum size of the result.
+
+    Returns:
+        str: The text itself if it fits, otherwise its first lines followed by an ellipsis.
+    """
+    if len(text) <= limit:
+        return text
+    position = text.rfind("\n", 0, limit - len(ELLIPSIS))
+    if position <= 0:
+        return text[: limit - len(ELLIPSIS)] + ELLIPSIS
+    return text[:position] + "\n" + ELLIPSIS
+
+
+def layout_pages(
+    title: str, awnser: str, thought: str, sources: str, prompt: str
+) -> list[discord.Embed]:
+    """
+    Lays an answer out into the embeds of its pages.
+
+    Page N shows the Nth chunk of the answer and of the thought process, followed by the question and the
+    sources. The answer chunks get the room the other parts of their embed leave.
+
+    Args:
+        title (str): The title of the embeds.
+        awnser (str): The answer, without its thought process.
+        thought (str): The thought process of the model.
+        sources (str): The formatted sources of the answer.
+        prompt (str): The question that was answered.
+
+    Returns:
+        list[discord.Embed]: The embeds of the pages, at least one.
+    """
+    title = shorten(title, EMBED_TITLE_LIMIT)
+    question = shorten(prompt, EMBED_FIELD_LIMIT)
+    sources = shorten(sources, EMBED_FIELD_LIMIT)
+    fixed = len(title) + len(QUESTION_NAME) + len(question) + FOOTER_RESERVE
+    if sources:
+        fixed += len(SOURCES_NAME) + len(sources)
+
+    thoughts = split_text(thought, EMBED_FIELD_LIMIT)
+    pages: list[tuple[str, Optional[str]]] = []
+    while awnser or len(pages) < len(thoughts):
+        thought_chunk = thoughts[len(pages)] if len(pages) < len(thoughts) else None
+        room = EMBED_TOTAL_LIMIT - fixed
+        if thought_chunk is not None:
+            room -= THOUGHT_NAME_RESERVE + len(thought_chunk)
+        chunk, awnser = take_chunk(awnser, min(EMBED_DESCRIPTION_LIMIT, room))
+        pages.append((chunk, thought_chunk))
+    if not pages:
+        pages.append(("", None))
+
+    embeds = []
+    for number, (chunk, thought_chunk) in enumerate(pages, start=1):
+        emb = discord.Embed(title=title, description=chunk)
+        if thought_chunk is not None:
+            emb.add_field(
+                name=f"{THOUGHT_NAME}{part_string(number, len(thoughts))}",
+                value=thought_chunk,
+                inline=False,
+            )
+        emb.add_field(name=QUESTION_NAME, value=question, inline=False)
+        if sources:
+            emb.add_field(name=SOURCES_NAME, value=sources, inline=False)
+        if len(pages) > 1:
+            emb.set_footer(text=f"Page {number} from {len(pages)}")
+        embeds.append(emb)
+    return embeds
+
+
+class CompressedPages:
+    """
+    The embeds of the pages of an answer, every page compressed on its own.
+
+    Args:
+        embeds (list[discord.Embed]): The embeds of the pages.
+
+    Attributes:
+        size (int): The size of the compressed pages.
+        compressed (list[bytes]): The compressed pages, in order.
+
+    Methods:
+        from_compressed: Rebuilds the pages from their compressed form.
+        embed: Returns the embed of a page.
+    """
+
+    __slots__ = ("_pages", "size")
+
+    def __init__(self, embeds: list[discord.Embed]):
+        self._pages = [
+            zlib.compress(json.dumps(emb.to_dict(), separators=(",", ":")).encode())
+            for emb in embeds
+        ]
+        self.size = sum(len(page) for page in self._pages)
+
+    @classmethod
+    def from_compressed(cls, pages: list[bytes]) -> "CompressedPages":
+        """
+        Rebuilds the pages from their compressed form.
+
+        Args:
+            pages (list[bytes]): The compressed pages, as returned by compressed.
+
+        Returns:
+            CompressedPages: The pages.
+        """
+        self = cls.__new__(cls)
+        self._pages = pages
+        self.size = sum(len(page) for page in pages)
+        return self
+
+    @property
+    def compressed(self) -> list[bytes]:
+        """The compressed pages, in order."""
+        return self._pages
+
+    def __len__(self) -> int:
+        return len(self._pages)
+
+    def embed(self, page: int) -> discord.Embed:
+        """
+        Returns the embed of a page.
+
+        Args:
+            page (int): The page number, starting at 1.
+
+        Returns:
+            discord.Embed: The embed of the page.
+        """
+        return discord.Embed.from_dict(
+            json.loads(zlib.decompress(self._pages[page - 1]))
+        )
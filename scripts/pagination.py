@@ -4,9 +4,14 @@ Posted by Hazzu, modified by community. See post 'Timeline' for change history
 Retrieved 2026-01-23, License - CC BY-SA 4.0
 """
 
-from typing import Callable, Optional
+import re
+from functools import partial
+from typing import Awaitable, Callable, Optional
 
 import discord
+from edit_coalescer import EditCoalescer
+from metrics import command
+from view_registry import ViewRegistry
 
 
 class Pagination(discord.ui.View):
@@ -14,14 +19,25 @@ class Pagination(discord.ui.View):
     A pagination view for Discord interactions.
 
     Args:
-        interaction (discord.Interaction): The initial interaction that triggered the pagination.
+        interaction (discord.Interaction): The initial interaction that triggered the pagination, None when replying to a message.
         get_page (Callable): A callable function that returns the current page's embed and total pages.
         generate_chat_response (Callable): A callable function that generates a chat response based on the user's input.
+        reply_to (Optional[discord.Message]): The message to reply to instead of editing the interaction's response.
+        users (Optional[set[int]]): The IDs of the users allowed to use the buttons, defaults to the author.
+        edits (Optional[EditCoalescer]): The coalescer of the response the first page replaces (the queue position
+            or the streamed preview), the view paces its own edits with a coalescer of its own.
+        registry (Optional[ViewRegistry]): The registry that bounds the live views, the caller registers the view.
 
     Attributes:
         interaction (discord.Interaction): The initial interaction that triggered the pagination.
         get_page (Callable): A callable function that returns the current page's embed and total pages.
         generate_chat_response (Callable): A callable function that generates a chat response based on the user's input.
+        reply_to (Optional[discord.Message]): The message the pagination replies to.
+        message (Optional[discord.PartialMessage]): The message of the view, once it is sent.
+        users (set[int]): The IDs of the users allowed to use the buttons.
+        edits (EditCoalescer): The coalescer of the edits of the message, fast clicks only send the last page.
+        registry (Optional[ViewRegistry]): The registry that bounds the live views.
+        stored (bool): Whether the answer is in the answer store, so the buttons work without this view.
         total_pages (Optional[int]): The total number of pages.
         index (int): The current page index.
 
@@ -36,6 +52,9 @@ class Pagination(discord.ui.View):
         end: Handles the end page button click.
         retry: Handles the retry button click.
         on_timeout: Removes the buttons on timeout.
+        remove_buttons: Removes the buttons from the message, when the view is evicted or times out.
+        replaced: Stops the view when a retry shows a new one on its message.
+        evicted: Called by the registry when the view is evicted.
         compute_total_pages: Computes the total number of pages based on the total results and results per page.
     """
 
@@ -45,17 +64,33 @@ class Pagination(discord.ui.View):
         get_page: Callable,
         generate_chat_response: Callable,
         logger: Callable,
+        reply_to: Optional[discord.Message] = None,
+        users: Optional[set[int]] = None,
+        edits: Optional[EditCoalescer] = None,
+        registry: Optional[ViewRegistry] = None,
     ):
         self.interaction = interaction
         self.get_page = get_page
         self.generate_chat_response = generate_chat_response
         self.logger = logger
+        self.reply_to = reply_to
+        self.message: Optional[discord.PartialMessage] = None
+        if users is None:
+            author = interaction.user if interaction is not None else reply_to.author
+            users = {author.id}
+        self.users = users
+        # The first page goes through the coalescer of the response so it replaces whatever is still waiting,
+        # the page turns get the normal interval and not the one of a streamed preview
+        self.edits = EditCoalescer()
+        self._first_edits = edits or self.edits
+        self.registry = registry
+        self.stored = False
         self.total_pages: Optional[int] = None
         self.index = 1
         super().__init__(timeout=100)
 
     async def interaction_check(self, interaction: discord.Interaction) -> bool:
-        if interaction.user == self.interaction.user:
+        if interaction.user.id in self.users:
             return True
         else:
             emb = discord.Embed(
@@ -72,12 +107,34 @@ class Pagination(discord.ui.View):
 
         self.update_buttons()
         self.timeout = None
-        await self.interaction.edit_original_response(embed=emb, view=self)
+        if self.reply_to is not None:
+            self._keep_message(await self.reply_to.reply(embed=emb, view=self))
+        else:
+
+            async def send():
+                self._keep_message(
+                    await self.interaction.edit_original_response(embed=emb, view=self)
+                )
+
+            # Replaces the queue position or the streamed preview that may still be waiting
+            self._first_edits.submit(send)
+            await self._first_edits.flush()
+
+    def _keep_message(self, message: discord.Message):
+        # Only the IDs are kept, the full message would retain the content of the answer
+        self.message = message.channel.get_partial_message(message.id)
 
     async def edit_page(self, interaction: discord.Interaction):
+        command.set("pagination")
         emb, self.total_pages = await self.get_page(self.index)
         self.update_buttons()
-        await interaction.response.edit_message(embed=emb, view=self)
+        if self.registry is not None:
+            self.registry.touch(self)
+        # Acknowledge the click at once, the edit itself is coalesced with the next clicks
+        await interaction.response.defer()
+        self.edits.submit(
+            partial(interaction.edit_original_response, embed=emb, view=self)
+        )
 
     def update_buttons(self):
         if self.total_pages == 1:
@@ -92,17 +149,23 @@ class Pagination(discord.ui.View):
         self.children[0].disabled = self.index == 1
         self.children[1].disabled = self.index == self.total_pages
 
-    @discord.ui.button(emoji="◀️", style=discord.ButtonStyle.blurple)
+    @discord.ui.button(
+        emoji="◀️", style=discord.ButtonStyle.blurple, custom_id="pagination:previous"
+    )
     async def previous(self, interaction: discord.Interaction, button: discord.Button):
         self.index -= 1
         await self.edit_page(interaction)
 
-    @discord.ui.button(emoji="▶️", style=discord.ButtonStyle.blurple)
+    @discord.ui.button(
+        emoji="▶️", style=discord.ButtonStyle.blurple, custom_id="pagination:next"
+    )
     async def next(self, interaction: discord.Interaction, button: discord.Button):
         self.index += 1
         await self.edit_page(interaction)
 
-    @discord.ui.button(emoji="⏭️", style=discord.ButtonStyle.blurple)
+    @discord.ui.button(
+        emoji="⏭️", style=discord.ButtonStyle.blurple, custom_id="pagination:end"
+    )
     async def end(self, interaction: discord.Interaction, button: discord.Button):
         if self.index <= self.total_pages // 2:
             self.index = self.total_pages
@@ -110,7 +173,9 @@ class Pagination(discord.ui.View):
             self.index = 1
         await self.edit_page(interaction)
 
-    @discord.ui.button(emoji="↩️", style=discord.ButtonStyle.blurple)
+    @discord.ui.button(
+        emoji="↩️", style=discord.ButtonStyle.blurple, custom_id="pagination:retry"
+    )
     async def retry(self, interaction: discord.Interaction, button: discord.Button):
         embeds = interaction.message.embeds
 
@@ -118,17 +183,116 @@ class Pagination(discord.ui.View):
             for field in embed.fields:
                 if field.name == "Question":
                     self.children[3].disabled = True
-                    self.logger.info(f"Retry prompt: {field.value}")
+                    self.replaced()
+                    self.logger.info("Retry prompt: %s", field.value)
                     interaction.message.channel.typing()
-                    await self.generate_chat_response(interaction, field.value)
+                    # A retry asks the LLM again instead of returning the cached answer
+                    await self.generate_chat_response(
+                        interaction, field.value, use_cache=False
+                    )
 
         # await self.edit_page(interaction)
 
     async def on_timeout(self):
         # remove buttons on timeout
-        message = await self.interaction.original_response()
-        await message.edit(view=None)
+        if self.registry is not None:
+            self.registry.remove(self)
+        await self.remove_buttons()
+
+    def replaced(self):
+        # The retry shows a new view on the same message
+        self.stop()
+        if self.registry is not None:
+            self.registry.remove(self)
+
+    async def evicted(self):
+        # A stored answer keeps its buttons, the StoredPagination restores the view on the next click
+        if not self.stored:
+            await self.remove_buttons()
+
+    async def remove_buttons(self):
+        if self.message is not None:
+            self.edits.submit(partial(self.message.edit, view=None))
+        else:
+            self.edits.submit(
+                partial(self.interaction.edit_original_response, view=None)
+            )
+        try:
+            await self.edits.flush()
+        except discord.HTTPException:
+            # The message may have been deleted
+            pass
 
     @staticmethod
     def compute_total_pages(total_results: int, results_per_page: int) -> int:
         return ((total_results - 1) // results_per_page) + 1
+
+
+# Matches the footer of the embeds of an answer with several pages
+FOOTER_PAGE = re.compile(r"Page (\d+) from \d+")
+
+
+def current_page(message: discord.Message) -> int:
+    """
+    Reads the page a message shows from the footer of its embed.
+
+    Args:
+        message (discord.Message): The message of the answer.
+
+    Returns:
+        int: The page number, 1 when the answer has a single page.
+    """
+    for embed in message.embeds:
+        match = FOOTER_PAGE.fullmatch(embed.footer.text or "")
+        if match:
+            return int(match.group(1))
+    return 1
+
+
+class StoredPagination(Pagination):
+    """
+    The persistent view that answers the buttons of the messages without a live view.
+
+    It is added once in setup_hook. On a click it restores the live view of the message from the answer
+    store and hands it the click, the next clicks go straight to the restored view.
+
+    Args:
+        restore (Callable): A coroutine function that restores the view of the clicked message, or returns None.
+        generate_chat_response (Callable): A callable function that generates a chat response based on the user's input.
+        logger (Callable): The logger.
+    """
+
+    def __init__(
+        self,
+        restore: Callable[[discord.Interaction], Awaitable[Optional[Pagination]]],
+        generate_chat_response: Callable,
+        logger: Callable,
+    ):
+        super().__init__(None, None, generate_chat_response, logger, users=set())
+        self.timeout = None
+        self.restore = restore
+
+    def replaced(self):
+        # The persistent view serves every message, a retry must not stop it
+        pass
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        custom_id = interaction.data.get("custom_id")
+        view = await self.restore(interaction)
+        if view is None:
+            if custom_id == self.retry.custom_id:
+                # The retry only needs the question shown in the message
+                return True
+            emb = discord.Embed(
+                description="This answer is no longer available, use ↩️ to ask again.",
+                color=16711680,
+            )
+            await interaction.response.send_message(embed=emb, ephemeral=True)
+            return False
+
+        for item in view.children:
+            if getattr(item, "custom_id", None) == custom_id:
+                if await view.interaction_check(interaction):
+                    await item.callback(interaction)
+        # The restored view handled the click
+        return False
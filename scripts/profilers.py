@@ -0,0 +1,258 @@
+"""
+This file contains the on-demand profilers behind the owner's !profile and !memory commands.
+Nothing is hooked into the interpreter until a command starts a profiler, and every profiler is removed as soon
+as it is done, so the bot runs at full speed the rest of the time. The CPU profilers are time-boxed: "sample"
+looks at the stack of the event loop's thread from a helper thread every few milliseconds (low overhead,
+safe in production), "cpu" runs cProfile on the event loop's thread (exact call counts, slower). The memory
+profiler takes tracemalloc snapshots and compares them to the one taken when it started. Reports are
+returned as files, to be sent as attachments.
+"""
+
+import asyncio
+import collections
+import cProfile
+import io
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Optional
+
+# Longest a CPU profile can run, in seconds
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "120"))
+# Number of entries of every report
+PROFILE_TOP = int(os.getenv("PROFILE_TOP", "30"))
+# Seconds between two samples of the sampling profiler
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.005"))
+# Number of frames tracemalloc keeps for every allocation
+TRACEMALLOC_FRAMES = int(os.getenv("TRACEMALLOC_FRAMES", "10"))
+
+# A report attachment: the file name and its content
+Report = tuple[str, bytes]
+
+
+class ProfilerBusyError(Exception):
+    """Raised when a CPU profile is started while another one is running."""
+
+
+class ProfilerStateError(Exception):
+    """Raised when the memory profiler is used in the wrong state, like a diff before it was started."""
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+
+class Profiler:
+    """
+    Profiles the CPU and the memory of the bot on demand.
+
+    Args:
+        top (int): The number of entries of every report.
+        max_seconds (float): The longest a CPU profile can run.
+
+    Attributes:
+        running (Optional[str]): The kind of CPU profile running, if any.
+
+    Methods:
+        sample: Samples the stack of the event loop for a while.
+        cprofile: Runs cProfile on the event loop for a while.
+        memory_start: Starts tracemalloc and takes the reference snapshot.
+        memory_diff: Compares a new snapshot to the reference one.
+        memory_stop: Stops tracemalloc.
+    """
+
+    def __init__(
+        self, top: int = PROFILE_TOP, max_seconds: float = PROFILE_MAX_SECONDS
+    ):
+        self.top = top
+        self.max_seconds = max_seconds
+        self.running: Optional[str] = None
+        self._baseline: Optional[tracemalloc.Snapshot] = None
+        self._baseline_at = 0.0
+
+    def _claim(self, kind: str, seconds: float) -> float:
+        if self.running is not None:
+            raise ProfilerBusyError(f"A {self.running} profile is already running")
+        self.running = kind
+        return min(max(seconds, 0.1), self.max_seconds)
+
+    async def sample(
+        self, seconds: float, interval: float = PROFILE_SAMPLE_INTERVAL
+    ) -> list[Report]:
+        """
+        Samples the stack of the event loop's thread from a helper thread.
+
+        Args:
+            seconds (float): How long to sample, capped at max_seconds.
+            interval (float): The seconds between two samples.
+
+        Returns:
+            list[Report]: The top functions by own and total samples, and the collapsed stacks of every
+            sample (the input format of flamegraph.pl and speedscope).
+
+        Raises:
+            ProfilerBusyError: If another CPU profile is running.
+        """
+        seconds = self._claim("sample", seconds)
+        loop_thread = threading.get_ident()
+        stacks: collections.Counter = collections.Counter()
+        stopped = threading.Event()
+
+        def run():
+            while not stopped.wait(interval):
+                frame = sys._current_frames().get(loop_thread)
+                names = []
+                while frame is not None:
+                    names.append(_frame_name(frame))
+                    frame = frame.f_back
+                stacks[tuple(reversed(names))] += 1
+
+        thread = threading.Thread(target=run, name="profile-sampler", daemon=True)
+        thread.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            stopped.set()
+            await asyncio.to_thread(thread.join)
+            self.running = None
+        return await asyncio.to_thread(self._sample_reports, stacks, seconds)
+
+    def _sample_reports(
+        self, stacks: collections.Counter, seconds: float
+    ) -> list[Report]:
+        total = sum(stacks.values())
+        own: collections.Counter = collections.Counter()
+        inclusive: collections.Counter = collections.Counter()
+        for stack, count in stacks.items():
+            if stack:
+                own[stack[-1]] += count
+            for name in set(stack):
+                inclusive[name] += count
+
+        lines = [
+            f"{total} samples of the event loop thread in {seconds:.1f} seconds",
+            "",
+        ]
+        for title, counter in (("Own samples", own), ("Total samples", inclusive)):
+            lines.append(f"{title}:")
+            for name, count in counter.most_common(self.top):
+                lines.append(f"{count / max(total, 1):7.1%} {count:8} {name}")
+            lines.append("")
+        collapsed = "".join(
+            ";".join(stack) + f" {count}\n" for stack, count in stacks.items()
+        )
+        return [
+            ("profile_sample.txt", "\n".join(lines).encode()),
+            ("profile_sample.collapsed", collapsed.encode()),
+        ]
+
+    async def cprofile(self, seconds: float) -> list[Report]:
+        """
+        Runs cProfile on the event loop's thread, so it sees every callback and task of the loop.
+
+        Args:
+            seconds (float): How long to profile, capped at max_seconds.
+
+        Returns:
+            list[Report]: The top functions by cumulative and own time, and the raw statistics (readable
+            with pstats or snakeviz).
+
+        Raises:
+            ProfilerBusyError: If another CPU profile is running.
+        """
+        seconds = self._claim("cpu", seconds)
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                profile.disable()
+        finally:
+            self.running = None
+        return await asyncio.to_thread(self._cprofile_reports, profile)
+
+    def _cprofile_reports(self, profile: cProfile.Profile) -> list[Report]:
+        text = io.StringIO()
+        stats = pstats.Stats(profile, stream=text)
+        for order in ("cumulative", "tottime"):
+            stats.sort_stats(order).print_stats(self.top)
+        return [
+            ("profile_cpu.txt", text.getvalue().encode()),
+            ("profile_cpu.pstats", marshal.dumps(stats.stats)),
+        ]
+
+    def memory_start(self, frames: int = TRACEMALLOC_FRAMES):
+        """
+        Starts tracemalloc and takes the snapshot the next diffs are compared to.
+
+        Args:
+            frames (int): The number of frames kept for every allocation.
+
+        Raises:
+            ProfilerStateError: If tracemalloc is already tracing.
+        """
+        if tracemalloc.is_tracing():
+            raise ProfilerStateError("Memory tracing is already running")
+        tracemalloc.start(frames)
+        self._baseline = tracemalloc.take_snapshot()
+        self._baseline_at = time.monotonic()
+
+    async def memory_diff(self) -> list[Report]:
+        """
+        Takes a snapshot and compares it to the one taken when the tracing started.
+
+        Returns:
+            list[Report]: The lines and the stacks that allocated the most since then.
+
+        Raises:
+            ProfilerStateError: If the tracing was not started.
+        """
+        if self._baseline is None or not tracemalloc.is_tracing():
+            raise ProfilerStateError("Memory tracing is not running")
+        # Taking the snapshot copies the traces and has to stay on the loop, comparing them does not
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        return await asyncio.to_thread(
+            self._memory_reports, snapshot, self._baseline, current, peak
+        )
+
+    def _memory_reports(
+        self,
+        snapshot: tracemalloc.Snapshot,
+        baseline: tracemalloc.Snapshot,
+        current: int,
+        peak: int,
+    ) -> list[Report]:
+        ignored = (
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<unknown>"),
+        )
+        snapshot = snapshot.filter_traces(ignored)
+        baseline = baseline.filter_traces(ignored)
+        elapsed = time.monotonic() - self._baseline_at
+        lines = [
+            f"Traced memory: {current / 1024 / 1024:.1f} MiB, peak {peak / 1024 / 1024:.1f} MiB",
+            f"Compared to the snapshot of {elapsed:.0f} seconds ago",
+            "",
+            "Top lines:",
+        ]
+        lines.extend(
+            str(stat) for stat in snapshot.compare_to(baseline, "lineno")[: self.top]
+        )
+        lines.extend(["", "Top stacks:"])
+        for stat in snapshot.compare_to(baseline, "traceback")[: self.top]:
+            lines.append(str(stat))
+            lines.extend(f"    {line}" for line in stat.traceback.format())
+        return [("memory_diff.txt", "\n".join(lines).encode())]
+
+    def memory_stop(self):
+        """Stops tracemalloc and drops its snapshots."""
+        tracemalloc.stop()
+        self._baseline = None
@@ -0,0 +1,359 @@
+"""
+This file contains the resilience layer of the requests to the OpenWebUI API.
+Every request has a connect, a first byte and a total timeout; the first byte and total timeouts follow a
+rolling window of the latencies of the model (a multiple of their p99, within bounds), so a stuck request
+is given up long before the static timeout while a slow model still gets the time it usually needs. The first
+byte timeout is a deadline for the start of the response, the gaps between two reads have their own timeout. A
+request that times out widens the next timeouts of its model at once, to twice the one that expired, and the
+widening decays with every request that succeeds, so the timeouts follow answers that get longer.
+Failures that are safe to repeat (5xx and connection errors) are retried with a jittered exponential
+backoff, and a request that takes longer than the p95 of its model can be hedged: a second request is sent
+and the first answer wins. Hedges are paid from a budget refilled by every request, so they can not
+amplify the load on the backends.
+"""
+
+import asyncio
+import os
+import random
+import time
+from collections import deque
+from typing import Awaitable, Callable, Optional, TypeVar
+
+import aiohttp
+
+RESILIENCE_RETRIES = int(os.getenv("RESILIENCE_RETRIES", "2"))
+RESILIENCE_BACKOFF_BASE = float(os.getenv("RESILIENCE_BACKOFF_BASE", "0.5"))
+RESILIENCE_BACKOFF_MAX = float(os.getenv("RESILIENCE_BACKOFF_MAX", "8"))
+RESILIENCE_TIMEOUT_MULTIPLIER = float(os.getenv("RESILIENCE_TIMEOUT_MULTIPLIER", "3"))
+RESILIENCE_MIN_TIMEOUT = float(os.getenv("RESILIENCE_MIN_TIMEOUT", "30"))
+RESILIENCE_MIN_CHAT_TIMEOUT = float(os.getenv("RESILIENCE_MIN_CHAT_TIMEOUT", "300"))
+RESILIENCE_MIN_SAMPLES = int(os.getenv("RESILIENCE_MIN_SAMPLES", "20"))
+RESILIENCE_WINDOW = int(os.getenv("RESILIENCE_WINDOW", "200"))
+RESILIENCE_HEDGE = os.getenv("RESILIENCE_HEDGE", "false").lower() == "true"
+RESILIENCE_HEDGE_BUDGET = float(os.getenv("RESILIENCE_HEDGE_BUDGET", "0.05"))
+RESILIENCE_READ_TIMEOUT = float(os.getenv("RESILIENCE_READ_TIMEOUT", "120"))
+
+# Maximum amount of hedges that can be saved up in the budget
+HEDGE_BURST = 5
+
+# After a timeout the next timeouts are at least this many times the one that expired
+WIDEN_FACTOR = 2
+# Share of the widening kept after every request that succeeds
+WIDEN_DECAY = 0.9
+
+# Status codes of the failures that are worth retrying
+RETRY_STATUSES = {500, 502, 503, 504}
+
+T = TypeVar("T")
+
+
+class RetryableStatusError(Exception):
+    """Raised by a request that got a status code worth retrying."""
+
+    def __init__(self, status: int):
+        super().__init__(f"Status code {status}")
+        self.status = status
+
+
+class StreamInterruptedError(Exception):
+    """Raised when a streamed response fails after part of it was shown, it is never retried."""
+
+
+# Failures after which a request is sent again
+RETRYABLE_ERRORS = (RetryableStatusError, aiohttp.ClientConnectionError)
+
+
+class LatencyWindow:
+    """
+    The latencies of the last requests.
+
+    Args:
+        size (int): The number of latencies kept.
+    """
+
+    def __init__(self, size: int = RESILIENCE_WINDOW):
+        self._samples: deque[float] = deque(maxlen=size)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def record(self, seconds: float):
+        """Adds a latency."""
+        self._samples.append(seconds)
+
+    def percentile(self, fraction: float) -> float:
+        """
+        Returns a percentile of the latencies.
+
+        Args:
+            fraction (float): The percentile, from 0 to 1.
+
+        Returns:
+            float: The latency below which the given fraction of the requests finished.
+        """
+        samples = sorted(self._samples)
+        return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+
+class Timeouts:
+    """
+    The timeouts of a request, filled with the time of its first byte by the client.
+
+    Attributes:
+        connect (float): The seconds allowed to open a connection.
+        first_byte (float): The seconds allowed until the response starts.
+        total (float): The seconds allowed for the whole request.
+        read (float): The seconds allowed between two reads of the response.
+        hedge (bool): Whether the request is the hedge of another one, it must not repeat its side effects.
+        started_at (float): The monotonic time at which the request started.
+        first_byte_at (Optional[float]): The monotonic time at which the response started.
+    """
+
+    def __init__(
+        self,
+        connect: float,
+        first_byte: float,
+        total: float,
+        read: float = RESILIENCE_READ_TIMEOUT,
+    ):
+        self.connect = connect
+        self.first_byte = first_byte
+        self.total = total
+        self.read = read
+        self.hedge = False
+        self.started_at = time.monotonic()
+        self.first_byte_at: Optional[float] = None
+        self.first_byte_event = asyncio.Event()
+
+    def set_first_byte(self, at: float):
+        """Records the monotonic time at which the response started."""
+        self.first_byte_at = at
+        self.first_byte_event.set()
+
+    def client_timeout(self) -> aiohttp.ClientTimeout:
+        """Builds the aiohttp timeout of the request, the first byte deadline is kept by the resilience layer."""
+        return aiohttp.ClientTimeout(
+            total=self.total, sock_connect=self.connect, sock_read=self.read
+        )
+
+
+class Resilience:
+    """
+    Runs requests with adaptive timeouts, retries and hedging.
+
+    Args:
+        connect_timeout (float): The seconds allowed to open a connection.
+        retries (int): The number of times a failed request is sent again.
+        hedge (bool): Whether slow requests are hedged.
+        hedge_budget (float): The share of the requests that can be hedged.
+
+    Attributes:
+        requests (int): The number of requests run.
+        retries_sent (int): The number of retries sent.
+        hedges_sent (int): The number of hedges sent.
+        hedges_won (int): The number of hedges that answered first.
+
+    Methods:
+        timeouts: Builds the timeouts of a request.
+        run: Runs a request with retries and, optionally, hedging.
+    """
+
+    def __init__(
+        self,
+        connect_timeout: float,
+        retries: int = RESILIENCE_RETRIES,
+        hedge: bool = RESILIENCE_HEDGE,
+        hedge_budget: float = RESILIENCE_HEDGE_BUDGET,
+    ):
+        self.connect_timeout = connect_timeout
+        self.retries = retries
+        self.hedge = hedge
+        self.hedge_budget = hedge_budget
+        self.requests = 0
+        self.retries_sent = 0
+        self.hedges_sent = 0
+        self.hedges_won = 0
+        self._hedge_tokens = 1.0
+        self._first_byte: dict[str, LatencyWindow] = {}
+        self._total: dict[str, LatencyWindow] = {}
+        # Minimum of the next timeouts of every key that timed out recently
+        self._widened: dict[str, float] = {}
+
+    def timeouts(
+        self, key: str, limit: float, floor: float = RESILIENCE_MIN_TIMEOUT
+    ) -> Timeouts:
+        """
+        Builds the timeouts of a request from the latencies of the previous ones.
+
+        Args:
+            key (str): The kind of request, usually the model and the endpoint.
+            limit (float): The static timeout, used until there are enough latencies and as an upper bound.
+            floor (float): The minimum of the adaptive timeouts.
+
+        Returns:
+            Timeouts: The timeouts of the request.
+        """
+        floor = max(floor, self._widened.get(key, 0.0))
+        return Timeouts(
+            self.connect_timeout,
+            self._adapt(self._first_byte.get(key), limit, floor),
+            self._adapt(self._total.get(key), limit, floor),
+        )
+
+    async def run(
+        self,
+        key: str,
+        limit: float,
+        request: Callable[[Timeouts], Awaitable[T]],
+        hedge: bool = False,
+        retry: bool = True,
+        floor: float = RESILIENCE_MIN_TIMEOUT,
+    ) -> T:
+        """
+        Runs a request, sending it again after a failure worth retrying.
+
+        Args:
+            key (str): The kind of request, usually the model and the endpoint.
+            limit (float): The static timeout of the request.
+            request (Callable): A coroutine function that sends the request with the given timeouts.
+                It raises RetryableStatusError for a status code worth retrying.
+            hedge (bool): Whether the request can be hedged, only for requests that do not show partial results.
+            retry (bool): Whether the request can be sent again, only for requests without side effects.
+            floor (float): The minimum of the adaptive timeouts, higher for requests whose length varies a lot.
+
+        Returns:
+            T: The result of the first request that succeeded.
+
+        Raises:
+            RetryableStatusError, aiohttp.ClientConnectionError: If the last retry failed too.
+            asyncio.TimeoutError: If the response did not start or finish in time.
+        """
+        self.requests += 1
+        self._hedge_tokens = min(HEDGE_BURST, self._hedge_tokens + self.hedge_budget)
+        retries = self.retries if retry else 0
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                self.retries_sent += 1
+                await asyncio.sleep(self._backoff(attempt))
+            try:
+                if hedge and self.hedge:
+                    return await self._hedged(key, limit, request, floor)
+                return await self._attempt(key, limit, request, floor)
+            except RETRYABLE_ERRORS:
+                if attempt == retries:
+                    raise
+
+    def _adapt(
+        self, window: Optional[LatencyWindow], limit: float, floor: float
+    ) -> float:
+        if window is None or len(window) < RESILIENCE_MIN_SAMPLES:
+            return limit
+        timeout = window.percentile(0.99) * RESILIENCE_TIMEOUT_MULTIPLIER
+        return min(limit, max(floor, timeout))
+
+    def _backoff(self, retry: int) -> float:
+        # Full jitter, so the retries of many requests do not arrive together
+        ceiling = min(
+            RESILIENCE_BACKOFF_MAX, RESILIENCE_BACKOFF_BASE * 2 ** (retry - 1)
+        )
+        return random.uniform(0, ceiling)
+
+    async def _attempt(
+        self,
+        key: str,
+        limit: float,
+        request: Callable[[Timeouts], Awaitable[T]],
+        floor: float,
+        hedge: bool = False,
+    ) -> T:
+        timeouts = self.timeouts(key, limit, floor)
+        timeouts.hedge = hedge
+        task = asyncio.ensure_future(request(timeouts))
+        try:
+            started = asyncio.ensure_future(timeouts.first_byte_event.wait())
+            try:
+                await asyncio.wait(
+                    {task, started},
+                    timeout=timeouts.first_byte,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+            finally:
+                started.cancel()
+            if not task.done() and timeouts.first_byte_at is None:
+                raise asyncio.TimeoutError()
+            remaining = timeouts.total - (time.monotonic() - timeouts.started_at)
+            result = await asyncio.wait_for(task, max(0.0, remaining))
+        except asyncio.TimeoutError:
+            self._timed_out(key, limit, timeouts)
+            raise
+        finally:
+            if not task.done():
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        finished_at = time.monotonic()
+        first_byte = None
+        if timeouts.first_byte_at is not None:
+            first_byte = timeouts.first_byte_at - timeouts.started_at
+        self._record(key, first_byte, finished_at - timeouts.started_at)
+        widened = self._widened.pop(key, None)
+        if widened is not None and widened * WIDEN_DECAY > floor:
+            self._widened[key] = widened * WIDEN_DECAY
+        return result
+
+    def _timed_out(self, key: str, limit: float, timeouts: Timeouts):
+        first_byte = timeouts.first_byte
+        if timeouts.first_byte_at is not None:
+            first_byte = timeouts.first_byte_at - timeouts.started_at
+        self._record(key, first_byte, timeouts.total)
+        # A single sample hardly moves the p99 of a full window, so the next timeouts are widened at once
+        expired = timeouts.total if timeouts.first_byte_at else timeouts.first_byte
+        self._widened[key] = min(
+            limit, max(self._widened.get(key, 0.0), expired * WIDEN_FACTOR)
+        )
+
+    def _record(self, key: str, first_byte: Optional[float], total: float):
+        if first_byte is not None:
+            self._first_byte.setdefault(key, LatencyWindow()).record(first_byte)
+        self._total.setdefault(key, LatencyWindow()).record(total)
+
+    async def _hedged(
+        self,
+        key: str,
+        limit: float,
+        request: Callable[[Timeouts], Awaitable[T]],
+        floor: float,
+    ) -> T:
+        window = self._total.get(key)
+        delay = None
+        if window is not None and len(window) >= RESILIENCE_MIN_SAMPLES:
+            delay = window.percentile(0.95)
+
+        primary = asyncio.create_task(self._attempt(key, limit, request, floor))
+        pending = {primary}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=delay)
+            if not done and self._hedge_tokens >= 1:
+                self._hedge_tokens -= 1
+                self.hedges_sent += 1
+                pending.add(
+                    asyncio.create_task(
+                        self._attempt(key, limit, request, floor, hedge=True)
+                    )
+                )
+            while True:
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self.hedges_won += 1
+                        return task.result()
+                    error = task.exception()
+                if not pending:
+                    raise error
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+        finally:
+            # The slower request is not needed anymore
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
@@ -0,0 +1,227 @@
+"""
+This file contains the cache of the answers to /question, so a question that was already asked does not go to the LLM again.
+Entries are keyed on the normalized prompt, the model and the enabled features, they expire after a TTL,
+and the least recently used ones are evicted once the cache uses more memory than allowed.
+The cache can be backed by a SQLite file so it survives restarts and is shared by the workers of a cluster; the
+file is only used from a worker thread, so disk I/O never blocks the event loop.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1000"))
+RESPONSE_CACHE_MAX_BYTES = int(
+    os.getenv("RESPONSE_CACHE_MAX_BYTES", str(32 * 1024 * 1024))
+)
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH", "")
+
+
+def normalize_prompt(prompt: str) -> str:
+    """
+    Normalizes a prompt so questions that only differ in case or spacing share a cache entry.
+
+    Args:
+        prompt (str): The prompt to normalize.
+
+    Returns:
+        str: The prompt in lower case with every run of whitespace replaced by a single space.
+    """
+    return " ".join(prompt.casefold().split())
+
+
+def make_key(prompt: str, model: str, features: dict) -> str:
+    """
+    Builds the cache key of a chat request.
+
+    Args:
+        prompt (str): The user's prompt.
+        model (str): The name of the model.
+        features (dict): The features enabled in the request.
+
+    Returns:
+        str: The SHA-256 hex digest of the normalized request.
+    """
+    identity = json.dumps(
+        [normalize_prompt(prompt), model, features], sort_keys=True, ensure_ascii=False
+    )
+    return hashlib.sha256(identity.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    An LRU cache with a TTL per entry and an optional SQLite backing store.
+
+    Args:
+        ttl (float): The amount of seconds an entry is valid, 0 disables the cache.
+        max_entries (int): The maximum amount of entries kept in memory.
+        max_bytes (int): The maximum size of the entries kept in memory.
+        path (str): The path of the SQLite file, an empty string keeps the cache in memory only.
+
+    Attributes:
+        hits (int): The number of lookups that found a valid entry.
+        misses (int): The number of lookups that did not.
+        evictions (int): The number of entries removed to respect the memory bounds.
+        size (int): The size of the entries kept in memory.
+    """
+
+    def __init__(
+        self,
+        ttl: float = RESPONSE_CACHE_TTL,
+        max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+        max_bytes: int = RESPONSE_CACHE_MAX_BYTES,
+        path: str = RESPONSE_CACHE_PATH,
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = 0
+        self._entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        """Whether the cache stores anything."""
+        return self.ttl > 0
+
+    async def open(self):
+        """Opens the backing store and removes its expired entries."""
+        if self.enabled and self.path and self._db is None:
+            await asyncio.to_thread(self._open_db)
+
+    async def close(self):
+        """Closes the backing store."""
+        if self._db is not None:
+            await asyncio.to_thread(self._close_db)
+
+    async def get(self, key: str) -> Optional[dict]:
+        """
+        Looks up a response.
+
+        Args:
+            key (str): The key built by make_key.
+
+        Returns:
+            Optional[dict]: The cached response, or None if there is no valid entry.
+        """
+        if not self.enabled:
+            return None
+
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] < time.time():
+            self._remove(key)
+            entry = None
+        if entry is None and self._db is not None:
+            entry = await asyncio.to_thread(self._db_get, key)
+            if entry is not None:
+                self._store(key, *entry)
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        if key in self._entries:
+            self._entries.move_to_end(key)
+        self.hits += 1
+        return json.loads(entry[1])
+
+    async def set(self, key: str, response: dict):
+        """
+        Stores a response.
+
+        Args:
+            key (str): The key built by make_key.
+            response (dict): The response of the OpenWebUI API.
+        """
+        if not self.enabled:
+            return
+        expires_at = time.time() + self.ttl
+        value = json.dumps(response, separators=(",", ":"), ensure_ascii=False)
+        self._store(key, expires_at, value)
+        if self._db is not None:
+            await asyncio.to_thread(self._db_set, key, expires_at, value)
+
+    def stats(self) -> dict:
+        """
+        Returns the counters of the cache.
+
+        Returns:
+            dict: The hits, misses, hit ratio, evictions, entries and size of the cache.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self.size,
+        }
+
+    def _store(self, key: str, expires_at: float, value: str):
+        if key in self._entries:
+            self._remove(key)
+        if len(value) > self.max_bytes:
+            return
+        self._entries[key] = (expires_at, value)
+        self.size += len(value)
+        while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key: str):
+        _, value = self._entries.pop(key)
+        self.size -= len(value)
+
+    def _open_db(self):
+        with self._db_lock:
+            self._db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            # WAL lets the workers of a cluster read the file while one of them writes it
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, expires_at REAL NOT NULL, value TEXT NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS responses_expires_at ON responses (expires_at)"
+            )
+            self._db.execute(
+                "DELETE FROM responses WHERE expires_at < ?", (time.time(),)
+            )
+            self._db.commit()
+
+    def _close_db(self):
+        with self._db_lock:
+            self._db.close()
+            self._db = None
+
+    def _db_get(self, key: str) -> Optional[tuple[float, str]]:
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT expires_at, value FROM responses WHERE key = ? AND expires_at >= ?",
+                (key, time.time()),
+            ).fetchone()
+        return row
+
+    def _db_set(self, key: str, expires_at: float, value: str):
+        with self._db_lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, expires_at, value) VALUES (?, ?, ?)",
+                (key, expires_at, value),
+            )
+            self._db.execute(
+                "DELETE FROM responses WHERE expires_at < ?", (time.time(),)
+            )
+            self._db.commit()
@@ -0,0 +1,224 @@
+"""
+This file contains the scheduler that bounds how many requests the bot sends to the LLM backend at the same time.
+Requests above the concurrency cap wait in a queue that is served by priority, and within a priority
+round robin between guilds and then between the users of a guild, so a single busy guild or user
+can not starve the others. When the queue is full new requests are rejected instead of piling up
+until they all time out. Waiting requests are told their position whenever it changes.
+When the bot runs as a cluster, a request that got its slot also takes one of the limit shared by the workers.
+"""
+
+import asyncio
+import os
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Hashable, Optional
+
+from cluster_state import SharedLimiter
+from metrics import timed_stage
+
+SCHEDULER_CONCURRENCY = int(os.getenv("SCHEDULER_CONCURRENCY", "4"))
+SCHEDULER_MAX_QUEUE = int(os.getenv("SCHEDULER_MAX_QUEUE", "100"))
+SCHEDULER_POSITION_INTERVAL = float(os.getenv("SCHEDULER_POSITION_INTERVAL", "2"))
+
+# Priorities, a lower value is served first
+PRIORITY_DM = 0
+PRIORITY_GUILD = 1
+
+
+class SchedulerFullError(Exception):
+    """Raised when a request is rejected because the queue is full."""
+
+
+class _Ticket:
+    """A request waiting for a slot."""
+
+    def __init__(self, priority: int, guild: Hashable, user: Hashable):
+        self.priority = priority
+        self.guild = guild
+        self.user = user
+        self.granted: asyncio.Future = asyncio.get_running_loop().create_future()
+
+
+class BackendScheduler:
+    """
+    A concurrency limiter with a bounded, fair and prioritized queue.
+
+    Args:
+        concurrency (int): The maximum number of requests running at the same time.
+        max_queue (int): The maximum number of waiting requests.
+        position_interval (float): The minimum amount of seconds between two queue position updates.
+        shared (Optional[SharedLimiter]): The limit shared with the other workers of a cluster, if any.
+
+    Attributes:
+        active (int): The number of requests running.
+        queued (int): The number of requests waiting.
+        rejected (int): The number of requests rejected because the queue was full.
+
+    Methods:
+        slot: Waits for a slot and holds it for the duration of the context.
+        position: The position of a ticket in the queue.
+    """
+
+    def __init__(
+        self,
+        concurrency: int = SCHEDULER_CONCURRENCY,
+        max_queue: int = SCHEDULER_MAX_QUEUE,
+        position_interval: float = SCHEDULER_POSITION_INTERVAL,
+        shared: Optional[SharedLimiter] = None,
+    ):
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.position_interval = position_interval
+        self.shared = shared
+        self.active = 0
+        self.queued = 0
+        self.rejected = 0
+        # priority -> guild -> user -> tickets, the first guild and user are served next
+        self._queues: dict[int, OrderedDict[Hashable, OrderedDict[Hashable, deque]]] = (
+            {}
+        )
+
+    @asynccontextmanager
+    async def slot(
+        self,
+        guild: Hashable,
+        user: Hashable,
+        priority: int = PRIORITY_GUILD,
+        on_position: Optional[Callable[[int], Awaitable[None]]] = None,
+    ) -> AsyncIterator[None]:
+        """
+        Waits for a slot and holds it for the duration of the context.
+
+        Args:
+            guild (Hashable): The guild the request comes from, None for DMs.
+            user (Hashable): The user that sent the request.
+            priority (int): The priority of the request, a lower value is served first.
+            on_position (Optional[Callable]): A coroutine function called with the 1-based queue position
+                while the request waits, at most once per position_interval seconds.
+
+        Raises:
+            SchedulerFullError: If the queue is full.
+        """
+        with timed_stage("queue"):
+            await self._acquire(guild, user, priority, on_position)
+            shared_slot = None
+            if self.shared is not None:
+                try:
+                    shared_slot = await self.shared.acquire()
+                except BaseException:
+                    self._release()
+                    raise
+        try:
+            yield
+        finally:
+            try:
+                if shared_slot is not None:
+                    await self.shared.release(shared_slot)
+            finally:
+                self._release()
+
+    def position(self, ticket: _Ticket) -> int:
+        """
+        Computes the position of a ticket by replaying the order in which the queue is served.
+
+        Args:
+            ticket (_Ticket): The waiting ticket.
+
+        Returns:
+            int: The 1-based position of the ticket, 0 if it is not queued.
+        """
+        position = 0
+        for priority in sorted(self._queues):
+            guilds = [
+                [deque(tickets) for tickets in users.values()]
+                for users in self._queues[priority].values()
+            ]
+            while guilds:
+                users = guilds.pop(0)
+                tickets = users.pop(0)
+                position += 1
+                if tickets.popleft() is ticket:
+                    return position
+                if tickets:
+                    users.append(tickets)
+                if users:
+                    guilds.append(users)
+        return 0
+
+    async def _acquire(self, guild, user, priority, on_position):
+        if self.active < self.concurrency and self.queued == 0:
+            self.active += 1
+            return
+        if self.queued >= self.max_queue:
+            self.rejected += 1
+            raise SchedulerFullError(f"The queue is full ({self.queued} requests)")
+
+        ticket = _Ticket(priority, guild, user)
+        self._enqueue(ticket)
+        last_position = 0
+        try:
+            while True:
+                if on_position is not None:
+                    position = self.position(ticket)
+                    if position != last_position:
+                        last_position = position
+                        await on_position(position)
+                done, _ = await asyncio.wait(
+                    [ticket.granted], timeout=self.position_interval
+                )
+                if done:
+                    return
+        except BaseException:
+            if ticket.granted.done() and not ticket.granted.cancelled():
+                # The slot was handed over while this request was being cancelled
+                self._release()
+            else:
+                ticket.granted.cancel()
+                self._dequeue(ticket)
+            raise
+
+    def _release(self):
+        self.active -= 1
+        ticket = self._next()
+        if ticket is not None:
+            self.active += 1
+            ticket.granted.set_result(None)
+
+    def _enqueue(self, ticket: _Ticket):
+        guilds = self._queues.setdefault(ticket.priority, OrderedDict())
+        users = guilds.setdefault(ticket.guild, OrderedDict())
+        users.setdefault(ticket.user, deque()).append(ticket)
+        self.queued += 1
+
+    def _dequeue(self, ticket: _Ticket):
+        guilds = self._queues.get(ticket.priority, {})
+        users = guilds.get(ticket.guild, {})
+        tickets = users.get(ticket.user)
+        if tickets is None or ticket not in tickets:
+            return
+        tickets.remove(ticket)
+        self.queued -= 1
+        self._prune(ticket.priority, ticket.guild, ticket.user)
+
+    def _next(self) -> Optional[_Ticket]:
+        for priority in sorted(self._queues):
+            guilds = self._queues[priority]
+            guild, users = next(iter(guilds.items()))
+            user, tickets = next(iter(users.items()))
+            ticket = tickets.popleft()
+            self.queued -= 1
+            # Round robin: the guild and the user go to the back of their queues
+            users.move_to_end(user)
+            guilds.move_to_end(guild)
+            self._prune(priority, guild, user)
+            return ticket
+        return None
+
+    def _prune(self, priority, guild, user):
+        guilds = self._queues[priority]
+        if not guilds[guild][user]:
+            del guilds[guild][user]
+        if not guilds[guild]:
+            del guilds[guild]
+        if not guilds:
+            del self._queues[priority]
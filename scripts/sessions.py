@@ -0,0 +1,181 @@
+"""
+This file contains the conversation sessions of the channels and threads the bot is talking in.
+A session keeps the messages of the conversation in an append-only list that is sent again, in the same
+order, with every new turn, so the prompt of a turn starts with the prompt of the previous one and the
+backend can reuse its prefix (KV) cache instead of prefilling the whole conversation again.
+Sessions are capped in turns and size; when a cap is reached the oldest half of the conversation is
+dropped at once, so the prefix only changes once every many turns. Idle sessions are evicted.
+"""
+
+import asyncio
+import os
+import time
+import uuid
+from collections import OrderedDict
+from typing import Optional
+
+SESSION_MAX_TURNS = int(os.getenv("SESSION_MAX_TURNS", "20"))
+SESSION_MAX_BYTES = int(os.getenv("SESSION_MAX_BYTES", str(64 * 1024)))
+SESSION_IDLE_TIMEOUT = float(os.getenv("SESSION_IDLE_TIMEOUT", "3600"))
+SESSION_MAX_SESSIONS = int(os.getenv("SESSION_MAX_SESSIONS", "1000"))
+
+
+class ConversationSession:
+    """
+    The conversation of a channel or thread.
+
+    Attributes:
+        chat_id (str): The ID of the chat in OpenWebUI.
+        messages (list[dict]): The messages of the conversation, in the order they are sent.
+        size (int): The size of the content of the messages.
+        turns (int): The number of turns (a user message and its answer) in the conversation.
+        compactions (int): The number of times the oldest turns were dropped.
+        created_at (float): The time at which the session was created.
+        last_used (float): The monotonic time at which the session was last used.
+        lock (asyncio.Lock): Serializes the turns, so they are appended in order.
+    """
+
+    def __init__(self):
+        self.chat_id = str(uuid.uuid4())
+        self.messages: list[dict] = []
+        self.size = 0
+        self.turns = 0
+        self.compactions = 0
+        self.created_at = time.time()
+        self.last_used = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def request_messages(self, content: str) -> list[dict]:
+        """
+        Builds the messages of the next turn.
+
+        Args:
+            content (str): The new user message.
+
+        Returns:
+            list[dict]: The messages of the conversation followed by the new user message.
+        """
+        return self.messages + [{"role": "user", "content": content}]
+
+    def append_turn(self, content: str, awnser: str, max_turns: int, max_bytes: int):
+        """
+        Appends a turn to the conversation, dropping the oldest half of it if a cap is reached.
+
+        Args:
+            content (str): The user message of the turn.
+            awnser (str): The answer of the model, without its thought process.
+            max_turns (int): The maximum number of turns.
+            max_bytes (int): The maximum size of the conversation.
+        """
+        self.messages.append({"role": "user", "content": content})
+        self.messages.append({"role": "assistant", "content": awnser})
+        self.size += len(content) + len(awnser)
+        self.turns += 1
+        if self.turns > max_turns or self.size > max_bytes:
+            self._compact(max_turns // 2, max_bytes // 2)
+
+    def _compact(self, max_turns: int, max_bytes: int):
+        while self.turns > 0 and (self.turns > max_turns or self.size > max_bytes):
+            user, assistant = self.messages[0], self.messages[1]
+            del self.messages[:2]
+            self.size -= len(user["content"]) + len(assistant["content"])
+            self.turns -= 1
+        self.compactions += 1
+
+
+class SessionStore:
+    """
+    The conversation sessions, keyed by channel or thread ID.
+
+    Args:
+        max_turns (int): The maximum number of turns of a session.
+        max_bytes (int): The maximum size of a session.
+        idle_timeout (float): The amount of seconds after which an unused session is evicted.
+        max_sessions (int): The maximum number of sessions, the least recently used are evicted.
+
+    Methods:
+        get: Returns the session of a channel, creating it if needed.
+        peek: Returns the session of a channel without creating it.
+        reset: Removes the session of a channel.
+        append_turn: Appends a turn to a session, respecting the caps.
+    """
+
+    def __init__(
+        self,
+        max_turns: int = SESSION_MAX_TURNS,
+        max_bytes: int = SESSION_MAX_BYTES,
+        idle_timeout: float = SESSION_IDLE_TIMEOUT,
+        max_sessions: int = SESSION_MAX_SESSIONS,
+    ):
+        self.max_turns = max_turns
+        self.max_bytes = max_bytes
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self._sessions: OrderedDict[int, ConversationSession] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def get(self, channel_id: int) -> ConversationSession:
+        """
+        Returns the session of a channel, creating it if needed.
+
+        Args:
+            channel_id (int): The ID of the channel or thread.
+
+        Returns:
+            ConversationSession: The session of the channel.
+        """
+        self._evict_idle()
+        session = self._sessions.get(channel_id)
+        if session is None:
+            session = self._sessions[channel_id] = ConversationSession()
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        self._sessions.move_to_end(channel_id)
+        session.last_used = time.monotonic()
+        return session
+
+    def peek(self, channel_id: int) -> Optional[ConversationSession]:
+        """
+        Returns the session of a channel without creating it.
+
+        Args:
+            channel_id (int): The ID of the channel or thread.
+
+        Returns:
+            Optional[ConversationSession]: The session, or None if the channel has none.
+        """
+        self._evict_idle()
+        return self._sessions.get(channel_id)
+
+    def reset(self, channel_id: int) -> bool:
+        """
+        Removes the session of a channel, the next message starts a new conversation.
+
+        Args:
+            channel_id (int): The ID of the channel or thread.
+
+        Returns:
+            bool: True if the channel had a session.
+        """
+        return self._sessions.pop(channel_id, None) is not None
+
+    def append_turn(self, session: ConversationSession, content: str, awnser: str):
+        """
+        Appends a turn to a session, respecting the caps of the store.
+
+        Args:
+            session (ConversationSession): The session.
+            content (str): The user message of the turn.
+            awnser (str): The answer of the model.
+        """
+        session.append_turn(content, awnser, self.max_turns, self.max_bytes)
+
+    def _evict_idle(self):
+        deadline = time.monotonic() - self.idle_timeout
+        while self._sessions:
+            channel_id, session = next(iter(self._sessions.items()))
+            if session.last_used >= deadline or session.lock.locked():
+                break
+            del self._sessions[channel_id]
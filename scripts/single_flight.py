@@ -0,0 +1,78 @@
+"""
+This file contains the coalescing of identical requests that are in flight at the same time.
+The first caller of a key (the leader) starts the request in its own task, every caller that arrives
+while it runs (a follower) awaits the same task instead of sending the request again.
+The task is shielded from the cancellation of any single caller and only cancelled once every caller is gone,
+and its result or exception is delivered to every caller.
+"""
+
+import asyncio
+from typing import Any, Awaitable, Callable, Hashable
+
+
+class _Call:
+    """A request in flight and the number of callers awaiting it."""
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Runs at most one request per key at a time and shares its result between the callers.
+
+    Attributes:
+        leaders (int): The number of requests that were started.
+        followers (int): The number of callers that joined a request in flight instead of starting one.
+
+    Methods:
+        do: Runs the request of a key, or joins the one in flight.
+        in_flight: The number of requests in flight.
+    """
+
+    def __init__(self):
+        self._calls: dict[Hashable, _Call] = {}
+        self.leaders = 0
+        self.followers = 0
+
+    async def do(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Runs the request of a key, or joins the one in flight.
+
+        Args:
+            key (Hashable): The key that identifies identical requests.
+            factory (Callable): A callable returning the coroutine of the request, only called by the leader.
+
+        Returns:
+            Any: The result of the request.
+
+        Raises:
+            Exception: The exception raised by the request, for every caller.
+        """
+        call = self._calls.get(key)
+        if call is None:
+            call = _Call(asyncio.create_task(factory()))
+            self._calls[key] = call
+            call.task.add_done_callback(lambda _: self._forget(key, call))
+            self.leaders += 1
+        else:
+            self.followers += 1
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                # Every caller was cancelled, nobody needs the result anymore
+                self._forget(key, call)
+                call.task.cancel()
+
+    def in_flight(self) -> int:
+        """Returns the number of requests in flight."""
+        return len(self._calls)
+
+    def _forget(self, key: Hashable, call: _Call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
@@ -0,0 +1,129 @@
+"""
+This file contains the helpers used to stream a chat completion from the OpenWebUI API into Discord.
+The completion arrives as Server-Sent Events, which are parsed without any line length limit
+(the web search sources can be very large), and the partial answer is shown in the deferred response
+while it is being generated. Edits go through the coalescer of the response, so the bot stays under
+Discord's edit rate limits and the final answer always replaces the preview.
+"""
+
+import os
+from typing import AsyncIterator
+
+import aiohttp
+import discord
+from edit_coalescer import EditCoalescer
+from page_layout import (
+    EMBED_DESCRIPTION_LIMIT,
+    EMBED_FIELD_LIMIT,
+    EMBED_TOTAL_LIMIT,
+    QUESTION_NAME,
+    THOUGHT_NAME,
+)
+from think_parser import ThinkParser
+
+# Minimum amount of seconds between two edits of the streamed response
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))
+
+
+async def iter_sse_data(stream: aiohttp.StreamReader) -> AsyncIterator[str]:
+    """
+    Parses a Server-Sent Events stream and yields the payload of every "data:" line.
+
+    Args:
+        stream (aiohttp.StreamReader): The body of the streamed response.
+
+    Yields:
+        str: The payload of a data line, without the "data:" prefix.
+    """
+    # Only the new chunk is split, the start of an unfinished line is kept aside until its end arrives,
+    # so a very long line costs its length once and not once per chunk
+    pending: list[bytes] = []
+    async for chunk in stream.iter_any():
+        *lines, rest = chunk.split(b"\n")
+        if lines:
+            lines[0] = b"".join(pending) + lines[0]
+            pending = []
+        for line in lines:
+            line = line.strip()
+            if line.startswith(b"data:"):
+                yield line[5:].strip().decode("utf-8")
+        if rest:
+            pending.append(rest)
+    line = b"".join(pending).strip()
+    if line.startswith(b"data:"):
+        yield line[5:].strip().decode("utf-8")
+
+
+def tail(text: str, size: int) -> str:
+    """
+    Returns the last characters of a string, marking it when it got truncated.
+
+    Args:
+        text (str): The text to shorten.
+        size (int): The maximum size of the result.
+
+    Returns:
+        str: The text itself if it fits, otherwise its last characters prefixed with an ellipsis.
+    """
+    if len(text) <= size:
+        return text
+    return "…" + text[-(size - 1) :]
+
+
+class StreamingPreview:
+    """
+    Shows a partial answer in the deferred response of an interaction while it is generated.
+
+    The text is read from the parser only when an edit is sent, and a new edit is only submitted when none
+    is waiting, so a fast stream results in at most one edit per interval of the coalescer.
+
+    Args:
+        interaction (discord.Interaction): The deferred interaction to edit.
+        prompt (str): The question that is being answered.
+        parser (ThinkParser): The parser that is fed the streamed completion.
+        edits (EditCoalescer): The coalescer of the edits of the response.
+    """
+
+    def __init__(
+        self,
+        interaction: discord.Interaction,
+        prompt: str,
+        parser: ThinkParser,
+        edits: EditCoalescer,
+    ):
+        self.interaction = interaction
+        self.prompt = prompt
+        self.parser = parser
+        self.edits = edits
+
+    def update(self):
+        """Submits an edit with the latest partial answer if none is waiting."""
+        if not self.edits.pending:
+            self.edits.submit(self._send)
+
+    def build_embed(self) -> discord.Embed:
+        """
+        Builds the embed that shows the partial answer.
+
+        Returns:
+            discord.Embed: The embed of the partial answer.
+        """
+        title = "Generating answer…"
+        thought = tail(self.parser.thought, EMBED_FIELD_LIMIT)
+        question = tail(self.prompt, EMBED_FIELD_LIMIT)
+        # The whole embed has to stay under Discord's total limit, the answer gets the room left
+        room = EMBED_TOTAL_LIMIT - len(title) - len(QUESTION_NAME) - len(question)
+        if thought:
+            room -= len(THOUGHT_NAME) + len(thought)
+        emb = discord.Embed(
+            title=title,
+            description=tail(self.parser.awnser, min(EMBED_DESCRIPTION_LIMIT, room))
+            or "Thinking…",
+        )
+        if thought:
+            emb.add_field(name=THOUGHT_NAME, value=thought, inline=False)
+        emb.add_field(name=QUESTION_NAME, value=question, inline=False)
+        return emb
+
+    async def _send(self):
+        await self.interaction.edit_original_response(embed=self.build_embed())
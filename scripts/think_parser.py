@@ -0,0 +1,129 @@
+"""
+This file contains an incremental parser that splits a completion into its thought process and its answer.
+Reasoning models wrap their thought process in <think>...</think> tags. The parser is a small state machine
+that is fed the completion chunk by chunk (as it is streamed), so it handles tags split across chunks,
+several think blocks and think blocks that are never closed, and it looks at every character only once.
+"""
+
+# Kinds of the segments emitted by the parser
+THOUGHT = "thought"
+AWNSER = "awnser"
+
+
+def _partial_tag_length(text: str, tag: str) -> int:
+    """
+    Returns the length of the longest end of the text that is the start of the tag.
+
+    Args:
+        text (str): The text to check.
+        tag (str): The tag that could be cut at the end of the text.
+
+    Returns:
+        int: The amount of characters at the end of the text that could be the start of the tag.
+    """
+    for size in range(min(len(tag) - 1, len(text)), 0, -1):
+        if text.endswith(tag[:size]):
+            return size
+    return 0
+
+
+class ThinkParser:
+    """
+    Splits a completion into thought and answer segments as it arrives.
+
+    Attributes:
+        in_thought (bool): Whether the parser is currently inside a think block.
+        thoughts (list[str]): The content of every think block, in order.
+        awnser_parts (list[str]): The parts of the answer, in order.
+
+    Methods:
+        feed: Parses the next chunk of the completion and returns the new segments.
+        close: Flushes the text held back at the end of the completion and returns the last segments.
+        thought: The thought process, every think block separated by an empty line.
+        awnser: The answer, without the think blocks.
+    """
+
+    OPEN_TAG = "<think>"
+    CLOSE_TAG = "</think>"
+
+    def __init__(self):
+        self.in_thought = False
+        self.thoughts: list[str] = []
+        self.awnser_parts: list[str] = []
+        self._thought_parts: list[str] = []
+        self._pending = ""
+
+    def _emit(self, text: str, segments: list[tuple[str, str]]):
+        if not text:
+            return
+        if self.in_thought:
+            self._thought_parts.append(text)
+            segments.append((THOUGHT, text))
+        else:
+            self.awnser_parts.append(text)
+            segments.append((AWNSER, text))
+
+    def _end_thought(self):
+        self.thoughts.append("".join(self._thought_parts))
+        self._thought_parts = []
+
+    def feed(self, chunk: str) -> list[tuple[str, str]]:
+        """
+        Parses the next chunk of the completion.
+
+        A tag cut at the end of the chunk is held back until the next chunk tells if it is a tag.
+
+        Args:
+            chunk (str): The next part of the completion.
+
+        Returns:
+            list[tuple[str, str]]: The new segments, each one is a kind (THOUGHT or AWNSER) and its text.
+        """
+        segments: list[tuple[str, str]] = []
+        text = self._pending + chunk
+        self._pending = ""
+        position = 0
+
+        while True:
+            tag = self.CLOSE_TAG if self.in_thought else self.OPEN_TAG
+            index = text.find(tag, position)
+            if index == -1:
+                break
+            self._emit(text[position:index], segments)
+            if self.in_thought:
+                self._end_thought()
+            self.in_thought = not self.in_thought
+            position = index + len(tag)
+
+        held_back = _partial_tag_length(text[position:], tag)
+        self._emit(text[position : len(text) - held_back], segments)
+        self._pending = text[len(text) - held_back :]
+        return segments
+
+    def close(self) -> list[tuple[str, str]]:
+        """
+        Ends the completion, the held back text is not a tag anymore and an unclosed think block is closed.
+
+        Returns:
+            list[tuple[str, str]]: The last segments.
+        """
+        segments: list[tuple[str, str]] = []
+        self._emit(self._pending, segments)
+        self._pending = ""
+        if self.in_thought:
+            self._end_thought()
+            self.in_thought = False
+        return segments
+
+    @property
+    def thought(self) -> str:
+        """The thought process, including the think block that is still open."""
+        thoughts = self.thoughts
+        if self._thought_parts:
+            thoughts = thoughts + ["".join(self._thought_parts)]
+        return "\n\n".join(thought.strip() for thought in thoughts if thought.strip())
+
+    @property
+    def awnser(self) -> str:
+        """The answer, without the think blocks."""
+        return "".join(self.awnser_parts).strip()
@@ -0,0 +1,186 @@
+"""
+This file contains the recorder of the traffic between the bot and the OpenWebUI API.
+When TRACE_PATH is set, a sample of the chat and image requests is written to a JSONL file (gzip compressed
+when the path ends in .gz), one line per request with its body, the status and body of the response, and
+the time until the first byte and until the end. The traces keep what synthetic payloads lack (long think
+blocks, big source lists, multilingual text) and are replayed by benchmarks/replay_traces.py.
+Traces are scrubbed before they are written: chat IDs and keys are dropped, and Discord mentions, IDs and
+e-mail addresses are replaced. Scrubbing, serialization and writing run in a worker thread.
+"""
+
+import asyncio
+import gzip
+import json
+import os
+import random
+import re
+import time
+from typing import Any, Iterator, Optional
+
+TRACE_PATH = os.getenv("TRACE_PATH", "")
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1"))
+
+# Version of the format of a trace line
+TRACE_VERSION = 1
+
+# Keys dropped from the recorded bodies, whatever their depth
+SCRUBBED_KEYS = {"chat_id", "api_key", "authorization", "token", "user"}
+
+_MENTION = re.compile(r"<(@[!&]?|#)\d+>")
+_SNOWFLAKE = re.compile(r"\b\d{17,20}\b")
+_EMAIL = re.compile(r"[\w.+-]+@[\w-]+\.[\w.-]+")
+
+
+def scrub(value: Any) -> Any:
+    """
+    Removes what identifies a user or a chat from a recorded body.
+
+    Args:
+        value (Any): The body, as parsed from JSON.
+
+    Returns:
+        Any: A scrubbed copy of the body.
+    """
+    if isinstance(value, dict):
+        return {
+            key: scrub(item)
+            for key, item in value.items()
+            if str(key).lower() not in SCRUBBED_KEYS
+        }
+    if isinstance(value, list):
+        return [scrub(item) for item in value]
+    if isinstance(value, str):
+        value = _MENTION.sub(r"<\g<1>0>", value)
+        value = _SNOWFLAKE.sub("0", value)
+        return _EMAIL.sub("user@example.com", value)
+    return value
+
+
+def read_traces(path: str) -> Iterator[dict]:
+    """
+    Reads the traces of a file written by TraceRecorder.
+
+    Args:
+        path (str): The path of the file, gzip compressed if it ends in .gz.
+
+    Yields:
+        dict: The traces, in the order they were recorded.
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+class TraceRecorder:
+    """
+    Writes a sample of the OpenWebUI requests and responses to a trace file.
+
+    Args:
+        path (str): The path of the trace file, an empty string disables the recorder.
+        sample_rate (float): The share of the requests recorded.
+
+    Attributes:
+        recorded (int): The number of traces written.
+        failed (int): The number of traces lost because the file could not be written.
+
+    Methods:
+        record: Records a request and its response.
+        close: Writes the traces that are still waiting.
+    """
+
+    def __init__(self, path: str = TRACE_PATH, sample_rate: float = TRACE_SAMPLE_RATE):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.recorded = 0
+        self.failed = 0
+        self._pending: list[dict] = []
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def enabled(self) -> bool:
+        """Whether the recorder writes anything."""
+        return bool(self.path)
+
+    def record(
+        self,
+        kind: str,
+        request: dict,
+        status: int,
+        response: Any,
+        started_at: float,
+        first_byte_at: Optional[float],
+        stream: bool = False,
+    ):
+        """
+        Records a request and its response, unless it is left out of the sample.
+
+        The bodies must not be changed afterwards, they are serialized later in a worker thread.
+
+        Args:
+            kind (str): The kind of request ("chat" or "image").
+            request (dict): The body of the request.
+            status (int): The status code of the response.
+            response (Any): The body of the response, parsed from JSON or as text.
+            started_at (float): The monotonic time at which the request was sent.
+            first_byte_at (Optional[float]): The monotonic time at which the response started.
+            stream (bool): Whether the response was streamed, response is then the assembled completion.
+        """
+        if not self.enabled or random.random() >= self.sample_rate:
+            return
+        finished_at = time.monotonic()
+        self._pending.append(
+            {
+                "version": TRACE_VERSION,
+                "kind": kind,
+                "stream": stream,
+                "time": time.time(),
+                "model": request.get("model"),
+                "status": status,
+                "first_byte": (first_byte_at or finished_at) - started_at,
+                "total": finished_at - started_at,
+                "request": request,
+                "response": response,
+            }
+        )
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush())
+
+    async def close(self):
+        """Writes the traces that are still waiting."""
+        if self._task is not None:
+            await self._task
+        if self._pending:
+            await self._flush()
+
+    async def _flush(self):
+        # The traces recorded while a batch is written make up the next batch
+        while self._pending:
+            batch, self._pending = self._pending, []
+            try:
+                await asyncio.to_thread(self._write, batch)
+            except OSError:
+                # A full or read-only disk must not stop the requests
+                self.failed += len(batch)
+                continue
+            self.recorded += len(batch)
+
+    def _write(self, batch: list[dict]):
+        lines = "".join(
+            json.dumps(
+                {
+                    **trace,
+                    "request": scrub(trace["request"]),
+                    "response": scrub(trace["response"]),
+                },
+                ensure_ascii=False,
+                separators=(",", ":"),
+            )
+            + "\n"
+            for trace in batch
+        )
+        # Appending to a gzip file adds a member, readers see a single stream
+        opener = gzip.open if self.path.endswith(".gz") else open
+        with opener(self.path, "at", encoding="utf-8") as file:
+            file.write(lines)
@@ -0,0 +1,101 @@
+"""
+This file contains the registry of the live pagination views.
+Every answer keeps a view (and its pages) in memory for as long as its buttons work, so the registry bounds
+how many views are live and how many bytes of pages they retain. When a cap is reached the least recently
+used view is stopped and told it was evicted, so nothing keeps it in memory anymore (the pagination then
+removes the buttons from its message, unless its answer is stored and the buttons keep working from there).
+"""
+
+import asyncio
+import os
+from collections import OrderedDict
+
+import discord
+
+VIEW_REGISTRY_MAX_VIEWS = int(os.getenv("VIEW_REGISTRY_MAX_VIEWS", "2000"))
+VIEW_REGISTRY_MAX_BYTES = int(
+    os.getenv("VIEW_REGISTRY_MAX_BYTES", str(16 * 1024 * 1024))
+)
+
+
+class ViewRegistry:
+    """
+    Keeps the live views under a count and a memory cap, evicting the least recently used.
+
+    The views must have an evicted coroutine method, called when they are evicted.
+
+    Args:
+        max_views (int): The maximum number of live views.
+        max_bytes (int): The maximum size of the pages retained by the live views.
+
+    Attributes:
+        size (int): The size of the pages retained by the live views.
+        evictions (int): The number of views evicted.
+
+    Methods:
+        register: Adds a view.
+        touch: Marks a view as recently used.
+        remove: Forgets a view without evicting it.
+    """
+
+    def __init__(
+        self,
+        max_views: int = VIEW_REGISTRY_MAX_VIEWS,
+        max_bytes: int = VIEW_REGISTRY_MAX_BYTES,
+    ):
+        self.max_views = max_views
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.evictions = 0
+        self._views: OrderedDict[discord.ui.View, int] = OrderedDict()
+        self._tasks: set[asyncio.Task] = set()
+
+    def __len__(self) -> int:
+        return len(self._views)
+
+    def register(self, view: discord.ui.View, size: int):
+        """
+        Adds a view, evicting the least recently used ones if a cap is reached.
+
+        Args:
+            view (discord.ui.View): The view.
+            size (int): The size of the pages the view retains.
+        """
+        self.remove(view)
+        self._views[view] = size
+        self.size += size
+        while len(self._views) > 1 and (
+            len(self._views) > self.max_views or self.size > self.max_bytes
+        ):
+            self._evict()
+
+    def touch(self, view: discord.ui.View):
+        """
+        Marks a view as recently used, it is evicted last.
+
+        Args:
+            view (discord.ui.View): The view.
+        """
+        if view in self._views:
+            self._views.move_to_end(view)
+
+    def remove(self, view: discord.ui.View):
+        """
+        Forgets a view without removing its buttons, when it is stopped or replaced.
+
+        Args:
+            view (discord.ui.View): The view.
+        """
+        size = self._views.pop(view, None)
+        if size is not None:
+            self.size -= size
+
+    def _evict(self):
+        view, size = self._views.popitem(last=False)
+        self.size -= size
+        self.evictions += 1
+        view.stop()
+        task = asyncio.create_task(view.evicted())
+        # Keep a reference so the task is not garbage collected while it runs
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
@@ -0,0 +1,151 @@
+"""
+Tests of the backend pool against local stand-ins of OpenWebUI: a backend that stops or fails gets its breaker
+opened, the requests go to the other backends, and it comes back through a half-open trial request.
+
+Usage:
+    python -m pytest tests
+"""
+
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "benchmarks"))
+
+import aiohttp  # noqa: E402
+from backend_pool import CLOSED, HALF_OPEN, OPEN, Backend, BackendPool  # noqa: E402
+from openwebui import OpenWebUIClient  # noqa: E402
+from standin import ChatReply, StandIn  # noqa: E402
+
+FAILURE_THRESHOLD = 2
+OPEN_SECONDS = 0.2
+
+
+class FailingStandIn(StandIn):
+    """A stand-in whose chat requests fail with a 503 while failing is set."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.failing = False
+
+    def chat_reply(self, body: dict) -> ChatReply:
+        if self.failing:
+            return ChatReply(503, "", [], 0.0, 0.0, "Service unavailable")
+        return super().chat_reply(body)
+
+
+class BackendPoolTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.standins = [
+            FailingStandIn("Hello", [], latency=0.0, image_bytes=0) for _ in range(3)
+        ]
+        self.backends = [
+            Backend(await standin.start(), "") for standin in self.standins
+        ]
+        self.client = OpenWebUIClient([])
+        # The health probes would race the breaker, only the requests drive it here
+        self.client.pool = BackendPool(
+            self.backends,
+            probe_interval=0,
+            failure_threshold=FAILURE_THRESHOLD,
+            open_seconds=OPEN_SECONDS,
+        )
+        await self.client.start()
+
+    async def asyncTearDown(self):
+        await self.client.close()
+        for standin in self.standins:
+            await standin.close()
+
+    async def chat(self) -> bool:
+        try:
+            async with self.client.post(
+                "/api/chat/completions",
+                "chat",
+                json={"model": "test", "messages": [], "stream": False},
+            ) as response:
+                await response.read()
+                return response.status == 200
+        except aiohttp.ClientError:
+            return False
+
+    async def eject(self, backend: Backend):
+        # The other backends answer, so every request is sent until the breaker of this one opens
+        for _ in range(50):
+            await self.chat()
+            if backend.state == OPEN:
+                return
+        self.fail("The breaker of the backend did not open")
+
+    async def recover(self, backend: Backend):
+        await asyncio.sleep(OPEN_SECONDS)
+        self.client.pool.pick()
+        self.assertEqual(backend.state, HALF_OPEN)
+        for _ in range(50):
+            self.assertTrue(await self.chat())
+            if backend.state == CLOSED:
+                return
+        self.fail("The backend did not come back")
+
+    async def test_stopped_backend(self):
+        stopped, backend = self.standins[0], self.backends[0]
+        await stopped.close()
+
+        await self.eject(backend)
+        self.assertEqual(backend.errors, FAILURE_THRESHOLD)
+        answered = sum(standin.requests for standin in self.standins[1:])
+        for _ in range(10):
+            self.assertTrue(await self.chat())
+        self.assertEqual(
+            sum(standin.requests for standin in self.standins[1:]), answered + 10
+        )
+        self.assertEqual(backend.requests, FAILURE_THRESHOLD)
+
+        port = int(backend.url.rsplit(":", 1)[1])
+        await stopped.start(port=port)
+        await self.recover(backend)
+        self.assertEqual(backend.failures, 0)
+
+    async def test_failing_backend(self):
+        failing, backend = self.standins[1], self.backends[1]
+        failing.failing = True
+
+        await self.eject(backend)
+        requests = failing.requests
+        for _ in range(10):
+            self.assertTrue(await self.chat())
+        self.assertEqual(failing.requests, requests)
+
+        failing.failing = False
+        await self.recover(backend)
+        self.assertGreater(failing.requests, requests)
+
+    async def test_failed_trial_reopens(self):
+        failing, backend = self.standins[2], self.backends[2]
+        failing.failing = True
+        await self.eject(backend)
+
+        await asyncio.sleep(OPEN_SECONDS)
+        for _ in range(50):
+            await self.chat()
+            if backend.requests > FAILURE_THRESHOLD:
+                break
+        # The half-open trial failed, the breaker opens again at once
+        self.assertEqual(backend.requests, FAILURE_THRESHOLD + 1)
+        self.assertEqual(backend.state, OPEN)
+
+
+class PickTest(unittest.TestCase):
+    def test_p2c_compares_two_backends(self):
+        backends = [Backend(f"http://backend{index}", "") for index in range(3)]
+        backends[0].outstanding = 5
+        pool = BackendPool(backends, strategy="p2c", probe_interval=0)
+        # Whichever two are drawn, the busy backend loses against the other one
+        for _ in range(100):
+            self.assertIsNot(pool.pick(), backends[0])
+
+
+if __name__ == "__main__":
+    unittest.main()